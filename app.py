@@ -1,80 +1,30 @@
 import base64
+import copy
 import datetime
-import io
+import functools
+import os
 import sys
 import abstcal as ac
 import pandas as pd
 import streamlit as st
 from streamlit.report_thread import get_report_ctx
+from compact import decode
+from diagnostics import Diagnostics, measure
+from disk_cache import disk_cache
+from downloads import download_formats, download_registry, download_url, register_route
+from ingestion import SITE_COLUMN, SiteFile, profile_sites, reconcile_subjects, site_name, upload_cache
+from jobs import CANCELLED, FAILED, job_manager
+from lapse_rules import parse_lapse_definitions
+from pipeline import PipelineContext, calculate_abstinence, params_signature, process_tlfb_data, process_visit_data
+from sessions import session_store
 
 # Hide tracebacks
 sys.tracebacklimit = 0
 
 
-# Use the following session to track data
-# Reference: https://gist.github.com/tvst/036da038ab3e999a64497f42de966a92
-class SessionState(object):
-    def __init__(self, **kwargs):
-        """A new SessionState object.
-
-        Parameters
-        ----------
-        **kwargs : any
-            Default values for the session state.
-
-        Example
-        -------
-        >>> session_state = SessionState(user_name='', favorite_color='black')
-        >>> session_state.user_name = 'Mary'
-        ''
-        >>> session_state.favorite_color
-        'black'
-
-        """
-        for key, val in kwargs.items():
-            setattr(self, key, val)
-
-
-@st.cache(allow_output_mutation=True)
-def get_session(id, **kwargs):
-    return SessionState(**kwargs)
-
-
-def get(**kwargs):
-    """Gets a SessionState object for the current session.
-
-    Creates a new object if necessary.
-
-    Parameters
-    ----------
-    **kwargs : any
-        Default values you want to add to the session state, if we're creating a
-        new one.
-
-    Example
-    -------
-    >>> session_state = get(user_name='', favorite_color='black')
-    >>> session_state.user_name
-    ''
-    >>> session_state.user_name = 'Mary'
-    >>> session_state.favorite_color
-    'black'
-
-    Since you set user_name above, next time your script runs this will be the
-    result:
-    >>> session_state = get(user_name='', favorite_color='black')
-    >>> session_state.user_name
-    'Mary'
-
-    """
-    ctx = get_report_ctx()
-    id = ctx.session_id
-    return get_session(id, **kwargs)
-
-
-session_state = get(tlfb_data=None, visit_data=None)
-
 # Shared options
+preview_page_size = 100
+supported_file_types = ["csv", "txt", "tsv", "xlsx", "parquet", "feather", "gz", "zip"]
 duplicate_options_mapped = {
     "Keep the minimal only": "min",
     "Keep the maximal only": "max",
@@ -92,19 +42,7 @@ outlier_options_mapped = {
 outlier_options = list(outlier_options_mapped)
 outlier_options_mapped_reversed = {value: key for key, value in outlier_options_mapped.items()}
 
-# TLFB data-related params
-tlfb_data_params = dict.fromkeys([
-    "data",
-    "cutoff",
-    "subjects",
-    "duplicate_mode",
-    "imputation_last_record",
-    "imputation_mode",
-    "imputation_gap_limit",
-    "outliers_mode",
-    "allowed_min",
-    "allowed_max"
-])
+# TLFB data-related options
 tlfb_imputation_options_mapped = {
     "Don't impute missing records":               None,
     "Linear (a linear interpolation in the gap)": "linear",
@@ -113,19 +51,7 @@ tlfb_imputation_options_mapped = {
 }
 tlfb_imputation_options = list(tlfb_imputation_options_mapped)
 
-# Visit data-related params
-visit_data_params = dict.fromkeys([
-    "data",
-    "data_format",
-    "expected_visits",
-    "subjects",
-    "duplicate_mode",
-    "imputation_mode",
-    "anchor_visit",
-    "allowed_min",
-    "allowed_max",
-    "outliers_mode"
-])
+# Visit data-related options
 visit_data_formats = [
     "Long",
     "Wide"
@@ -138,27 +64,7 @@ visit_imputation_options_mapped = {
 visit_imputation_options = list(visit_imputation_options_mapped)
 visit_imputation_options_mapped_reversed = {value: key for key, value in visit_imputation_options_mapped.items()}
 
-# Biochemical data-related params
-bio_data_params = dict.fromkeys([
-    "data",
-    "cutoff",
-    "overridden_amount",
-    "duplicate_mode",
-    "imputation_mode",
-    "allowed_min",
-    "allowed_max",
-    "outliers_mode",
-    "enable_interpolation",
-    "half_life",
-    "days_interpolation"
-])
-
-# Calculator-related params
-abst_pp_params = dict()
-abst_cont_params = dict()
-abst_prol_params = dict()
-abst_params_shared = dict()
-
+# Calculator-related options
 calculation_assumptions_mapped = {
     "Intent-to-Treat (ITT)": "itt",
     "Responders-Only (RO)":  "ro"
@@ -171,20 +77,40 @@ abst_options = [
 ]
 
 
-def _load_elements():
+def _load_elements(context):
     st.title("Abstinence Calculator")
-    _load_overview_elements()
+    _load_overview_elements(context)
     st.markdown("***")
-    _load_tlfb_elements()
+    tlfb_subjects, refresh_tlfb, tlfb_container = _load_tlfb_elements(context)
     st.markdown("***")
-    _load_visit_elements()
+    _load_visit_elements(context, tlfb_subjects)
+    # The TLFB data are processed after the Visit data have decided the subjects, and shown in their own section
+    if refresh_tlfb or context.tlfb_data is not None:
+        with tlfb_container:
+            _process_tlfb_data(context, refresh_tlfb)
     st.markdown("***")
-    _load_cal_elements()
-
-
-def _load_overview_elements():
-    st.markdown("This web app calculates abstinence using the Timeline-Followback data in addiction research. No data "
-                "will be saved or shared.")
+    _load_cal_elements(context)
+    if context.diagnostics is not None:
+        st.markdown("***")
+        _load_diagnostics_elements(context.diagnostics)
+
+
+def _storage_notice():
+    # The disk cache and the spilled sessions are opt-in for the deployment, so the notice follows its settings
+    notice = (f"Your uploaded data are held in the server's memory while your session is active, and dropped after "
+              f"{session_store.ttl // 60} idle minutes. They aren't shared with other users.")
+    if disk_cache.directory is not None:
+        notice += (" This server also keeps the processed data and the abstinence results in a cache on its disk, "
+                   "which outlasts the session and server restarts until the cache needs the space.")
+    if session_store.spill_dir is not None:
+        notice += (f" Instead of being dropped, idle sessions, with their uploaded data, are saved on the server's "
+                   f"disk for up to {session_store.spill_ttl // 86400} days.")
+    return notice
+
+
+def _load_overview_elements(context):
+    st.markdown("This web app calculates abstinence using the Timeline-Followback data in addiction research. " +
+                _storage_notice())
     st.markdown("For advanced use cases and detailed API references, please refer to the package's "
                 "[GitHub](https://github.com/ycui1-mda/abstcal) page for more information.")
     st.markdown("**Disclaimer**: Not following the steps or variation in your source data may result in incorrect "
@@ -205,20 +131,42 @@ def _load_overview_elements():
                 "uploaded files, please remove them manually and re-upload the new ones.")
 
     if st.button("Reset Data"):
-        session_state.tlfb_data = None
-        session_state.visit_data = None
-
+        context.reset_data()
+        job_manager.discard(get_report_ctx().session_id)
+
+    cache_stats = upload_cache.stats()
+    st.markdown(f"Parsed Upload Cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses, "
+                f"{cache_stats['bytes'] / 1024 ** 2:.1f} MB in use")
+    store_stats = session_store.stats()
+    st.markdown(f"Active Sessions: {store_stats['sessions']} ({store_stats['bytes'] / 1024 ** 2:.1f} MB resident), "
+                f"Spilled Sessions: {store_stats['spilled_sessions']}")
+    if disk_cache.directory is not None:
+        disk_stats = disk_cache.stats()
+        st.markdown(f"Result Cache on Disk: {disk_stats['entries']} entries, {disk_stats['bytes'] / 1024 ** 2:.1f} MB "
+                    f"of {disk_stats['max_bytes'] / 1024 ** 2:.0f} MB")
+    job_stats = job_manager.stats()
+    st.markdown(f"Background Jobs: {job_stats['running']} running, {job_stats['pending']} waiting")
+    # Tracing the memory slows the measured steps, so the diagnostics are collected only on request
+    if st.checkbox("Collect diagnostics (wall time, CPU time, peak memory and rows of each step, shown at the end of "
+                   "the page; the steps run slower while it's on)"):
+        if context.diagnostics is None:
+            context.diagnostics = Diagnostics(get_report_ctx().session_id)
+    else:
+        context.diagnostics = None
     st.markdown(f"Current Version of abstcal: {ac.__version__}")
     st.markdown(f"Last Update Date: Dec 15, 2020")
 
 
-def _load_tlfb_elements():
+def _load_tlfb_elements(context):
+    tlfb_data_params = context.tlfb_data_params
+    bio_data_params = context.bio_data_params
     st.header("Section 1. TLFB Data")
     st.markdown("""The dataset should have three columns: __*id*__, 
     __*date*__, and __*amount*__. The id column stores the subject ids, each of which should 
     uniquely identify a study subject. The date column stores the dates when daily substance 
     uses are collected. The amount column stores substance uses for each day. Supported file 
-    formats include comma-separated (.csv), tab-delimited (.txt), and Excel spreadsheets (.xls, .xlsx).  \n\n
+    formats include delimited text (.csv, .txt, .tsv), also compressed (.gz, .zip), Excel spreadsheets (.xlsx), 
+    and Parquet or Feather files.  \n\n
       \n\nid | date | amount 
     ------------ | ------------- | -------------
     1000 | 02/03/2019 | 10
@@ -227,17 +175,21 @@ def _load_tlfb_elements():
       \n\n
     """)
     container = st.beta_container()
-    uploaded_file = container.file_uploader(
-        "Specify the TLFB data file on your computer.",
-        ["csv", "txt", "xlsx"]
+    uploaded_files = container.file_uploader(
+        "Specify the TLFB data file on your computer. For a multi-site study, specify the file of each site.",
+        supported_file_types,
+        accept_multiple_files=True
     )
     tlfb_subjects = list()
-    if uploaded_file:
-        data = io.BytesIO(uploaded_file.getbuffer())
-        tlfb_data_params["data"] = df = pd.read_csv(data)
-        container.write(df)
-        tlfb_data = ac.TLFBData(df)
-        tlfb_subjects = sorted(tlfb_data.subject_ids)
+    if uploaded_files:
+        parsed_file = _load_uploads(context, uploaded_files, "tlfb", "TLFB")
+        tlfb_data_params["data"] = parsed_file.data
+        tlfb_data_params["data_digest"] = parsed_file.digest
+        # The session keeps the upload in the compact encoding, which is decoded for the preview only
+        df = decode(parsed_file.data)
+        _preview_data(df, "tlfb_upload", container)
+        _show_site_profiles(df, "tlfb", container)
+        tlfb_subjects = parsed_file.subjects
     else:
         container.write("The TLFB data are shown here after loading.")
 
@@ -335,14 +287,19 @@ def _load_tlfb_elements():
         """)
         if has_bio_data:
             bio_container = st.beta_container()
-            uploaded_file = bio_container.file_uploader(
-                "Specify the Biochemical data file on your computer.",
-                ["csv", "txt", "xlsx"]
+            uploaded_files = bio_container.file_uploader(
+                "Specify the Biochemical data file on your computer. For a multi-site study, specify the file of "
+                "each site.",
+                supported_file_types,
+                accept_multiple_files=True
             )
-            if uploaded_file:
-                data = io.BytesIO(uploaded_file.getbuffer())
-                bio_data_params["data"] = pd.read_csv(data)
-                bio_container.write(bio_data_params["data"])
+            if uploaded_files:
+                parsed_file = _load_uploads(context, uploaded_files, "bio", "biochemical")
+                bio_data_params["data"] = parsed_file.data
+                bio_data_params["data_digest"] = parsed_file.digest
+                df = decode(parsed_file.data)
+                _preview_data(df, "bio_upload", bio_container)
+                _show_site_profiles(df, "bio", bio_container)
             else:
                 bio_container.write("The Biochemical data are shown here after loading.")
 
@@ -380,40 +337,34 @@ def _load_tlfb_elements():
                     raise ValueError("The half life of the biochemical measure should be greater than zero.")
 
     processed_data = st.button("Get/Refresh TLFB Data Summary")
-
-    if processed_data or session_state.tlfb_data is not None:
-        _process_tlfb_data()
+    return tlfb_subjects, processed_data, st.beta_container()
 
 
-def _process_tlfb_data():
+def _process_tlfb_data(context, restart):
+    tlfb_data_params = context.tlfb_data_params
+    bio_data_params = context.bio_data_params
     tlfb_df = tlfb_data_params["data"]
     if tlfb_df is None:
         raise ValueError("Please specify the TLFB data in the file uploader above.")
 
-    tlfb_data = ac.TLFBData(
-        tlfb_df,
-        tlfb_data_params["cutoff"],
-        tlfb_data_params["subjects"]
-    )
-    session_state.tlfb_data = tlfb_data
-    abst_params_shared["tlfb_data"] = tlfb_data
-    _load_data_summary(tlfb_data, tlfb_data_params)
+    job = _submit_job("tlfb", params_signature(tlfb_data_params, bio_data_params),
+                      functools.partial(process_tlfb_data, diagnostics=context.diagnostics), tlfb_data_params,
+                      bio_data_params, restart=restart)
+    stage_results = _wait_for_job(job, "TLFB Data Processing")
+    if stage_results is None:
+        return
+    tlfb_data = stage_results["impute"].data
+    context.tlfb_data = tlfb_data
+    context.tlfb_index = stage_results["index"].output
+    context.tlfb_key = stage_results["impute"].key
+    _load_data_summary(stage_results, tlfb_data_params, "tlfb", context.diagnostics)
 
     tlfb_imputation_mode = tlfb_data_params["imputation_mode"]
     if tlfb_imputation_mode is not None:
         st.write("Imputation Summary")
-        imputation_params = [
-            tlfb_data_params["imputation_mode"],
-            tlfb_data_params["imputation_last_record"],
-            tlfb_data_params["imputation_gap_limit"]
-        ]
         bio_messages = list()
         if bio_data_params["data"] is not None:
             bio_messages.append("Note: Biochemical Data are used for TLFB imputation")
-            biochemical_data = ac.TLFBData(
-                bio_data_params["data"],
-                bio_data_params["cutoff"]
-            )
             bio_messages.append(f"Cutoff: {bio_data_params['cutoff']}")
             bio_messages.append(f"Interpolation: {bio_data_params['enable_interpolation']}")
             if bio_data_params["enable_interpolation"]:
@@ -421,22 +372,16 @@ def _process_tlfb_data():
                 bio_messages.append(f'Interpolated Days: {bio_data_params["days_interpolation"]}')
                 bio_messages.append(f'Overridden Amount for False Negative TLFB Records: '
                                     f'{bio_data_params["overridden_amount"]}')
-                biochemical_data.interpolate_biochemical_data(
-                    bio_data_params["half_life"],
-                    bio_data_params["days_interpolation"]
-                )
-            biochemical_data.drop_na_records()
-            biochemical_data.check_duplicates()
-            imputation_params.extend((biochemical_data, str(bio_data_params["overridden_amount"])))
 
-        st.write(tlfb_data.impute_data(*imputation_params))
+        st.write(stage_results["impute"].output)
         if bio_messages:
             st.write("; ".join(bio_messages))
     else:
         st.write("Imputation Action: None")
 
 
-def _load_visit_elements():
+def _load_visit_elements(context, tlfb_subjects):
+    visit_data_params = context.visit_data_params
     st.header("Section 2. Visit Data")
     st.markdown("""It needs to be in one of the following two formats.  \n\n**The long format.** 
     The dataset should have three columns: __*id*__, __*visit*__, 
@@ -454,20 +399,24 @@ def _load_visit_elements():
     1000 | 02/03/2019 | 02/10/2019 | 02/17/2019 | 03/09/2019 | 04/07/2019 | 05/06/2019
     1001 | 02/05/2019 | 02/13/2019 | 02/20/2019 | 03/11/2019 | 04/06/2019 | 05/09/2019""")
     container = st.beta_container()
-    uploaded_file = container.file_uploader(
-        "Specify the Visit data file on your computer.",
-        ["csv", "txt", "xlsx"]
+    uploaded_files = container.file_uploader(
+        "Specify the Visit data file on your computer. For a multi-site study, specify the file of each site.",
+        supported_file_types,
+        accept_multiple_files=True
     )
     visit_data_params['data_format'] = st.selectbox("Specify the file format", visit_data_formats).lower()
     visits = list()
-    if uploaded_file:
-        data = io.BytesIO(uploaded_file.getbuffer())
-        visit_data_params["data"] = df = pd.read_csv(data)
-        container.write(df)
-        visit_data = ac.VisitData(df, visit_data_params['data_format'])
-        visits = sorted(visit_data.visits)
+    visit_subjects = list()
+    if uploaded_files:
+        parsed_file = _load_uploads(context, uploaded_files, "visit", "visit", visit_data_params['data_format'])
+        visit_data_params["data"] = parsed_file.data
+        visit_data_params["data_digest"] = parsed_file.digest
+        df = decode(parsed_file.data)
+        _preview_data(df, "visit_upload", container)
+        _show_site_profiles(df, "visit", container, visit_data_params['data_format'])
+        visits = parsed_file.visits
         visit_data_params['expected_visits'] = visits
-        visit_subjects = sorted(visit_data.subject_ids)
+        visit_subjects = parsed_file.subjects
     else:
         container.write("The Visit data are shown here after loading.")
 
@@ -528,67 +477,112 @@ def _load_visit_elements():
                 value=None
             )
 
-    processed_data = st.button("Get/Refresh Visit Data Summary")
-
-    if processed_data or session_state.visit_data is not None:
-        _process_visit_data()
+    if tlfb_subjects and visit_subjects:
+        _load_reconciliation_elements(context, tlfb_subjects, visit_subjects)
 
+    processed_data = st.button("Get/Refresh Visit Data Summary")
 
-def _process_visit_data():
+    if processed_data or context.visit_data is not None:
+        _process_visit_data(context, processed_data)
+
+
+def _load_uploads(context, uploaded_files, kind, label, data_format=None):
+    # Each file of a multi-site study holds the data of one site, which is named after the file
+    with measure(context.diagnostics, "upload", label) as measured:
+        parsed_file = upload_cache.load_sites([SiteFile(site_name(x.name), x.getbuffer()) for x in uploaded_files],
+                                              kind, data_format, context.diagnostics)
+        measured["data_out"] = parsed_file.data
+    return parsed_file
+
+
+def _show_site_profiles(df, kind, container, data_format=None):
+    if SITE_COLUMN not in df.columns:
+        return
+    container.write(f"The data of {df[SITE_COLUMN].nunique()} sites are merged. The records of the same subject "
+                    f"and date (or visit) in several files are duplicates, handled the same as those within a file.")
+    if container.checkbox("Show the profile of each site", key=f"{kind}_site_profiles"):
+        _preview_data(profile_sites(df, kind, data_format), f"{kind}_site_profiles", container)
+
+
+def _load_reconciliation_elements(context, tlfb_subjects, visit_subjects):
+    tlfb_data_params = context.tlfb_data_params
+    reconciliation = reconcile_subjects(tlfb_subjects, visit_subjects, tlfb_data_params["subjects"],
+                                        context.visit_data_params["subjects"])
+    st.subheader("Subject Reconciliation")
+    st.write(f"TLFB Subjects: {len(tlfb_subjects)}; Visit Subjects: {len(visit_subjects)}; "
+             f"Selected Subjects in Both: {len(reconciliation.subjects)}")
+    for mismatches, key, label in ((reconciliation.tlfb_only, "tlfb_only", "TLFB data but no Visit data"),
+                                   (reconciliation.visit_only, "visit_only", "Visit data but no TLFB data")):
+        if mismatches:
+            _preview_data(pd.DataFrame({"id": mismatches}), f"{key}_subjects",
+                          lazy_label=f"Show the {len(mismatches)} subjects with {label}")
+    # Only the subjects in both data have their abstinence calculated, so the TLFB data of the others are skipped
+    if st.checkbox("Process only the selected subjects in both the TLFB and Visit data", value=True):
+        tlfb_data_params["subjects"] = reconciliation.subjects
+
+
+def _process_visit_data(context, restart):
+    visit_data_params = context.visit_data_params
     visit_df = visit_data_params["data"]
     if visit_df is None:
         raise ValueError("Please upload your Visit data and make sure it's loaded successfully.")
 
     st.write("Data Overview")
-    visit_data = ac.VisitData(
-        visit_df,
-        visit_data_params["data_format"],
-        visit_data_params["expected_visits"],
-        visit_data_params["subjects"]
-    )
-    session_state.visit_data = visit_data
-    abst_params_shared["visit_data"] = visit_data
-    _load_data_summary(visit_data, visit_data_params)
+    job = _submit_job("visit", params_signature(visit_data_params),
+                      functools.partial(process_visit_data, diagnostics=context.diagnostics), visit_data_params,
+                      restart=restart)
+    stage_results = _wait_for_job(job, "Visit Data Processing")
+    if stage_results is None:
+        return
+    visit_data = stage_results["impute"].data
+    context.visit_data = visit_data
+    context.visit_index = stage_results["dates"].output
+    context.visit_key = stage_results["impute"].key
+    _load_data_summary(stage_results, visit_data_params, "visit", context.diagnostics)
     imputation_mode = visit_data_params["imputation_mode"]
     if imputation_mode is not None:
         st.write(f'Imputation Summary (Parameters: anchor visit={visit_data_params["anchor_visit"]}, '
                  f'mode={visit_imputation_options_mapped_reversed[imputation_mode]})')
-        st.write(visit_data.impute_data(visit_data_params["anchor_visit"], visit_data_params["imputation_mode"]))
+        st.write(stage_results["impute"].output)
     else:
         st.write("Imputation Action: None")
     st.write("Visit Attendance Summary")
-    st.write(visit_data.get_retention_rates())
+    st.write(stage_results["retention"].output)
 
 
-def _load_data_summary(data, data_params):
+def _load_data_summary(stage_results, data_params, key, diagnostics=None):
+    with measure(diagnostics, "render", f"{key} summary", stage_results["profile"].data):
+        _show_data_summary(stage_results, data_params, key)
+
+
+def _show_data_summary(stage_results, data_params, key):
     st.subheader("Data Overview")
-    data_all_summary, data_subject_summary = \
-        data.profile_data(data_params["allowed_min"], data_params["allowed_max"])
+    data_all_summary, data_subject_summary = stage_results["profile"].output
     st.write(data_all_summary)
-    st.write(data_subject_summary)
+    _preview_data(data_subject_summary, f"{key}_subject_summary", lazy_label="Show the summary of each subject")
 
-    na_number = data.drop_na_records()
+    na_number = stage_results["drop_na"].output
     st.write(f"Removed Records With N/A Values Count: {na_number}")
 
     duplicate_mode = data_params["duplicate_mode"]
-    duplicates = data.check_duplicates(duplicate_mode)
+    duplicates = stage_results["duplicates"].output
     st.write(f"Duplicate Records Count: {duplicates}; "
              f"Duplicate Records Action: {duplicate_options_mapped_reversed[duplicate_mode]}")
 
     outliers_mode = data_params["outliers_mode"]
     if outliers_mode is not None:
         st.write(f"Outliers Summary for Action: {outlier_options_mapped_reversed[outliers_mode]}")
-        st.write(data.recode_outliers(
-            data_params["allowed_min"],
-            data_params["allowed_max"],
-            data_params["outliers_mode"])
-        )
+        st.write(stage_results["outliers"].output)
     else:
         st.write("Outliers Action: None")
 
 
-
-def _load_cal_elements():
+def _load_cal_elements(context):
+    visit_data_params = context.visit_data_params
+    abst_pp_params = context.abst_pp_params
+    abst_prol_params = context.abst_prol_params
+    abst_cont_params = context.abst_cont_params
+    abst_params_shared = context.abst_params_shared
     st.header("Section 3. Calculate Abstinence")
     abst_params_shared["mode"] = calculation_assumptions_mapped[
         st.selectbox("Abstinence Assumption Mode", calculation_assumptions)
@@ -597,6 +591,13 @@ def _load_cal_elements():
         "Including each of the visit dates as the end of the time window examined, otherwise the time window of concern"
         " will end the day before the visit date."
     )
+    abst_params_shared["workers"] = st.number_input(
+        "Number of worker processes for the calculation (subjects are split across the workers when more than one)",
+        value=1,
+        min_value=1,
+        max_value=os.cpu_count() or 1,
+        step=1
+    )
     pp_col, prol_col, cont_col = columns = st.beta_columns(3)
     abst_params_list = (abst_pp_params, abst_prol_params, abst_cont_params)
     abst_var_name_options = ("Infer automatically", "Specify custom variable names")
@@ -633,16 +634,12 @@ def _load_cal_elements():
             )
             lapse_text = col.text_input(
                 "4. Specify lapse definitions. Enter your options and separate them "
-                "by commas. When lapses are not allowed, its definition is False. For all definitions, "
-                "please enclose each of them within single quotes. "
-                "Example: 'False', '5 cigs', '5 cigs/14 days'. "
+                "by commas. When lapses are not allowed, its definition is False. The definitions may be "
+                "enclosed within single quotes. "
+                "Example: False, '5 cigs', '2 days', '5 cigs/14 days'. "
                 "See GitHub page for more details."
             )
-            definitions = eval(f"[{lapse_text}]")
-            for i, definition in enumerate(definitions):
-                if definition.lower() == "false":
-                    definitions[i] = False
-            abst_params["lapse_definitions"] = definitions
+            abst_params["lapse_definitions"] = parse_lapse_definitions(lapse_text)
             abst_params["grace_period"] = col.slider(
                 "5. Specify the grace period in days (default: 14 days)",
                 value=14,
@@ -656,59 +653,143 @@ def _load_cal_elements():
                 visit_data_params['expected_visits']
             )
 
+    # The results of the last calculation stay with the session, so the later reruns show them without the button
+    abstinence_job = job_manager.get(get_report_ctx().session_id, "abstinence")
     if st.button("Get Abstinence Results"):
-        _calculate_abstinence()
+        _calculate_abstinence(context)
+    elif abstinence_job is not None:
+        _load_abstinence_results(abstinence_job)
 
 
-def _calculate_abstinence():
-    st.header("Calculation Summary")
-    if session_state.tlfb_data is None or session_state.visit_data is None:
+def _calculate_abstinence(context):
+    if context.tlfb_data is None or context.visit_data is None:
         raise ValueError("Please process the TLFB and Visit data first.")
-
-    calculator = ac.AbstinenceCalculator(session_state.tlfb_data, session_state.visit_data)
-    calculation_results = list()
-    if abst_pp_params["visits"]:
-        calculation_results.append(calculator.abstinence_pp(
-            abst_pp_params["visits"],
-            abst_pp_params["days"],
-            abst_pp_params["abst_var_names"],
-            abst_params_shared["including_end"],
-            abst_params_shared["mode"]
-        ))
-    if abst_prol_params["visits"]:
-        calculation_results.append(calculator.abstinence_prolonged(
-            abst_prol_params["quit_visit"],
-            abst_prol_params["visits"],
-            abst_prol_params["lapse_definitions"],
-            abst_prol_params["grace_period"],
-            abst_prol_params["abst_var_names"],
-            abst_params_shared["including_end"],
-            abst_params_shared["mode"]
-        ))
-    if abst_cont_params["visits"]:
-        calculation_results.append(calculator.abstinence_cont(
-            abst_cont_params["start_visit"],
-            abst_cont_params["visits"],
-            abst_cont_params["abst_var_names"],
-            abst_params_shared["including_end"],
-            abst_params_shared["mode"]
-        ))
-    abst_df = calculator.merge_abst_data([x[0] for x in calculation_results])
+    abst_params = (context.abst_pp_params, context.abst_prol_params, context.abst_cont_params,
+                   context.abst_params_shared)
+    # The job works on a snapshot, as the next rerun replaces the parameters of the context
+    signature = params_signature(*abst_params, {"tlfb_data": context.tlfb_key, "visit_data": context.visit_key})
+    job = _submit_job("abstinence", signature, calculate_abstinence, copy.copy(context), restart=True)
+    _load_abstinence_results(job)
+
+
+def _load_abstinence_results(job):
+    calculation_results = _wait_for_job(job, "Abstinence Calculation")
+    if calculation_results is None:
+        return
+    abst_df, lapse_df = calculation_results
+    st.header("Calculation Summary")
     st.subheader("Abstinence Data")
-    st.write(abst_df)
+    _preview_data(abst_df, "abstinence_results")
     _pop_download_link(abst_df, "abstinence_data", "Abstinence Data", True)
 
-    lapse_df = calculator.merge_lapse_data([x[1] for x in calculation_results])
     st.subheader("Lapse Data")
-    st.write(lapse_df)
+    _preview_data(lapse_df, "lapse_results")
     _pop_download_link(lapse_df, "lapse_data", "Lapse Data", False)
 
 
+def _load_diagnostics_elements(diagnostics):
+    st.header("Diagnostics")
+    with st.beta_expander("Steps of this session"):
+        st.markdown("Each step that ran since the diagnostics were turned on, with its wall time, the CPU time of the "
+                    "thread running it, the peak memory it allocated, and its rows in and out. The steps whose "
+                    "results were cached show the time of getting them from the cache.")
+        diagnostics_df = diagnostics.to_frame()
+        if diagnostics_df.empty:
+            st.write("No steps have run yet.")
+            return
+        _preview_data(diagnostics_df, "diagnostics")
+        summary = diagnostics_df.groupby(["step", "stage"], sort=False)[["wall_seconds", "cpu_seconds"]].sum()
+        st.write("Total Time of Each Step")
+        st.dataframe(summary)
+        _pop_download_link(diagnostics_df, "diagnostics", "Diagnostics", False)
+        if st.button("Clear Diagnostics"):
+            diagnostics.clear()
+
+
+def _submit_job(name, signature, func, *args, restart=False):
+    return job_manager.submit(get_report_ctx().session_id, name, signature, func, *args, restart=restart)
+
+
+def _wait_for_job(job, label):
+    """Shows the progress of the job until it finishes, with a button to cancel it.
+
+    A widget change reruns the script, which stops waiting while the job keeps running, and the rerun waits for the
+    same job again.
+
+    Returns
+    -------
+    any
+        The result of the job, or None when the job has been cancelled. The error of a failed job is raised.
+
+    """
+    if not job.done():
+        progress_bar = st.progress(job.progress)
+        status = st.empty()
+        if st.button(f"Cancel {label}", key=f"cancel_{job.name}"):
+            job.cancel()
+        while not job.wait(0.2):
+            progress_bar.progress(job.progress)
+            status.text(f"{label}: {job.stage}")
+        progress_bar.empty()
+        status.empty()
+    if job.status == CANCELLED:
+        st.warning(f"{label} has been cancelled. Press the button above to start it again.")
+        return None
+    if job.status == FAILED:
+        raise job.error
+    return job.result
+
+
+def _column_summary(df):
+    summary = pd.DataFrame({
+        "type": df.dtypes.astype(str),
+        "non-missing": df.notna().sum(),
+        "distinct": df.nunique()
+    })
+    # Only the numbers and the dates have a meaningful range, while the text columns may even hold mixed types
+    ranged_columns = [column for column in df.columns if pd.api.types.is_numeric_dtype(df[column]) or
+                      pd.api.types.is_datetime64_any_dtype(df[column])]
+    summary["min"] = df[ranged_columns].min().astype(str)
+    summary["max"] = df[ranged_columns].max().astype(str)
+    return summary
+
+
+def _preview_data(df, key, container=st, lazy_label=None):
+    """Shows the frame one page at a time, with its column summary and all its rows on request.
+
+    Only the rows of the current page are sent to the browser. With lazy_label, the frame is a lower-priority table
+    that's shown only after its checkbox is checked.
+    """
+    if lazy_label is not None and not container.checkbox(lazy_label, key=f"{key}_shown"):
+        return
+    row_count = len(df)
+    page_count = max(1, -(-row_count // preview_page_size))
+    page = 1
+    if page_count > 1:
+        page = int(container.number_input(f"Page (of {page_count})", 1, page_count, 1, key=f"{key}_page"))
+    start = (page - 1) * preview_page_size
+    end = min(start + preview_page_size, row_count)
+    if page_count > 1 and container.checkbox(f"Show all {row_count} rows", key=f"{key}_all"):
+        container.dataframe(df)
+    else:
+        container.dataframe(df.iloc[start:end])
+        container.text(f"Rows {start + 1 if row_count else 0}-{end} of {row_count}")
+    if container.checkbox("Show the column summary", key=f"{key}_columns"):
+        container.dataframe(_column_summary(df))
+
+
 def _pop_download_link(df, filename, link_name, kept_index):
-    csv_file = df.to_csv(index=kept_index)
-    b64 = base64.b64encode(csv_file.encode()).decode()
-    href = f'<a href="data:file/csv;base64,{b64}" download="{filename}.csv">Download {link_name}</a>'
-    st.markdown(href, unsafe_allow_html=True)
+    # Without the download route, the CSV file is embedded in the link, as it was before the route
+    if not register_route():
+        b64 = base64.b64encode(df.to_csv(index=kept_index).encode()).decode()
+        href = f'<a href="data:file/csv;base64,{b64}" download="{filename}.csv">Download {link_name}</a>'
+        st.markdown(href, unsafe_allow_html=True)
+        return
+    # The file is generated by the server only when a link is followed, so the page only holds the links
+    token = download_registry.register(get_report_ctx().session_id, df, filename, kept_index)
+    links = " | ".join(f'<a href="{download_url(token, file_format)}" download>{file_format.upper()}</a>'
+                       for file_format in download_formats)
+    st.markdown(f"Download {link_name}: {links}", unsafe_allow_html=True)
 
 
 def _max_width_(width):
@@ -720,4 +801,8 @@ def _max_width_(width):
 
 if __name__ == "__main__":
     _max_width_(1200)
-    _load_elements()
+    register_route()
+    # The session is held while the script runs, so the changes of the run are never lost to a spill
+    with session_store.hold(get_report_ctx().session_id, context=PipelineContext()) as session_state:
+        session_state.context.new_run()
+        _load_elements(session_state.context)
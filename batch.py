@@ -0,0 +1,259 @@
+"""Runs the abstinence calculation pipeline without Streamlit.
+
+Each study is described by a JSON config with the same options as the web app, for example:
+
+    {
+        "name": "study_a",
+        "output_dir": "results",
+        "tlfb": {"path": "tlfb.csv", "cutoff": 0, "imputation_mode": "linear"},
+        "bio": {"path": "co.csv", "cutoff": 4, "overridden_amount": 1},
+        "visit": {"path": "visits.csv", "data_format": "long", "anchor_visit": 0},
+        "abstinence": {
+            "mode": "itt",
+            "including_end": false,
+            "workers": 1,
+            "pp": {"visits": [2, 3], "days": [7, 14]},
+            "prolonged": {"quit_visit": 1, "visits": [3], "lapse_definitions": [false, "5 cigs"]},
+            "continuous": {"start_visit": 1, "visits": [2, 3]}
+        }
+    }
+
+A config file may hold one study, a list of studies, or an object with a "studies" list.
+
+For cohorts that don't fit in memory, "chunk_size" sets the number of subjects processed at a time. The TLFB and
+biochemical files are then partitioned by subject in a temporary directory, which "work_dir" may point to, and the
+results are appended to the output files after each chunk.
+
+A "sweep" object runs the calculation for every combination of the listed parameter values, for example
+{"tlfb_cutoff": [0, 1], "grace_period": [7, 14], "mode": ["itt", "ro"]}, and writes the tagged results in the long
+format. The abstinence "workers" then calculate the combinations in parallel.
+
+The TLFB and biochemical rows of the subjects without visit data are dropped as the files are read, unless
+"reconcile_subjects" is false.
+
+Usage: python batch.py study_a.json study_b.json --workers 4
+"""
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from chunked import calculate_chunked
+from ingestion import parse_file, reconcile_subjects
+from pipeline import PipelineContext, calculate_abstinence, process_tlfb_data, process_visit_data
+from sweep import run_sweep
+
+# The defaults are the same as the initial values of the web app's widgets
+tlfb_defaults = {
+    "cutoff": 0.0,
+    "subjects": "all",
+    "duplicate_mode": "mean",
+    "imputation_mode": "linear",
+    "imputation_last_record": "ffill",
+    "imputation_gap_limit": None,
+    "outliers_mode": None,
+    "allowed_min": 0.0,
+    "allowed_max": 100.0
+}
+bio_defaults = {
+    "cutoff": 0.0,
+    "overridden_amount": None,
+    "enable_interpolation": False,
+    "half_life": 1,
+    "days_interpolation": 1
+}
+visit_defaults = {
+    "data_format": "long",
+    "expected_visits": None,
+    "subjects": "all",
+    "duplicate_mode": "mean",
+    "imputation_mode": "freq",
+    "anchor_visit": None,
+    "outliers_mode": None,
+    "allowed_min": None,
+    "allowed_max": None
+}
+abst_defaults = {
+    "mode": "itt",
+    "including_end": False,
+    "workers": 1
+}
+abst_pp_defaults = {"visits": list(), "days": list(), "abst_var_names": "infer"}
+abst_prol_defaults = {"visits": list(), "quit_visit": None, "lapse_definitions": [False], "grace_period": 14,
+                      "abst_var_names": "infer"}
+abst_cont_defaults = {"visits": list(), "start_visit": None, "abst_var_names": "infer"}
+
+
+# The keys of a data config that locate its data rather than set its parameters
+_source_keys = ("path", "content", "records")
+
+
+def _update_params(params, defaults, config):
+    params.update(defaults)
+    params.update({key: value for key, value in config.items() if key not in _source_keys})
+
+
+def _load_path(data_config, kind, data_format=None, subjects=None):
+    return parse_file(data_config["path"], kind, data_format, subjects)
+
+
+def update_abst_params(context, abst_config):
+    """Sets the abstinence parameters of the context from the "abstinence" object of a study config."""
+    _update_params(context.abst_params_shared, abst_defaults,
+                   {key: value for key, value in abst_config.items() if key in abst_defaults})
+    _update_params(context.abst_pp_params, abst_pp_defaults, abst_config.get("pp", dict()))
+    _update_params(context.abst_prol_params, abst_prol_defaults, abst_config.get("prolonged", dict()))
+    _update_params(context.abst_cont_params, abst_cont_defaults, abst_config.get("continuous", dict()))
+
+
+def build_context(config, load_tlfb=True, load=_load_path):
+    """Creates the pipeline context of a study config, loading its data files.
+
+    The TLFB and biochemical files are left unread without load_tlfb, for the chunked mode to stream them. load gets
+    the ParsedUpload of a data config with its kind and data format, by default reading the file at its "path", and
+    it may drop the rows of the subjects other than those passed to it.
+
+    Unless the config sets "reconcile_subjects" to false, the TLFB and biochemical data are reduced to the selected
+    subjects of the visit data as they're read, since the abstinence of the other subjects isn't calculated.
+    """
+    context = PipelineContext()
+    visit_config = config["visit"]
+    visit_data_params = context.visit_data_params
+    _update_params(visit_data_params, visit_defaults, visit_config)
+    parsed_file = load(visit_config, "visit", visit_data_params["data_format"])
+    visit_data_params.update(data=parsed_file.data, data_digest=parsed_file.digest)
+    if visit_data_params["expected_visits"] is None:
+        visit_data_params["expected_visits"] = parsed_file.visits
+    if visit_data_params["anchor_visit"] is None:
+        visit_data_params["anchor_visit"] = visit_data_params["expected_visits"][0]
+
+    tlfb_config = config["tlfb"]
+    tlfb_data_params = context.tlfb_data_params
+    _update_params(tlfb_data_params, tlfb_defaults, tlfb_config)
+    subjects = None
+    if config.get("reconcile_subjects", True):
+        # The TLFB subjects aren't known before the file is read, so only the visit data decide what's kept
+        subjects = reconcile_subjects(parsed_file.subjects, parsed_file.subjects, tlfb_data_params["subjects"],
+                                      visit_data_params["subjects"]).subjects
+        tlfb_data_params["subjects"] = subjects
+    if load_tlfb:
+        parsed_file = load(tlfb_config, "tlfb", subjects=subjects)
+        tlfb_data_params.update(data=parsed_file.data, data_digest=parsed_file.digest)
+
+    bio_config = config.get("bio")
+    if bio_config:
+        _update_params(context.bio_data_params, bio_defaults, bio_config)
+        if context.bio_data_params["overridden_amount"] is None:
+            context.bio_data_params["overridden_amount"] = tlfb_data_params["cutoff"] + 1
+        if load_tlfb:
+            parsed_file = load(bio_config, "bio", subjects=subjects)
+            context.bio_data_params.update(data=parsed_file.data, data_digest=parsed_file.digest)
+
+    update_abst_params(context, config.get("abstinence", dict()))
+    return context
+
+
+def run_study(config):
+    """Processes the TLFB and visit data of a study, calculates its abstinence and writes the results.
+
+    Returns
+    -------
+    tuple
+        The paths of the abstinence data file and the lapse data file.
+
+    """
+    output_dir = config.get("output_dir", ".")
+    os.makedirs(output_dir, exist_ok=True)
+    abst_path = os.path.join(output_dir, f"{config['name']}_abstinence_data.csv")
+    lapse_path = os.path.join(output_dir, f"{config['name']}_lapse_data.csv")
+
+    chunk_size = config.get("chunk_size")
+    sweep_grid = config.get("sweep")
+    if chunk_size and sweep_grid:
+        raise ValueError("A study can't be both chunked and swept.")
+    context = build_context(config, load_tlfb=not chunk_size)
+    visit_results = process_visit_data(context.visit_data_params)
+    context.visit_data = visit_results["impute"].data
+    context.visit_index = visit_results["dates"].output
+    context.visit_key = visit_results["impute"].key
+    if chunk_size:
+        bio_path = config["bio"]["path"] if config.get("bio") else None
+        calculate_chunked(context, config["tlfb"]["path"], bio_path, abst_path, lapse_path, chunk_size,
+                          work_dir=config.get("work_dir"))
+        return abst_path, lapse_path
+    if sweep_grid:
+        abst_path = os.path.join(output_dir, f"{config['name']}_sweep_abstinence_data.csv")
+        lapse_path = os.path.join(output_dir, f"{config['name']}_sweep_lapse_data.csv")
+        if config.get("bio") and "overridden_amount" not in config["bio"]:
+            # The overriding amount follows each swept TLFB cutoff, rather than the study's cutoff
+            context.bio_data_params["overridden_amount"] = "infer"
+        abst_df, lapse_df = run_sweep(context, sweep_grid, context.abst_params_shared["workers"] or 1)
+        abst_df.to_csv(abst_path, index=False)
+        lapse_df.to_csv(lapse_path, index=False)
+        return abst_path, lapse_path
+
+    stage_results = process_tlfb_data(context.tlfb_data_params, context.bio_data_params)
+    context.tlfb_data = stage_results["impute"].data
+    context.tlfb_index = stage_results["index"].output
+    context.tlfb_key = stage_results["impute"].key
+    abst_df, lapse_df = calculate_abstinence(context)
+    abst_df.to_csv(abst_path, index=True)
+    lapse_df.to_csv(lapse_path, index=False)
+    return abst_path, lapse_path
+
+
+def run_batch(configs, workers=None):
+    """Runs the studies in a process pool.
+
+    Returns
+    -------
+    dict
+        The output paths of each study by its name, or the error if the study has failed.
+
+    """
+    results = dict()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(run_study, config): config["name"] for config in configs}
+        for future in as_completed(futures):
+            try:
+                results[futures[future]] = future.result()
+            except Exception as e:
+                results[futures[future]] = e
+    return results
+
+
+def load_configs(paths):
+    configs = list()
+    for path in paths:
+        with open(path) as file:
+            config = json.load(file)
+        if isinstance(config, dict):
+            config = config.get("studies", [config])
+        for study in config:
+            study.setdefault("name", os.path.splitext(os.path.basename(path))[0])
+        configs.extend(config)
+    names = [x["name"] for x in configs]
+    if len(names) != len(set(names)):
+        raise ValueError("Each study should have a unique name.")
+    return configs
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Calculate abstinence for the studies in the config files.")
+    parser.add_argument("configs", nargs="+", help="The JSON config files of the studies")
+    parser.add_argument("--workers", type=int, default=None, help="The number of worker processes")
+    args = parser.parse_args(args)
+
+    results = run_batch(load_configs(args.configs), args.workers)
+    failed = False
+    for name, result in sorted(results.items()):
+        if isinstance(result, Exception):
+            failed = True
+            print(f"{name}: failed ({result})", file=sys.stderr)
+        else:
+            print(f"{name}: {', '.join(result)}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
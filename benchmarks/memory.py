@@ -0,0 +1,79 @@
+"""Compares the memory held by a session's TLFB data with and without the compact encoding.
+
+The session holds the parsed uploads, which the upload cache shares with it, the cached stage results of the TLFB
+and biochemical graphs, whose final ones the session context shares by reference, and the usage index. The baseline
+layout is the one before the compact encoding, where the uploads and every cached stage result are decoded frames.
+The stages run on an empty memory cache and a temporary disk cache, so every stage is computed and held in memory the
+way it is in a new session.
+
+Usage: python -m benchmarks.memory --subjects 2000 --days 180
+"""
+import argparse
+import tempfile
+import pipeline
+from benchmarks.bio_interpolation import make_data
+from compact import CompactData, CompactFrame
+from disk_cache import DiskCache
+from ingestion import parse_data
+
+
+def _frame_nbytes(df):
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+
+def _upload(df, kind):
+    # Uploads usually have text ids and dates, which is how they're read from the files
+    df = df.assign(id="S" + df["id"].astype(str), date=df["date"].dt.strftime("%m/%d/%Y"))
+    return parse_data(df.to_csv(index=False).encode(), kind)
+
+
+def _report(label, baseline_bytes, compact_bytes):
+    print(f"{label}: baseline {baseline_bytes / 2 ** 20:.1f} MB, compact {compact_bytes / 2 ** 20:.1f} MB "
+          f"({baseline_bytes / compact_bytes:.1f}x)")
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--subjects", type=int, default=2000)
+    parser.add_argument("--days", type=int, default=180)
+    args = parser.parse_args(args)
+
+    tlfb_df, bio_df = make_data(args.subjects, args.days)
+    tlfb_upload, bio_upload = _upload(tlfb_df, "tlfb"), _upload(bio_df, "bio")
+    # The upload cache holds the uploads in the compact encoding, which the session's parameters refer to
+    tlfb_frame, bio_frame = CompactFrame(tlfb_upload.data), CompactFrame(bio_upload.data)
+    tlfb_params = dict.fromkeys(pipeline.tlfb_param_keys)
+    tlfb_params.update({"data": tlfb_frame, "data_digest": tlfb_upload.digest, "cutoff": 0.0,
+                        "subjects": "all", "duplicate_mode": "mean", "imputation_mode": "linear",
+                        "imputation_last_record": "ffill", "outliers_mode": False, "allowed_min": 0.0,
+                        "allowed_max": 5.0})
+    bio_params = dict.fromkeys(pipeline.bio_param_keys)
+    bio_params.update({"data": bio_frame, "data_digest": bio_upload.digest, "cutoff": 4.0,
+                       "duplicate_mode": "mean", "enable_interpolation": True, "half_life": 0.25,
+                       "days_interpolation": 3, "overridden_amount": "infer"})
+
+    with tempfile.TemporaryDirectory() as directory:
+        pipeline.disk_cache = DiskCache(directory)
+        pipeline.stage_cache.clear()
+        pipeline.process_tlfb_data(tlfb_params, bio_params)
+        # Every stage result of the session is in the memory cache, the final ones shared with the session context
+        cached_results = list(pipeline.stage_cache._entries.values())
+
+    baseline_stages, compact_stages, baseline_total, compact_total = 0, 0, 0, 0
+    for result in cached_results:
+        if isinstance(result.data, CompactData):
+            baseline_bytes = _frame_nbytes(result.data.restore().data)
+            baseline_stages += baseline_bytes
+            compact_stages += result.nbytes
+        else:
+            baseline_bytes = result.nbytes
+        baseline_total += baseline_bytes
+        compact_total += result.nbytes
+    _report("Uploads", tlfb_upload.nbytes + bio_upload.nbytes, tlfb_frame.nbytes + bio_frame.nbytes)
+    _report("Processed stages", baseline_stages, compact_stages)
+    _report("Session", tlfb_upload.nbytes + bio_upload.nbytes + baseline_total,
+            tlfb_frame.nbytes + bio_frame.nbytes + compact_total)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+"""Times and memory-profiles each stage of the pipeline on synthetic trials of several sizes.
+
+Every stage runs uncached, from parsing the uploaded files to exporting the results. The times are the best of the
+repeated runs, and the peak memory is what the stage allocates on top of its inputs, measured in a separate run with
+tracemalloc because tracing slows the stages down. The results are written as JSON for comparing the runs.
+
+Usage: python -m benchmarks.pipeline_stages --subjects 100 1000 5000 --output stages.json --compare baseline.json
+"""
+import argparse
+import datetime
+import io
+import json
+import platform
+import sys
+import time
+import tracemalloc
+import abstcal as ac
+import numpy as np
+import pandas as pd
+import pipeline
+from benchmarks.synthetic import make_trial_data
+from ingestion import read_data
+from lapse_rules import abstinence_cont, abstinence_pp, abstinence_prolonged
+
+# The parameters of the processing, the same as the defaults of the app except for the enabled options
+tlfb_params = {
+    "cutoff": 0.0,
+    "subjects": "all",
+    "duplicate_mode": "mean",
+    "imputation_mode": "linear",
+    "imputation_last_record": "ffill",
+    "imputation_gap_limit": None,
+    "outliers_mode": False,
+    "allowed_min": 0.0,
+    "allowed_max": 100.0,
+    "overridden_amount": "infer"
+}
+bio_params = {"cutoff": 4.0, "enable_interpolation": True, "half_life": 0.25, "days_interpolation": 3}
+visit_params = {"expected_visits": "infer", "subjects": "all", "duplicate_mode": "mean", "imputation_mode": "freq",
+                "outliers_mode": None, "allowed_min": None, "allowed_max": None}
+
+
+def _row_count(value):
+    if isinstance(value, pd.DataFrame):
+        return len(value)
+    if isinstance(getattr(value, "data", None), pd.DataFrame):
+        return len(value.data)
+    if isinstance(value, tuple) and value:
+        # The stages return their data with an output, and the abstinence families their abstinence and lapse data
+        return _row_count(value[0])
+    return None
+
+
+class StageRecorder(object):
+    def __init__(self, trace_memory):
+        """Runs the stages one at a time, recording the wall time, the CPU time, the peak memory and the row counts."""
+        self.trace_memory = trace_memory
+        self.records = list()
+
+    def run(self, name, func, *args):
+        if self.trace_memory:
+            # Restarting the tracing resets its peak, which counts only the memory allocated by the stage
+            tracemalloc.stop()
+            tracemalloc.start()
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        result = func(*args)
+        wall_seconds, cpu_seconds = time.perf_counter() - wall_start, time.process_time() - cpu_start
+        peak_bytes = tracemalloc.get_traced_memory()[1] if self.trace_memory else None
+        self.records.append({
+            "stage": name,
+            "seconds": wall_seconds,
+            "cpu_seconds": cpu_seconds,
+            "peak_bytes": peak_bytes,
+            "rows_in": _row_count(args[0]) if args else None,
+            "rows_out": _row_count(result)
+        })
+        return result
+
+
+def _run_stages(recorder, prefix, stages, source, params):
+    # Without the cache, the mutating stages work in place, which is fine as each stage is run once in order
+    results = dict()
+    for stage in stages:
+        upstream = source if stage.upstream is None else results[stage.upstream]
+        stage_params = {key: params.get(key) for key in stage.param_keys}
+        results[stage.name] = recorder.run(f"{prefix}.{stage.name}", lambda x: stage.func(x, stage_params),
+                                           upstream)[0]
+    return results
+
+
+def _export_csv(abst_df, lapse_df):
+    buffer = io.StringIO()
+    abst_df.to_csv(buffer)
+    lapse_df.to_csv(buffer, index=False)
+    return buffer.getvalue()
+
+
+def run_pipeline(files, recorder, abst_params):
+    """Runs every stage on the files, the CSV contents of a synthetic trial, recording each of them."""
+    tlfb_df = recorder.run("parse.tlfb", read_data, files["tlfb"], "tlfb")
+    bio_df = recorder.run("parse.bio", read_data, files["bio"], "bio")
+    visit_long_df = recorder.run("parse.visit_long", read_data, files["visits_long"], "visit", "long")
+    visit_wide_df = recorder.run("parse.visit_wide", read_data, files["visits_wide"], "visit", "wide")
+
+    bio_results = _run_stages(recorder, "bio", pipeline.bio_stages, bio_df, pipeline._stage_params(bio_params))
+    params = pipeline._stage_params(tlfb_params)
+    params["bio_data"] = pipeline.StageResult(None, bio_results["duplicates"], None, 0)
+    tlfb_data = _run_stages(recorder, "tlfb", pipeline.tlfb_stages, tlfb_df, params)["impute"]
+    visit_data = None
+    for data_format, visit_df in (("long", visit_long_df), ("wide", visit_wide_df)):
+        format_params = dict(visit_params, data_format=data_format)
+        # The visit names of the wide format are its column names, which are read as text
+        format_params["anchor_visit"] = sorted(visit_df["visit"].unique())[0] if data_format == "long" \
+            else visit_df.columns[1]
+        results = _run_stages(recorder, f"visit_{data_format}", pipeline.visit_stages, visit_df,
+                              pipeline._stage_params(format_params))
+        visit_data = results["impute"] if data_format == "long" else visit_data
+
+    pp_params, prol_params, cont_params, shared_params = abst_params
+    calculator = ac.AbstinenceCalculator(tlfb_data, visit_data)
+    pp_results = recorder.run("abstinence.pp", lambda: abstinence_pp(
+        tlfb_data, visit_data, pp_params["visits"], pp_params["days"], "infer", shared_params["including_end"],
+        shared_params["mode"]))
+    prol_results = recorder.run("abstinence.prolonged", lambda: abstinence_prolonged(
+        tlfb_data, visit_data, prol_params["quit_visit"], prol_params["visits"], prol_params["lapse_definitions"],
+        prol_params["grace_period"], "infer", shared_params["including_end"], shared_params["mode"]))
+    cont_results = recorder.run("abstinence.continuous", lambda: abstinence_cont(
+        tlfb_data, visit_data, cont_params["start_visit"], cont_params["visits"], "infer",
+        shared_params["including_end"], shared_params["mode"]))
+    calculation_results = (pp_results, prol_results, cont_results)
+    abst_df, lapse_df = recorder.run("abstinence.merge", lambda: (
+        calculator.merge_abst_data([x[0] for x in calculation_results]),
+        calculator.merge_lapse_data([x[1] for x in calculation_results])))
+    recorder.run("export.csv", _export_csv, abst_df, lapse_df)
+
+
+def benchmark(subject_count, follow_up_days, visit_count, repeat, seed):
+    """Benchmarks the stages on a synthetic trial of the size.
+
+    Returns
+    -------
+    list
+        The records of the stages, with the best times of the repeated runs and the peak memory of the traced run.
+
+    """
+    trial_data = make_trial_data(subject_count, follow_up_days, visit_count, seed=seed)
+    files = {name: df.to_csv(index=False).encode() for name, df in trial_data._asdict().items()}
+    last_visit = visit_count - 1
+    abst_params = (
+        {"visits": list(range(2, visit_count)), "days": [7, 30]},
+        {"quit_visit": 1, "visits": [last_visit], "lapse_definitions": [False, "5 cigs", "5 cigs/7 days", "3 days"],
+         "grace_period": 14},
+        {"start_visit": 1, "visits": [last_visit]},
+        {"including_end": False, "mode": "itt"}
+    )
+
+    timed_runs = list()
+    for _ in range(repeat):
+        recorder = StageRecorder(False)
+        run_pipeline(files, recorder, abst_params)
+        timed_runs.append(recorder.records)
+    traced_recorder = StageRecorder(True)
+    tracemalloc.start()
+    try:
+        run_pipeline(files, traced_recorder, abst_params)
+    finally:
+        tracemalloc.stop()
+
+    records = list()
+    for i, traced_record in enumerate(traced_recorder.records):
+        record = dict(timed_runs[0][i], subjects=subject_count, days=follow_up_days)
+        record["seconds"] = min(x[i]["seconds"] for x in timed_runs)
+        record["cpu_seconds"] = min(x[i]["cpu_seconds"] for x in timed_runs)
+        record["peak_bytes"] = traced_record["peak_bytes"]
+        records.append(record)
+    return records
+
+
+def _print_records(records, baseline_records=None):
+    baseline = {(x["subjects"], x["stage"]): x for x in baseline_records or list()}
+    print(f"{'subjects':>8} {'stage':<26} {'seconds':>9} {'cpu':>9} {'peak MB':>9} {'rows in':>9} {'rows out':>9}"
+          + (f" {'vs base':>8}" if baseline else ""))
+    for record in records:
+        line = f"{record['subjects']:>8} {record['stage']:<26} {record['seconds']:>9.4f} " \
+               f"{record['cpu_seconds']:>9.4f} {record['peak_bytes'] / 2 ** 20:>9.1f} " \
+               f"{record['rows_in'] if record['rows_in'] is not None else '':>9} " \
+               f"{record['rows_out'] if record['rows_out'] is not None else '':>9}"
+        baseline_record = baseline.get((record["subjects"], record["stage"]))
+        if baseline_record is not None and baseline_record["seconds"] > 0:
+            line += f" {record['seconds'] / baseline_record['seconds']:>7.2f}x"
+        print(line)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--subjects", type=int, nargs="+", default=[100, 1000])
+    parser.add_argument("--days", type=int, default=180)
+    parser.add_argument("--visits", type=int, default=5)
+    parser.add_argument("--repeat", type=int, default=3, help="The number of the timed runs of each size")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="The JSON file of the results")
+    parser.add_argument("--compare", help="The JSON file of an earlier run, whose times are compared")
+    args = parser.parse_args(args)
+
+    records = list()
+    for subject_count in args.subjects:
+        records.extend(benchmark(subject_count, args.days, args.visits, args.repeat, args.seed))
+    baseline_records = None
+    if args.compare:
+        with open(args.compare) as file:
+            baseline_records = json.load(file)["results"]
+    _print_records(records, baseline_records)
+
+    if args.output:
+        results = {
+            "meta": {
+                "created": datetime.datetime.now().isoformat(timespec="seconds"),
+                "python": sys.version.split()[0],
+                "platform": platform.platform(),
+                "numpy": np.__version__,
+                "pandas": pd.__version__,
+                "abstcal": ac.__version__,
+                "days": args.days,
+                "visits": args.visits,
+                "repeat": args.repeat,
+                "seed": args.seed
+            },
+            "results": records
+        }
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""Generates synthetic smoking cessation trials with the TLFB, biochemical and visit data of the app's uploads.
+
+Usage: python -m benchmarks.synthetic --subjects 1000 --days 180 --output-dir synthetic_data
+"""
+import argparse
+import os
+from collections import namedtuple
+import numpy as np
+import pandas as pd
+
+TrialData = namedtuple("TrialData", ["tlfb", "bio", "visits_long", "visits_wide"])
+
+# The days of self-report before the baseline visit, as recalled at the baseline
+_RECALL_DAYS = 30
+
+
+def make_trial_data(subject_count, follow_up_days=180, visit_count=5, missing_rate=0.05, duplicate_rate=0.01,
+                    outlier_rate=0.002, seed=0):
+    """Generates the data of a trial in which the subjects quit at the second visit, some of them relapsing later.
+
+    The subjects enroll over a year and smoke at their own rates before quitting. After the quit visit, some stay
+    abstinent with occasional lapses and the others relapse after an exponentially distributed delay. The biochemical
+    measures (CO in ppm) are taken at the visits and follow the smoking of the preceding days.
+
+    Parameters
+    ----------
+    subject_count : int
+        The number of subjects.
+    follow_up_days : int
+        The days from the baseline visit to the last visit, over which the visits are spread evenly.
+    visit_count : int
+        The number of visits, at least two. Visit 0 is the baseline and visit 1 is the quit visit.
+    missing_rate : float
+        The fraction of the TLFB records and of the visits after the baseline that are missing.
+    duplicate_rate : float
+        The fraction of the TLFB records that are reported twice with different amounts.
+    outlier_rate : float
+        The fraction of the TLFB records with implausibly large amounts.
+    seed : int
+        The seed of the random generator, so the same arguments always generate the same data.
+
+    Returns
+    -------
+    TrialData
+        The TLFB and biochemical data, and the visit data in the long and the wide formats.
+
+    """
+    if visit_count < 2:
+        raise ValueError("The trial should have at least the baseline and the quit visits.")
+    rng = np.random.default_rng(seed)
+    ids = np.arange(1000, 1000 + subject_count)
+    enrollment_dates = np.datetime64("2020-01-01") + rng.integers(0, 365, subject_count).astype("timedelta64[D]")
+
+    visit_days = np.linspace(0, follow_up_days, visit_count).round().astype(int)
+    visit_offsets = np.tile(visit_days, (subject_count, 1))
+    visit_offsets[:, 1:] += rng.integers(-3, 4, (subject_count, visit_count - 1))
+    visit_offsets[:, 1:] = np.maximum(visit_offsets[:, 1:], 1)
+    visit_kept = rng.random((subject_count, visit_count)) >= missing_rate
+    visit_kept[:, 0] = True
+
+    # The days run from the start of the recall period to the last visit, one row per subject
+    days = np.arange(-_RECALL_DAYS, follow_up_days + 1)
+    usual_rates = rng.gamma(4.0, 3.0, subject_count)
+    quit_days = visit_offsets[:, 1]
+    relapse_days = np.where(rng.random(subject_count) < 0.3, np.iinfo(np.int64).max,
+                            quit_days + rng.exponential(30.0, subject_count).astype(int) + 1)
+    before_quit = days[None, :] < quit_days[:, None]
+    relapsed = days[None, :] >= relapse_days[:, None]
+    lapses = rng.random(before_quit.shape) < 0.03
+    amounts = np.where(before_quit, rng.poisson(usual_rates[:, None], before_quit.shape),
+                       np.where(relapsed, rng.poisson(0.7 * usual_rates[:, None], before_quit.shape),
+                                np.where(lapses, rng.poisson(2.0, before_quit.shape) + 1, 0))).astype(float)
+
+    # The CO level follows the average smoking of the three days before the visit
+    rows = np.arange(subject_count)[:, None]
+    recent = np.stack([amounts[rows, np.clip(visit_offsets[:, i, None] + _RECALL_DAYS - np.arange(1, 4), 0,
+                                             len(days) - 1)].mean(axis=1) for i in range(visit_count)], axis=1)
+    co_levels = (2.0 + 1.2 * recent + rng.gamma(2.0, 0.8, recent.shape)).round(1)
+
+    tlfb_df = pd.DataFrame({
+        "id": np.repeat(ids, len(days)),
+        "date": (np.repeat(enrollment_dates, len(days)) + np.tile(days, subject_count).astype("timedelta64[D]")),
+        "amount": amounts.ravel()
+    })
+    tlfb_df = tlfb_df.loc[rng.random(len(tlfb_df)) >= missing_rate, :]
+    outliers = rng.random(len(tlfb_df)) < outlier_rate
+    tlfb_df.loc[outliers, "amount"] = rng.integers(150, 500, int(outliers.sum())).astype(float)
+    duplicates = tlfb_df.loc[rng.random(len(tlfb_df)) < duplicate_rate, :].copy()
+    duplicates["amount"] += rng.integers(1, 4, len(duplicates))
+    tlfb_df = pd.concat([tlfb_df, duplicates]).sort_values(by=["id", "date"], kind="mergesort", ignore_index=True)
+
+    visit_dates = enrollment_dates[:, None] + visit_offsets.astype("timedelta64[D]")
+    visits_long = pd.DataFrame({
+        "id": np.repeat(ids, visit_count),
+        "visit": np.tile(np.arange(visit_count), subject_count),
+        "date": visit_dates.ravel()
+    })
+    bio_df = visits_long.assign(amount=co_levels.ravel()).loc[visit_kept.ravel(), ["id", "date", "amount"]].\
+        reset_index(drop=True)
+    visits_long = visits_long.loc[visit_kept.ravel(), :].reset_index(drop=True)
+    visits_wide = visits_long.pivot(index="id", columns="visit", values="date").reset_index()
+    visits_wide.columns.name = None
+    return TrialData(tlfb_df, bio_df, visits_long, visits_wide)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--subjects", type=int, default=1000)
+    parser.add_argument("--days", type=int, default=180)
+    parser.add_argument("--visits", type=int, default=5)
+    parser.add_argument("--missing-rate", type=float, default=0.05)
+    parser.add_argument("--duplicate-rate", type=float, default=0.01)
+    parser.add_argument("--outlier-rate", type=float, default=0.002)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output-dir", default="synthetic_data")
+    args = parser.parse_args(args)
+
+    trial_data = make_trial_data(args.subjects, args.days, args.visits, args.missing_rate, args.duplicate_rate,
+                                 args.outlier_rate, args.seed)
+    os.makedirs(args.output_dir, exist_ok=True)
+    for name, df in trial_data._asdict().items():
+        path = os.path.join(args.output_dir, f"{name}.csv")
+        df.to_csv(path, index=False)
+        print(f"{path}: {len(df)} rows")
+
+
+if __name__ == "__main__":
+    main()
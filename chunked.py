@@ -0,0 +1,156 @@
+import copy
+import os
+import pickle
+import shutil
+import tempfile
+import pandas as pd
+from ingestion import iter_file
+from compact import decode
+from pipeline import calculate_abstinence, process_tlfb_chunk
+
+
+class SubjectPartitions(object):
+    def __init__(self, directory, subject_ids, chunk_size):
+        """Partitions data by subject into chunk files on disk.
+
+        The sorted subject ids are split into contiguous chunks of chunk_size subjects. The rows appended to the
+        partitions are split by their chunk and written as separate part files, so appending never reads the earlier
+        rows back into memory.
+
+        Parameters
+        ----------
+        directory : str
+            The directory of the part files, which is created if needed.
+        subject_ids : list
+            The ids of the subjects to keep. The rows of the other subjects are dropped.
+        chunk_size : int
+            The number of subjects in each chunk.
+
+        """
+        self.directory = directory
+        self.chunks = [subject_ids[i:i + chunk_size] for i in range(0, len(subject_ids), chunk_size)]
+        self._chunk_numbers = pd.Series(
+            [i for i, chunk in enumerate(self.chunks) for _ in chunk], index=pd.Index(subject_ids), dtype=int)
+        self._part_counts = [0] * len(self.chunks)
+        os.makedirs(directory, exist_ok=True)
+
+    def _part_path(self, chunk_number, part_number):
+        return os.path.join(self.directory, f"{chunk_number:06d}_{part_number:06d}.pkl")
+
+    def append(self, df):
+        chunk_numbers = self._chunk_numbers.reindex(df["id"].values).values
+        kept = pd.notna(chunk_numbers)
+        for chunk_number, chunk_df in df.loc[kept, :].groupby(chunk_numbers[kept].astype(int), sort=False):
+            with open(self._part_path(chunk_number, self._part_counts[chunk_number]), "wb") as file:
+                pickle.dump(chunk_df, file, protocol=pickle.HIGHEST_PROTOCOL)
+            self._part_counts[chunk_number] += 1
+
+    def load(self, chunk_number):
+        """Reads the rows of the chunk in the order they were appended, or None when the chunk has no rows."""
+        frames = list()
+        for part_number in range(self._part_counts[chunk_number]):
+            with open(self._part_path(chunk_number, part_number), "rb") as file:
+                frames.append(pickle.load(file))
+        if not frames:
+            return None
+        return pd.concat(frames, ignore_index=True)
+
+
+def _partition_file(path, directory, subject_ids, chunk_size, kind, chunk_rows):
+    partitions = SubjectPartitions(directory, subject_ids, chunk_size)
+    for df in iter_file(path, kind, chunk_rows=chunk_rows):
+        partitions.append(df)
+    return partitions
+
+
+def _append_csv(df, path, index):
+    # Every chunk has the same columns, so the header is written with the first chunk that has any rows
+    if df.empty:
+        return
+    header = os.path.getsize(path) == 0
+    df.to_csv(path, mode="a", header=header, index=index)
+
+
+def calculate_chunked(context, tlfb_path, bio_path, abst_path, lapse_path, chunk_size=1000, chunk_rows=100000,
+                      work_dir=None):
+    """Calculates the abstinence of the cohorts that don't fit in memory, one subject chunk at a time.
+
+    The TLFB and biochemical files are streamed and partitioned by subject on disk. The drop_na, duplicates, outliers
+    and imputation stages run on one chunk of subjects at a time, and the abstinence and lapse data are appended to
+    the output files after each chunk. The visit data are processed in memory beforehand and stay in the context,
+    because they have a few rows per subject and their imputation uses the statistics of the whole cohort.
+
+    The abstinence data are the same as those of calculate_abstinence. The lapse data have the same rows, but they're
+    sorted by abstinence name, subject id and date within each chunk rather than across all the subjects.
+
+    Parameters
+    ----------
+    context : PipelineContext
+        The context with the processed visit data and the parameters. The data of the TLFB and biochemical params
+        are replaced with each chunk.
+    tlfb_path, bio_path : str
+        The paths of the TLFB and biochemical data files. The biochemical path may be None.
+    abst_path, lapse_path : str
+        The output CSV files, which are overwritten.
+    chunk_size : int
+        The number of subjects processed at a time, which bounds the peak memory.
+    chunk_rows : int
+        The number of rows read from the input files at a time.
+    work_dir : str
+        The parent directory of the temporary partition files, the system temporary directory by default.
+
+    Returns
+    -------
+    dict
+        The numbers of the chunks and the subjects, and the record counts by the imputation code.
+
+    """
+    if context.visit_data is None:
+        raise ValueError("Please process the Visit data first.")
+    if chunk_size < 1:
+        raise ValueError("The chunk size should be a positive integer.")
+
+    # The calculation only includes the subjects that have visit data, so the other TLFB rows are dropped on reading
+    subject_ids = sorted(context.visit_data.subject_ids)
+    open(abst_path, "w").close()
+    open(lapse_path, "w").close()
+    imputation_counts = dict()
+    partition_dir = tempfile.mkdtemp(prefix="abstcal_chunks_", dir=work_dir)
+    try:
+        tlfb_partitions = _partition_file(tlfb_path, os.path.join(partition_dir, "tlfb"), subject_ids,
+                                           chunk_size, "tlfb", chunk_rows)
+        bio_partitions = None
+        if bio_path is not None:
+            bio_partitions = _partition_file(bio_path, os.path.join(partition_dir, "bio"), subject_ids,
+                                             chunk_size, "bio", chunk_rows)
+
+        chunk_context = copy.copy(context)
+        chunk_context.visit_data = decode(context.visit_data)
+        for chunk_number in range(len(tlfb_partitions.chunks)):
+            tlfb_df = tlfb_partitions.load(chunk_number)
+            if tlfb_df is None:
+                continue
+            tlfb_data_params = dict(context.tlfb_data_params, data=tlfb_df, data_digest=None)
+            bio_data_params = dict(context.bio_data_params, data=None, data_digest=None)
+            if bio_partitions is not None:
+                # A chunk without biochemical data has nothing to override
+                bio_data_params["data"] = bio_partitions.load(chunk_number)
+            stage_results = process_tlfb_chunk(tlfb_data_params, bio_data_params)
+            chunk_context.tlfb_data = stage_results["impute"].data
+            chunk_context.tlfb_index = None
+
+            abst_df, lapse_df = calculate_abstinence(chunk_context)
+            _append_csv(abst_df, abst_path, True)
+            _append_csv(lapse_df, lapse_path, False)
+            impute_summary = stage_results["impute"].output
+            if impute_summary is not None:
+                for code, count in zip(impute_summary["imputation_code"], impute_summary["record_count"]):
+                    imputation_counts[code] = imputation_counts.get(code, 0) + int(count)
+    finally:
+        shutil.rmtree(partition_dir, ignore_errors=True)
+
+    return {
+        "chunks": len(tlfb_partitions.chunks),
+        "subjects": len(subject_ids),
+        "imputation": imputation_counts
+    }
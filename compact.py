@@ -0,0 +1,120 @@
+import copy
+import numpy as np
+import pandas as pd
+
+_NAT_DAYS = np.iinfo(np.int32).min
+_DAY_NANOSECONDS = 86400 * 10 ** 9
+
+
+def _encode_column(values):
+    dtype = values.dtype
+    if not isinstance(dtype, np.dtype) or dtype.kind not in "Mfiu":
+        codes, uniques = pd.factorize(values)
+        return "codes", (codes.astype(np.int32), uniques)
+    if dtype.kind == "M":
+        nanoseconds = values.astype("datetime64[ns]").astype(np.int64)
+        missing = np.isnat(values)
+        epoch = nanoseconds[~missing].min() if (~missing).any() else 0
+        offsets = nanoseconds - epoch
+        if (offsets[~missing] % _DAY_NANOSECONDS == 0).all() and \
+                (offsets[~missing] // _DAY_NANOSECONDS < np.iinfo(np.int32).max).all():
+            days = np.where(missing, _NAT_DAYS, offsets // _DAY_NANOSECONDS).astype(np.int32)
+            return "days", (epoch, days)
+        return "raw", values
+    if dtype.kind == "f":
+        compact_values = values.astype(np.float32)
+        if np.array_equal(compact_values.astype(dtype), values, equal_nan=True):
+            return "float", compact_values
+        return "raw", values
+    compact_dtype = np.result_type(np.min_scalar_type(values.min()), np.min_scalar_type(values.max())) \
+        if len(values) else np.int8
+    return "int", values.astype(compact_dtype)
+
+
+def _decode_column(kind, payload, dtype):
+    if kind == "days":
+        epoch, days = payload
+        nanoseconds = epoch + days.astype(np.int64) * _DAY_NANOSECONDS
+        return np.where(days == _NAT_DAYS, np.datetime64("NaT", "ns"), nanoseconds.astype("datetime64[ns]")).\
+            astype(dtype)
+    if kind == "codes":
+        codes, uniques = payload
+        values = pd.Series(uniques.take(np.where(codes < 0, 0, codes)) if len(uniques) else codes, dtype=object)
+        values[codes < 0] = np.nan
+        return values.astype(dtype).values
+    return payload.astype(dtype, copy=True)
+
+
+def _payload_nbytes(payload):
+    if isinstance(payload, tuple):
+        return sum(_payload_nbytes(x) for x in payload)
+    if hasattr(payload, "memory_usage"):
+        return int(payload.memory_usage(deep=True))
+    return int(getattr(payload, "nbytes", 8))
+
+
+class CompactFrame(object):
+    def __init__(self, df):
+        """A compact in-memory encoding of a TLFB, biochemical or visit frame.
+
+        The ids and the visits are stored as int32 codes with a lookup table of the distinct values, the dates as
+        int32 day offsets from the earliest date, the amounts as float32, and the integer columns with the smallest
+        integer type. Each column falls back to its original values when the encoding would lose information, such
+        as dates with times of day or amounts that float32 can't represent, so the decoded frame is always the same.
+        """
+        self.columns = list(df.columns)
+        self.index = None if isinstance(df.index, pd.RangeIndex) and df.index.start == 0 and df.index.step == 1 \
+            else df.index
+        self.dtypes = [df[column].dtype for column in self.columns]
+        self.encoded_columns = [_encode_column(df[column].values) for column in self.columns]
+        self.row_count = len(df)
+
+    @property
+    def nbytes(self):
+        index_bytes = 0 if self.index is None else int(self.index.memory_usage(deep=True))
+        return index_bytes + sum(_payload_nbytes(payload) for _, payload in self.encoded_columns)
+
+    def to_frame(self):
+        df = pd.DataFrame({
+            column: _decode_column(kind, payload, dtype)
+            for column, (kind, payload), dtype in zip(self.columns, self.encoded_columns, self.dtypes)
+        }, columns=self.columns)
+        if self.index is not None:
+            df.index = self.index
+        return df
+
+
+class CompactData(object):
+    def __init__(self, data):
+        """Holds an abstcal TLFBData or VisitData object with its data encoded as a CompactFrame."""
+        self.data_class = type(data)
+        self.attributes = {key: value for key, value in vars(data).items() if key != "data"}
+        self.frame = CompactFrame(data.data)
+
+    @property
+    def nbytes(self):
+        return self.frame.nbytes
+
+    @property
+    def subject_ids(self):
+        return self.attributes["subject_ids"]
+
+    def restore(self):
+        """Creates a new abstcal object with the decoded data, which can be modified freely."""
+        data = self.data_class.__new__(self.data_class)
+        for key, value in self.attributes.items():
+            setattr(data, key, copy.deepcopy(value))
+        data.data = self.frame.to_frame()
+        return data
+
+
+def decode(value):
+    """Gets the frame of a CompactFrame or the abstcal object of a CompactData, and any other value as it is.
+
+    The decoded frame or object is a new copy, which can be modified freely.
+    """
+    if isinstance(value, CompactFrame):
+        return value.to_frame()
+    if isinstance(value, CompactData):
+        return value.restore()
+    return value
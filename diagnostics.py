@@ -0,0 +1,143 @@
+import contextlib
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+import tracemalloc
+from collections import deque
+import pandas as pd
+
+# Each record is logged as a JSON line, which a deployment can route to its monitoring
+logger = logging.getLogger("abstcal_web.diagnostics")
+if os.environ.get("ABSTCAL_DIAGNOSTICS_LOG"):
+    _handler = logging.FileHandler(os.environ["ABSTCAL_DIAGNOSTICS_LOG"])
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(_handler)
+    logger.setLevel(logging.INFO)
+
+_tracing_lock = threading.Lock()
+_active_measurements = 0
+_stops_tracing = False
+
+
+def _begin_tracing():
+    # Memory is traced only while some step is measured, so the sessions without diagnostics don't pay for it
+    global _active_measurements, _stops_tracing
+    with _tracing_lock:
+        if _active_measurements == 0:
+            _stops_tracing = not tracemalloc.is_tracing()
+            if _stops_tracing:
+                tracemalloc.start()
+            elif hasattr(tracemalloc, "reset_peak"):
+                tracemalloc.reset_peak()
+        _active_measurements += 1
+        return tracemalloc.get_traced_memory()[0]
+
+
+def _end_tracing(start_bytes):
+    global _active_measurements
+    with _tracing_lock:
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+        _active_measurements -= 1
+        if _active_measurements == 0 and _stops_tracing:
+            tracemalloc.stop()
+    return max(peak_bytes - start_bytes, 0)
+
+
+def row_count(value):
+    """Gets the number of rows of a frame, an abstcal data object or its compact encoding, or None."""
+    if isinstance(value, pd.DataFrame):
+        return len(value)
+    data = getattr(value, "data", None)
+    if isinstance(data, pd.DataFrame):
+        return len(data)
+    frame = getattr(value, "frame", value)
+    return getattr(frame, "row_count", None)
+
+
+class Diagnostics(object):
+    def __init__(self, session_id=None, max_records=1000):
+        """The wall time, CPU time, peak memory and row counts of the steps run for one session.
+
+        The CPU time is that of the measuring thread, which leaves out the worker processes of a sharded calculation.
+        The peak memory is what the step allocates above the memory in use when it starts. Tracing is shared by the
+        process, so the peaks of steps that overlap with the measured steps of other sessions are approximate.
+
+        Parameters
+        ----------
+        session_id : str
+            The session, which is included in the logged records.
+        max_records : int
+            The number of the most recent records that are kept.
+
+        """
+        self.session_id = session_id
+        self.records = deque(maxlen=max_records)
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # The sessions are pickled when they're spilled, which a lock can't be
+        state = dict(vars(self))
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        vars(self).update(state)
+        self._lock = threading.Lock()
+
+    def start(self):
+        return time.perf_counter(), time.thread_time(), _begin_tracing()
+
+    def record(self, measurement, step, stage, rows_in=None, rows_out=None, source="computed"):
+        """Records a step started with start, where source tells whether its result was computed or cached."""
+        wall_start, cpu_start, memory_start = measurement
+        record = {
+            "time": datetime.datetime.now().isoformat(timespec="milliseconds"),
+            "session": self.session_id,
+            "step": step,
+            "stage": stage,
+            "source": source,
+            "wall_seconds": round(time.perf_counter() - wall_start, 6),
+            "cpu_seconds": round(time.thread_time() - cpu_start, 6),
+            "peak_bytes": _end_tracing(memory_start),
+            "rows_in": rows_in,
+            "rows_out": rows_out
+        }
+        with self._lock:
+            self.records.append(record)
+        logger.info(json.dumps(record))
+
+    def to_frame(self):
+        with self._lock:
+            df = pd.DataFrame(list(self.records), columns=["time", "session", "step", "stage", "source", "wall_seconds",
+                                                           "cpu_seconds", "peak_bytes", "rows_in", "rows_out"])
+        # The rows are unknown for some steps, which shouldn't turn the counts into floats
+        return df.astype({"rows_in": "Int64", "rows_out": "Int64"})
+
+    def clear(self):
+        with self._lock:
+            self.records.clear()
+
+
+@contextlib.contextmanager
+def measure(diagnostics, step, stage, data_in=None):
+    """Measures the block as a step of the diagnostics, doing nothing when the diagnostics are None.
+
+    The block may set "data_out" and "source" of the yielded dict, whose rows are counted when the block ends.
+    """
+    measured = dict()
+    if diagnostics is None:
+        yield measured
+        return
+    rows_in = row_count(data_in)
+    measurement = diagnostics.start()
+    try:
+        yield measured
+    except BaseException:
+        measured["source"] = "failed"
+        raise
+    finally:
+        diagnostics.record(measurement, step, stage, rows_in, row_count(measured.get("data_out")),
+                           measured.get("source", "computed"))
@@ -0,0 +1,231 @@
+import copy
+import os
+import pickle
+import stat
+import threading
+import pandas as pd
+
+try:
+    import pyarrow
+    import pyarrow.feather as feather
+except ImportError:
+    pyarrow = None
+
+
+def private_directory(directory):
+    """Creates the directory accessible only by this user, or checks that the existing one is.
+
+    The directories hold pickles, and loading a pickle planted by another user would run their code, so a directory
+    that's a link, owned by another user, or writable by others raises PermissionError.
+    """
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    directory_stat = os.lstat(directory)
+    if not stat.S_ISDIR(directory_stat.st_mode):
+        raise PermissionError(f"The directory {directory} isn't a directory.")
+    if hasattr(os, "getuid") and (directory_stat.st_uid != os.getuid() or directory_stat.st_mode & 0o022):
+        raise PermissionError(f"The directory {directory} should be owned by this user and writable by it only.")
+    return directory
+
+
+def _arrow_round_trips(df):
+    # Arrow gives the object columns of numbers a numeric type, so only those of text come back as they were written
+    return all(pd.api.types.infer_dtype(df.iloc[:, i]) in ("string", "empty")
+               for i, dtype in enumerate(df.dtypes) if dtype == object)
+
+
+def _write_frame(df, path):
+    # Arrow files are read back memory-mapped, while the frames that Arrow can't hold as they are, such as ids of
+    # mixed types, are pickled instead
+    if pyarrow is not None and _arrow_round_trips(df):
+        try:
+            feather.write_feather(df, path, compression="uncompressed")
+            return
+        except (pyarrow.ArrowException, TypeError, ValueError):
+            pass
+    with open(path, "wb") as file:
+        pickle.dump(df, file, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _read_frame(path):
+    with open(path, "rb") as file:
+        is_arrow = file.read(6) == b"ARROW1"
+    if is_arrow:
+        return feather.read_table(path, memory_map=True).to_pandas()
+    with open(path, "rb") as file:
+        return pickle.load(file)
+
+
+class StoredData(object):
+    def __init__(self, data_class, attributes, disk_cache, key):
+        """An abstcal TLFBData or VisitData object whose data stay in the disk cache until they're restored."""
+        self.data_class = data_class
+        self.attributes = attributes
+        self.disk_cache = disk_cache
+        self.key = key
+
+    @property
+    def nbytes(self):
+        return 0
+
+    def restore(self):
+        """Creates a new abstcal object with the data read from the disk cache, which can be modified freely."""
+        data = self.data_class.__new__(self.data_class)
+        for key, value in self.attributes.items():
+            setattr(data, key, copy.deepcopy(value))
+        data.data = self.disk_cache.load_frames(self.key)["data"]
+        return data
+
+
+class DiskCache(object):
+    def __init__(self, directory=None, max_bytes=10 * 1024 ** 3):
+        """A persistent content-addressed cache of frames and the small objects that go with them.
+
+        Each entry has a metadata pickle and a file for each of its frames. The frames are written as uncompressed
+        Arrow (Feather) files, which are read back memory-mapped without any parsing. An entry's access time is its
+        metadata file's modification time, and the least recently used entries are deleted when the files go over
+        max_bytes. The keys are the fingerprints of the inputs and the parameters, so any process can reuse them.
+        The directory must be private to the user (see private_directory), otherwise the cache stays unused, and
+        without a directory the cache is off, so nothing is written to disk.
+
+        The size of the files is scanned once and then kept up to date with the writes, so the directory is only
+        scanned again when the size goes over max_bytes, which also counts the entries written by other processes.
+
+        Parameters
+        ----------
+        directory : str
+            The directory of the cache files, or None to turn the cache off.
+        max_bytes : int
+            The disk budget of the cache files.
+
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._checked = None
+        self._total_bytes = None
+        self._lock = threading.Lock()
+
+    def _usable(self):
+        # The directory is checked once, as only its owner could change it afterwards
+        if self._checked is None and self.directory is None:
+            self._checked = False
+        elif self._checked is None:
+            try:
+                private_directory(self.directory)
+                self._checked = True
+            except OSError:
+                self._checked = False
+        return self._checked
+
+    def _path(self, key, name):
+        return os.path.join(self.directory, f"{key}.{name}")
+
+    def _read_meta(self, key):
+        if not self._usable():
+            raise PermissionError(f"The cache directory {self.directory} isn't private.")
+        with open(self._path(key, "meta"), "rb") as file:
+            return pickle.load(file)
+
+    def get(self, key):
+        """Gets the metadata of the entry, or None when the key isn't cached."""
+        try:
+            meta = self._read_meta(key)
+            os.utime(self._path(key, "meta"))
+        except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return meta
+
+    def load_frames(self, key):
+        """Reads the frames of the entry as a dict of the frames by their names."""
+        return {name: _read_frame(self._path(key, f"{name}.arrow")) for name in self._read_meta(key)["frames"]}
+
+    def put(self, key, frames, meta):
+        """Writes the frames, a dict of the frames by their names, and the metadata dict of the entry.
+
+        The metadata file is written last, so a partially written entry is never read.
+        """
+        if not self._usable():
+            return
+        meta = dict(meta, frames=list(frames))
+        written_bytes = 0
+        try:
+            for name, df in frames.items():
+                temp_path = self._path(key, f"{name}.arrow.{os.getpid()}.{threading.get_ident()}.tmp")
+                _write_frame(df, temp_path)
+                written_bytes += os.path.getsize(temp_path)
+                os.replace(temp_path, self._path(key, f"{name}.arrow"))
+            temp_path = self._path(key, f"meta.{os.getpid()}.{threading.get_ident()}.tmp")
+            with open(temp_path, "wb") as file:
+                pickle.dump(meta, file, protocol=pickle.HIGHEST_PROTOCOL)
+            written_bytes += os.path.getsize(temp_path)
+            os.replace(temp_path, self._path(key, "meta"))
+        except (OSError, pickle.PicklingError, TypeError, AttributeError):
+            # The cache is an optimization, so an entry that can't be written is skipped
+            return
+        with self._lock:
+            # A rewritten entry is counted twice, which only brings the next scan forward
+            if self._total_bytes is not None:
+                self._total_bytes += written_bytes
+            if self._total_bytes is None or self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def _entries(self):
+        entries = dict()
+        if not self._usable():
+            return entries
+        for filename in os.listdir(self.directory):
+            path = os.path.join(self.directory, filename)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            key = filename.split(".", 1)[0]
+            access_time, size, paths = entries.get(key, (0, 0, list()))
+            if filename.endswith(".meta"):
+                access_time = stat.st_mtime
+            entries[key] = (access_time, size + stat.st_size, paths + [path])
+        return entries
+
+    def _evict(self):
+        # Called with the lock held, when the running size is unknown or over the budget
+        entries = self._entries()
+        total_bytes = sum(size for _, size, _ in entries.values())
+        for key, (_, size, paths) in sorted(entries.items(), key=lambda x: x[1][0]):
+            if total_bytes <= self.max_bytes:
+                break
+            for path in sorted(paths, key=lambda x: not x.endswith(".meta")):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            total_bytes -= size
+        self._total_bytes = total_bytes
+
+    def clear(self):
+        with self._lock:
+            for _, _, paths in self._entries().values():
+                for path in paths:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+            self._total_bytes = None
+
+    def stats(self):
+        entries = self._entries()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(entries),
+            "bytes": sum(size for _, size, _ in entries.values()),
+            "max_bytes": self.max_bytes
+        }
+
+
+# The cache persists the processed data and results, so it's only on when the deployment sets its directory, and it
+# keeps the cache across server restarts
+disk_cache = DiskCache(os.environ.get("ABSTCAL_CACHE_DIR"), int(os.environ.get("ABSTCAL_CACHE_MAX_BYTES",
+                                                                               10 * 1024 ** 3)))
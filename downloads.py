@@ -0,0 +1,166 @@
+import gc
+import io
+import logging
+import secrets
+import threading
+import zlib
+from collections import OrderedDict, namedtuple
+import tornado.web
+from streamlit import config
+from streamlit.server.server_util import make_url_path_regex
+from tornado.ioloop import IOLoop
+
+# The output formats with their file extensions and content types
+download_formats = OrderedDict([
+    ("csv", ("csv", "text/csv")),
+    ("csv.gz", ("csv.gz", "application/gzip")),
+    ("json", ("jsonl", "application/x-ndjson")),
+    ("parquet", ("parquet", "application/octet-stream")),
+    ("xlsx", ("xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"))
+])
+
+Download = namedtuple("Download", ["df", "filename", "kept_index"])
+
+_CSV_CHUNK_ROWS = 50000
+_WRITE_CHUNK_BYTES = 1024 ** 2
+
+
+def _iter_csv(df, kept_index):
+    for start in range(0, max(len(df), 1), _CSV_CHUNK_ROWS):
+        yield df.iloc[start:start + _CSV_CHUNK_ROWS].to_csv(index=kept_index, header=start == 0).encode()
+
+
+def _iter_json(df, kept_index):
+    # JSON lines, one object per row, which are written in pieces the same as the CSV files
+    if kept_index:
+        df = df.reset_index()
+    for start in range(0, len(df), _CSV_CHUNK_ROWS):
+        yield df.iloc[start:start + _CSV_CHUNK_ROWS].to_json(orient="records", lines=True, date_format="iso").\
+            rstrip("\n").encode() + b"\n"
+
+
+def _iter_gzip(chunks):
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        yield compressor.compress(chunk)
+    yield compressor.flush()
+
+
+def _iter_buffer(write):
+    # Parquet and Excel files can't be written in pieces, so they're written at once and sent in pieces
+    buffer = io.BytesIO()
+    write(buffer)
+    view = buffer.getbuffer()
+    for start in range(0, len(view), _WRITE_CHUNK_BYTES):
+        yield bytes(view[start:start + _WRITE_CHUNK_BYTES])
+
+
+def iter_download(download, file_format):
+    """Generates the bytes of the download in the format, one piece at a time."""
+    df, kept_index = download.df, download.kept_index
+    if file_format == "csv":
+        return _iter_csv(df, kept_index)
+    if file_format == "csv.gz":
+        return _iter_gzip(_iter_csv(df, kept_index))
+    if file_format == "json":
+        return _iter_json(df, kept_index)
+    if file_format == "parquet":
+        return _iter_buffer(lambda buffer: df.to_parquet(buffer, index=kept_index))
+    if file_format == "xlsx":
+        return _iter_buffer(lambda buffer: df.to_excel(buffer, index=kept_index, engine="openpyxl"))
+    raise ValueError(f"The download format should be one of {', '.join(download_formats)}.")
+
+
+class DownloadRegistry(object):
+    def __init__(self, max_entries=256):
+        """The result tables offered for download, keyed on random tokens that appear in the download links.
+
+        The tables are held by reference, so registering one doesn't copy it. A session registering a table under
+        the same file name replaces its previous one. The session store discards the tables of the sessions it spills
+        or drops, and the least recently registered tables are dropped beyond max_entries.
+        """
+        self.max_entries = max_entries
+        self._downloads = OrderedDict()
+        self._tokens = dict()
+        self._lock = threading.Lock()
+
+    def register(self, session_id, df, filename, kept_index):
+        token = secrets.token_urlsafe(16)
+        with self._lock:
+            previous_token = self._tokens.pop((session_id, filename), None)
+            self._downloads.pop(previous_token, None)
+            self._downloads[token] = Download(df, filename, kept_index)
+            self._tokens[(session_id, filename)] = token
+            while len(self._downloads) > self.max_entries:
+                self._downloads.popitem(last=False)
+            self._tokens = {key: value for key, value in self._tokens.items() if value in self._downloads}
+        return token
+
+    def get(self, token):
+        with self._lock:
+            return self._downloads.get(token)
+
+    def discard(self, session_id):
+        """Drops the tables of the session, such as one that's spilled or dropped by the session store."""
+        with self._lock:
+            for key in [x for x in self._tokens if x[0] == session_id]:
+                self._downloads.pop(self._tokens.pop(key), None)
+
+
+download_registry = DownloadRegistry()
+
+
+class DownloadHandler(tornado.web.RequestHandler):
+    async def get(self, token):
+        download = download_registry.get(token)
+        file_format = self.get_argument("format", "csv")
+        if download is None or file_format not in download_formats:
+            raise tornado.web.HTTPError(404)
+        extension, content_type = download_formats[file_format]
+        self.set_header("Content-Type", content_type)
+        self.set_header("Content-Disposition", f'attachment; filename="{download.filename}.{extension}"')
+        # The pieces are generated on a worker thread, so a large download doesn't hold up the server's event loop
+        pieces = iter_download(download, file_format)
+        while True:
+            piece = await IOLoop.current().run_in_executor(None, next, pieces, None)
+            if piece is None:
+                break
+            self.write(piece)
+            await self.flush()
+
+
+logger = logging.getLogger("abstcal_web.downloads")
+_route_lock = threading.Lock()
+# None until the route is added, and then whether it was
+_route_registered = None
+
+
+def download_url(token, file_format):
+    # The URL is relative, so it follows the base URL path that the app is served under
+    return f"download/{token}?format={file_format}"
+
+
+def register_route():
+    """Adds the download route to the Streamlit server's Tornado app, once per process.
+
+    Streamlit doesn't expose its app, so it's found among the live objects. Tornado matches the added handlers before
+    the app's own routes, which end with a catch-all route for the static files. The app is only looked for once, and
+    when it isn't found, such as with a version of Streamlit that holds it differently, a warning is logged.
+
+    Returns
+    -------
+    bool
+        Whether the route is served, otherwise the download links would not be found.
+
+    """
+    global _route_registered
+    with _route_lock:
+        if _route_registered is None:
+            pattern = make_url_path_regex(config.get_option("server.baseUrlPath"), "download/([A-Za-z0-9_-]+)")
+            apps = [x for x in gc.get_objects() if isinstance(x, tornado.web.Application)]
+            for app in apps:
+                app.add_handlers(r".*", [(pattern, DownloadHandler)])
+            _route_registered = bool(apps)
+            if not apps:
+                logger.warning("The Streamlit server's Tornado app isn't found, so the downloads aren't served.")
+        return _route_registered
@@ -0,0 +1,350 @@
+"""Keeps the processed data and the abstinence of an ongoing study up to date as new rows arrive.
+
+A dataset is created once from a study config of batch.py and persisted in a directory, with the uploaded rows, the
+processed TLFB and visit data, and the abstinence and lapse data. Each delta file of new TLFB, biochemical or visit
+rows is then appended to it. Only the subjects whose processed data change are reprocessed and recalculated, and the
+other subjects keep their results. The merged results are the same as processing all the rows from scratch.
+
+Usage:
+    python incremental.py init study_a.json --dataset-dir study_a_dataset
+    python incremental.py append study_a_dataset --tlfb tlfb_week_12.csv --visit visits_week_12.csv
+"""
+import argparse
+import copy
+import json
+import os
+import pickle
+import sys
+import tempfile
+from collections import namedtuple
+import abstcal as ac
+import pandas as pd
+from batch import build_context
+from compact import decode
+from ingestion import file_digest, parse_file
+from pipeline import PipelineContext, calculate_abstinence, process_tlfb_chunk, process_tlfb_data, \
+    process_visit_data
+
+# Bumped whenever the layout of the persisted datasets changes, so an older dataset is recreated rather than misread
+_dataset_version = 1
+_DATASET_FILE = "dataset.pkl"
+
+# What an append changed: the revision of the dataset, the rows added by kind, the changed subjects with the reasons
+# and the ranges of their changed days, the abstinence cells whose values changed, and the lapse rows added and removed
+ChangeReport = namedtuple("ChangeReport", ["revision", "rows_added", "subjects", "cells", "lapses_added",
+                                           "lapses_removed"])
+
+
+def _save_state(dataset_dir, state):
+    # The new state replaces the old one at once, so an interrupted append leaves the previous revision intact
+    os.makedirs(dataset_dir, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=dataset_dir, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as file:
+            pickle.dump(state, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, os.path.join(dataset_dir, _DATASET_FILE))
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def load_dataset(dataset_dir):
+    """Reads the persisted state of the dataset, a dict with its config, rows, processed data and results."""
+    path = os.path.join(dataset_dir, _DATASET_FILE)
+    if not os.path.exists(path):
+        raise ValueError(f"There isn't any dataset in {dataset_dir}. Please create it with init first.")
+    with open(path, "rb") as file:
+        state = pickle.load(file)
+    if state.get("version") != _dataset_version or state.get("abstcal_version") != ac.__version__:
+        raise ValueError(f"The dataset in {dataset_dir} was created by another version. Please create it again.")
+    return state
+
+
+def _params_without_data(params):
+    return {key: value for key, value in params.items() if key != "data"}
+
+
+def create_dataset(config, dataset_dir):
+    """Processes the data of the study config, calculates its abstinence and persists them in the directory.
+
+    Returns
+    -------
+    tuple
+        The abstinence data and the lapse data.
+
+    """
+    # The TLFB rows of the subjects without visits are kept, since their visits may come with a later delta
+    context = build_context(dict(config, reconcile_subjects=False))
+    visit_results = process_visit_data(context.visit_data_params)
+    context.visit_data = visit_results["impute"].data
+    context.visit_index = visit_results["dates"].output
+    context.visit_key = visit_results["impute"].key
+    stage_results = process_tlfb_data(context.tlfb_data_params, context.bio_data_params)
+    context.tlfb_data = stage_results["impute"].data
+    context.tlfb_index = stage_results["index"].output
+    context.tlfb_key = stage_results["impute"].key
+    abst_df, lapse_df = calculate_abstinence(context)
+
+    state = {
+        "version": _dataset_version,
+        "abstcal_version": ac.__version__,
+        "revision": 0,
+        "name": config.get("name", "study"),
+        "output_dir": config.get("output_dir", "."),
+        # The expected visits that the config leaves to the data are inferred again whenever new visits arrive
+        "infers_visits": config["visit"].get("expected_visits") is None,
+        "params": {
+            "tlfb": _params_without_data(context.tlfb_data_params),
+            "bio": _params_without_data(context.bio_data_params),
+            "visit": _params_without_data(context.visit_data_params),
+            "abst": (context.abst_pp_params, context.abst_prol_params, context.abst_cont_params,
+                     context.abst_params_shared)
+        },
+        "rows": {
+            "tlfb": context.tlfb_data_params["data"],
+            "bio": context.bio_data_params.get("data"),
+            "visit": context.visit_data_params["data"]
+        },
+        "tlfb_data": decode(context.tlfb_data),
+        "visit_data": decode(context.visit_data),
+        "abst": abst_df,
+        "lapse": lapse_df
+    }
+    _save_state(dataset_dir, state)
+    return abst_df, lapse_df
+
+
+def _changed_rows(before, after, keys, subject_ids):
+    """Gets the merged rows of the subjects that differ between the processed frames, or that only one of them has."""
+    before = before.loc[before["id"].isin(subject_ids), :]
+    after = after.loc[after["id"].isin(subject_ids), :]
+    value_columns = [column for column in after.columns if column not in keys and column in before.columns]
+    merged = before.merge(after, on=keys, how="outer", suffixes=("_before", "_after"), indicator=True)
+    changed = merged["_merge"] != "both"
+    for column in value_columns:
+        values_before, values_after = merged[f"{column}_before"], merged[f"{column}_after"]
+        changed |= (values_before != values_after) & ~(values_before.isna() & values_after.isna())
+    return merged.loc[changed, :]
+
+
+def _with_rows(data, df):
+    data = copy.copy(data)
+    data.data = df
+    data.subject_ids = set(df["id"].unique())
+    return data
+
+
+def _subset(data, subject_ids):
+    return _with_rows(data, data.data.loc[data.data["id"].isin(subject_ids), :])
+
+
+def _restore_int_columns(abst_df):
+    # The scores are integers unless some of them are missing, the same as in the full calculation
+    for column in abst_df.columns:
+        if pd.api.types.is_float_dtype(abst_df[column]) and abst_df[column].notna().all():
+            abst_df[column] = abst_df[column].astype(int)
+    return abst_df
+
+
+def _changed_cells(abst_df, new_abst_df):
+    before = abst_df.loc[abst_df.index.isin(new_abst_df.index), :].rename_axis("id").reset_index().\
+        melt(id_vars="id", var_name="abst_name", value_name="before")
+    after = new_abst_df.rename_axis("id").reset_index().melt(id_vars="id", var_name="abst_name", value_name="after")
+    cells = before.merge(after, on=["id", "abst_name"], how="outer")
+    unchanged = (cells["before"] == cells["after"]) | (cells["before"].isna() & cells["after"].isna())
+    return cells.loc[~unchanged, :].sort_values(by=["id", "abst_name"], ignore_index=True)
+
+
+def _sorted_lapses(lapse_df, abst_columns, abst_params):
+    """Sorts the lapses the same as the full calculation, by abstinence name within each family in the family order.
+
+    Each family's columns are a contiguous block of the abstinence data, whose size follows from its parameters.
+    """
+    abst_pp_params, abst_prol_params, abst_cont_params, _ = abst_params
+    block_sizes = [len(abst_pp_params["visits"]) * len(abst_pp_params["days"]) if abst_pp_params["visits"] else 0,
+                   len(abst_prol_params["visits"]) * len(abst_prol_params["lapse_definitions"])
+                   if abst_prol_params["visits"] else 0,
+                   len(abst_cont_params["visits"])]
+    families = dict()
+    start = 0
+    for family, block_size in enumerate(block_sizes):
+        families.update(dict.fromkeys(abst_columns[start:start + block_size], family))
+        start += block_size
+    lapse_df = lapse_df.assign(_family=lapse_df["abst_name"].map(families))
+    return lapse_df.sort_values(by=["_family", "abst_name", "id", "date"], ignore_index=True).drop(columns="_family")
+
+
+def _append_rows(rows, delta_df, digest, delta_digest):
+    # The digest of the appended rows chains those of the earlier rows and the delta, for the stage cache keys
+    return pd.concat([rows, delta_df], ignore_index=True), file_digest(f"{digest}:{delta_digest}".encode())
+
+
+def append_delta(dataset_dir, tlfb_path=None, bio_path=None, visit_path=None):
+    """Appends the delta files of new rows to the persisted dataset and updates its processed data and results.
+
+    The visit data have a few rows per subject and their imputation uses the statistics of the whole cohort, so they
+    are reprocessed in full, and the subjects whose processed visits change are recalculated. The TLFB and
+    biochemical data are reprocessed only for the subjects with new rows, which re-imputes the gaps around the new
+    days, and the subjects whose processed days change are recalculated. The abstinence of a subject depends only on
+    the subject's own days and visits, so the results of the other subjects are kept as they are.
+
+    Parameters
+    ----------
+    dataset_dir : str
+        The directory of the dataset created by create_dataset.
+    tlfb_path, bio_path, visit_path : str
+        The delta files of the new TLFB, biochemical and visit rows, any of which may be None.
+
+    Returns
+    -------
+    tuple
+        The merged abstinence data, the merged lapse data and the ChangeReport of the append.
+
+    """
+    state = load_dataset(dataset_dir)
+    params = state["params"]
+    rows = state["rows"]
+    if bio_path is not None and rows["bio"] is None:
+        raise ValueError("The study has no biochemical data, so biochemical rows can't be appended.")
+    rows_added = dict.fromkeys(("tlfb", "bio", "visit"), 0)
+    reasons = dict()
+
+    visit_data = state["visit_data"]
+    if visit_path is not None:
+        visit_params = dict(params["visit"])
+        parsed_file = parse_file(visit_path, "visit", visit_params["data_format"])
+        rows["visit"], visit_params["data_digest"] = _append_rows(rows["visit"], parsed_file.data,
+                                                                  visit_params["data_digest"], parsed_file.digest)
+        rows_added["visit"] = len(parsed_file.data)
+        if state["infers_visits"]:
+            visit_params["expected_visits"] = sorted(set(visit_params["expected_visits"]) | set(parsed_file.visits))
+        visit_data = decode(process_visit_data(dict(visit_params, data=rows["visit"]))["impute"].data)
+        changed_df = _changed_rows(state["visit_data"].data, visit_data.data, ["id", "visit"],
+                                   visit_data.subject_ids | state["visit_data"].subject_ids)
+        for subject_id in changed_df["id"].unique():
+            reasons.setdefault(subject_id, set()).add("visit")
+        params["visit"] = visit_params
+        changed_visits = changed_df.groupby("id").size()
+    else:
+        changed_visits = pd.Series(dtype=int)
+
+    tlfb_data = state["tlfb_data"]
+    delta_subjects = set()
+    for kind, path in (("tlfb", tlfb_path), ("bio", bio_path)):
+        if path is None:
+            continue
+        parsed_file = parse_file(path, kind)
+        rows[kind], params[kind]["data_digest"] = _append_rows(rows[kind], parsed_file.data,
+                                                               params[kind]["data_digest"], parsed_file.digest)
+        rows_added[kind] = len(parsed_file.data)
+        delta_subjects |= set(parsed_file.data["id"].unique())
+    changed_days = pd.DataFrame({"id": [], "date": pd.to_datetime([])})
+    reprocessed_subjects = delta_subjects & set(rows["tlfb"]["id"].unique())
+    if reprocessed_subjects:
+        tlfb_params = dict(params["tlfb"], data=rows["tlfb"].loc[rows["tlfb"]["id"].isin(reprocessed_subjects), :])
+        bio_params = dict(params["bio"], data=None)
+        if rows["bio"] is not None:
+            bio_params["data"] = rows["bio"].loc[rows["bio"]["id"].isin(reprocessed_subjects), :]
+        reprocessed_df = process_tlfb_chunk(tlfb_params, bio_params)["impute"].data.data
+        kept_df = tlfb_data.data.loc[~tlfb_data.data["id"].isin(reprocessed_subjects), :]
+        tlfb_df = pd.concat([kept_df, reprocessed_df], ignore_index=True).\
+            sort_values(by=["id", "date"], kind="mergesort", ignore_index=True)
+        changed_days = _changed_rows(tlfb_data.data, tlfb_df, ["id", "date"], reprocessed_subjects)
+        for subject_id in changed_days["id"].unique():
+            reasons.setdefault(subject_id, set()).add("tlfb" if subject_id in tlfb_data.subject_ids else "new")
+        tlfb_data = _with_rows(tlfb_data, tlfb_df)
+
+    # Only the subjects in both data are calculated, the same as in the full calculation
+    recalculated_subjects = sorted(set(reasons) & tlfb_data.subject_ids & visit_data.subject_ids)
+    abst_df, lapse_df = state["abst"], state["lapse"]
+    cells = pd.DataFrame(columns=["id", "abst_name", "before", "after"])
+    lapses_added = lapses_removed = 0
+    if recalculated_subjects:
+        context = PipelineContext()
+        context.tlfb_data = _subset(tlfb_data, recalculated_subjects)
+        context.visit_data = _subset(visit_data, recalculated_subjects)
+        context.abst_pp_params, context.abst_prol_params, context.abst_cont_params, context.abst_params_shared = \
+            copy.deepcopy(params["abst"])
+        new_abst_df, new_lapse_df = calculate_abstinence(context)
+        cells = _changed_cells(abst_df, new_abst_df)
+
+        old_lapse_df = lapse_df.loc[lapse_df["id"].isin(recalculated_subjects), :]
+        lapse_changes = old_lapse_df.merge(new_lapse_df, how="outer", indicator=True)["_merge"]
+        lapses_added, lapses_removed = int((lapse_changes == "right_only").sum()), \
+            int((lapse_changes == "left_only").sum())
+        abst_df = _restore_int_columns(pd.concat([abst_df.loc[~abst_df.index.isin(recalculated_subjects), :],
+                                                  new_abst_df]).sort_index())
+        lapse_df = _sorted_lapses(pd.concat([lapse_df.loc[~lapse_df["id"].isin(recalculated_subjects), :],
+                                             new_lapse_df]), list(abst_df.columns), params["abst"])
+
+    day_ranges = changed_days.groupby("id")["date"].agg(["min", "max", "count"])
+    subjects = pd.DataFrame({
+        "id": sorted(reasons),
+        "reasons": [", ".join(sorted(reasons[x])) for x in sorted(reasons)],
+        "first_changed_date": [day_ranges["min"].get(x) for x in sorted(reasons)],
+        "last_changed_date": [day_ranges["max"].get(x) for x in sorted(reasons)],
+        "changed_days": [int(day_ranges["count"].get(x, 0)) for x in sorted(reasons)],
+        "changed_visits": [int(changed_visits.get(x, 0)) for x in sorted(reasons)],
+        "recalculated": [x in recalculated_subjects for x in sorted(reasons)]
+    })
+
+    state.update(revision=state["revision"] + 1, tlfb_data=tlfb_data, visit_data=visit_data, abst=abst_df,
+                 lapse=lapse_df)
+    _save_state(dataset_dir, state)
+    return abst_df, lapse_df, ChangeReport(state["revision"], rows_added, subjects, cells, lapses_added,
+                                           lapses_removed)
+
+
+def _write_results(output_dir, name, abst_df, lapse_df):
+    os.makedirs(output_dir, exist_ok=True)
+    abst_path = os.path.join(output_dir, f"{name}_abstinence_data.csv")
+    lapse_path = os.path.join(output_dir, f"{name}_lapse_data.csv")
+    abst_df.to_csv(abst_path, index=True)
+    lapse_df.to_csv(lapse_path, index=False)
+    return [abst_path, lapse_path]
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    init_parser = subparsers.add_parser("init", help="Create a dataset from a study config")
+    init_parser.add_argument("config", help="The JSON config file of the study")
+    init_parser.add_argument("--dataset-dir", required=True, help="The directory of the persisted dataset")
+    append_parser = subparsers.add_parser("append", help="Append delta files of new rows to a dataset")
+    append_parser.add_argument("dataset_dir", help="The directory of the persisted dataset")
+    append_parser.add_argument("--tlfb", help="The delta file of the new TLFB rows")
+    append_parser.add_argument("--bio", help="The delta file of the new biochemical rows")
+    append_parser.add_argument("--visit", help="The delta file of the new visit rows")
+    for subparser in (init_parser, append_parser):
+        subparser.add_argument("--output-dir", help="The directory of the results, the study's output_dir by default")
+    args = parser.parse_args(args)
+
+    if args.command == "init":
+        with open(args.config) as file:
+            config = json.load(file)
+        config.setdefault("name", os.path.splitext(os.path.basename(args.config))[0])
+        abst_df, lapse_df = create_dataset(config, args.dataset_dir)
+        paths = _write_results(args.output_dir or config.get("output_dir", "."), config["name"], abst_df, lapse_df)
+        print(f"{config['name']}: {', '.join(paths)}")
+        return 0
+
+    if args.tlfb is None and args.bio is None and args.visit is None:
+        parser.error("Please specify at least one delta file.")
+    abst_df, lapse_df, report = append_delta(args.dataset_dir, args.tlfb, args.bio, args.visit)
+    state = load_dataset(args.dataset_dir)
+    output_dir = args.output_dir or state["output_dir"]
+    paths = _write_results(output_dir, state["name"], abst_df, lapse_df)
+    prefix = os.path.join(output_dir, f"{state['name']}_revision_{report.revision}")
+    report.subjects.to_csv(f"{prefix}_changed_subjects.csv", index=False)
+    report.cells.to_csv(f"{prefix}_changed_cells.csv", index=False)
+    paths += [f"{prefix}_changed_subjects.csv", f"{prefix}_changed_cells.csv"]
+    added = ", ".join(f"{count} {kind}" for kind, count in report.rows_added.items() if count)
+    print(f"{state['name']} revision {report.revision}: added {added} rows; {len(report.subjects)} subjects changed, "
+          f"{report.subjects['recalculated'].sum()} recalculated; {len(report.cells)} abstinence cells changed, "
+          f"{report.lapses_added} lapses added, {report.lapses_removed} removed")
+    print(", ".join(paths))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,458 @@
+import csv
+import gzip
+import hashlib
+import io
+import os
+import threading
+import zipfile
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import abstcal as ac
+import numpy as np
+import pandas as pd
+from compact import CompactFrame, decode
+from diagnostics import measure
+
+# The parsed frame and the lists used to fill the subject and visit pickers
+ParsedUpload = namedtuple("ParsedUpload", ["digest", "data", "subjects", "visits", "nbytes"])
+
+# The subjects that are analysed, those selected in both the TLFB and the visit data, and the subjects that only one
+# of the uploads has
+SubjectReconciliation = namedtuple("SubjectReconciliation", ["subjects", "tlfb_only", "visit_only"])
+
+# A file of a multi-site upload and the site whose rows it holds
+SiteFile = namedtuple("SiteFile", ["site", "buffer"])
+
+# The column of a merged multi-site upload that tags each row with its site, which the pipeline drops when loading
+SITE_COLUMN = "site"
+
+# The files of a multi-site upload parsed at the same time, which the parsers mostly spend outside of the GIL
+_PARSE_WORKERS = int(os.environ.get("ABSTCAL_PARSE_WORKERS", min(8, os.cpu_count() or 1)))
+
+# The file extensions stripped from the file names to get the site names
+_FILE_EXTENSIONS = (".gz", ".zip", ".csv", ".txt", ".tsv", ".xlsx", ".parquet", ".feather")
+
+
+def file_digest(buffer):
+    return hashlib.sha256(buffer).hexdigest()
+
+
+# The delimiters tried when sniffing text files and the number of bytes that are sniffed
+_DELIMITERS = ",\t;|"
+_SNIFF_BYTES = 64 * 1024
+
+# The rows of a text file read at a time when only some subjects are kept
+_FILTER_CHUNK_ROWS = 100000
+
+
+def select_subjects(df, subjects):
+    """Gets the rows of the subjects, or all the rows when subjects is "all" or None."""
+    if subjects is None or isinstance(subjects, str) and subjects == "all":
+        return df
+    return df.loc[df["id"].isin(subjects), :].reset_index(drop=True)
+
+
+def drop_sites(df):
+    """Gets the frame without the site column of a multi-site upload, as a copy that may be modified in place."""
+    return df.drop(columns=SITE_COLUMN) if SITE_COLUMN in df.columns else df.copy()
+
+
+def site_name(filename):
+    """Gets the site of a file of a multi-site upload, which is its file name without the directory and extensions."""
+    name = os.path.basename(filename)
+    while name.lower().endswith(_FILE_EXTENSIONS) and "." in name[1:]:
+        name = name[:name.rindex(".")]
+    return name
+
+
+def reconcile_subjects(tlfb_subjects, visit_subjects, tlfb_selection="all", visit_selection="all"):
+    """Finds the subjects whose abstinence can be calculated, and the subjects of one upload missing from the other.
+
+    Parameters
+    ----------
+    tlfb_subjects, visit_subjects : list
+        The subjects found in the TLFB and the visit data.
+    tlfb_selection, visit_selection : object
+        "all" or the subjects selected in each of the data.
+
+    Returns
+    -------
+    SubjectReconciliation
+        The sorted subjects that are selected in both data, and those only in the TLFB or only in the visit data.
+
+    """
+    tlfb_subjects, visit_subjects = set(tlfb_subjects), set(visit_subjects)
+    selected_subjects = tlfb_subjects & visit_subjects
+    for selection in (tlfb_selection, visit_selection):
+        if selection is not None and not (isinstance(selection, str) and selection == "all"):
+            selected_subjects &= set(selection)
+    return SubjectReconciliation(sorted(selected_subjects), sorted(tlfb_subjects - visit_subjects),
+                                 sorted(visit_subjects - tlfb_subjects))
+
+
+def _column_types(columns, kind, data_format=None):
+    """Gets the date columns and the explicit dtypes of the columns that abstcal expects for the kind of data."""
+    columns = list(columns)
+    if kind == "visit" and data_format == "wide":
+        date_columns = [column for column in columns if column not in ("id", SITE_COLUMN)]
+    else:
+        date_columns = [column for column in ("date",) if column in columns]
+    dtypes = {"amount": float} if kind in ("tlfb", "bio") and "amount" in columns else dict()
+    return date_columns, dtypes
+
+
+def _sniff_delimiter(sample):
+    text = sample.decode("utf-8", errors="ignore")
+    try:
+        return csv.Sniffer().sniff(text, delimiters=_DELIMITERS).delimiter
+    except csv.Error:
+        return ","
+
+
+def _text_options(open_file, kind, data_format):
+    with open_file() as file:
+        delimiter = _sniff_delimiter(file.read(_SNIFF_BYTES))
+    with open_file() as file:
+        columns = pd.read_csv(file, sep=delimiter, nrows=0).columns
+    date_columns, dtypes = _column_types(columns, kind, data_format)
+    return {"sep": delimiter, "dtype": dtypes, "parse_dates": date_columns, "infer_datetime_format": True}
+
+
+def _read_text(open_file, kind, data_format, subjects=None):
+    options = _text_options(open_file, kind, data_format)
+    with open_file() as file:
+        if subjects is None:
+            return pd.read_csv(file, **options)
+        # The rows of the other subjects are dropped as the file is read, so the whole file is never held at once
+        return pd.concat([select_subjects(df, subjects) for df in
+                          pd.read_csv(file, chunksize=_FILTER_CHUNK_ROWS, **options)], ignore_index=True)
+
+
+def _iter_text(open_file, kind, data_format, chunk_rows):
+    options = _text_options(open_file, kind, data_format)
+    with open_file() as file:
+        for df in pd.read_csv(file, chunksize=chunk_rows, **options):
+            yield df
+
+
+def _read_excel(buffer, kind, data_format):
+    try:
+        columns = pd.read_excel(io.BytesIO(buffer), nrows=0, engine="openpyxl").columns
+        date_columns, dtypes = _column_types(columns, kind, data_format)
+        return pd.read_excel(io.BytesIO(buffer), dtype=dtypes, parse_dates=date_columns, engine="openpyxl")
+    except ImportError:
+        raise ValueError("Reading Excel files requires the openpyxl package.")
+
+
+def _convert_types(df, kind, data_format):
+    # The columnar formats keep their own types, so only the columns stored as text still need the conversion
+    date_columns, dtypes = _column_types(df.columns, kind, data_format)
+    for column in date_columns:
+        if not pd.api.types.is_datetime64_any_dtype(df[column]):
+            df[column] = pd.to_datetime(df[column], infer_datetime_format=True)
+    return df.astype(dtypes) if dtypes else df
+
+
+def _read_columnar(buffer, kind, data_format, reader):
+    try:
+        df = reader(io.BytesIO(buffer))
+    except ImportError:
+        raise ValueError("Reading Parquet and Feather files requires the pyarrow package.")
+    return _convert_types(df, kind, data_format)
+
+
+def _zip_member(archive):
+    """Gets the name of the text file in the zip archive, or None when the archive is an Excel workbook."""
+    names = [name for name in archive.namelist() if not name.endswith("/")]
+    if "[Content_Types].xml" in names:
+        return None
+    if len(names) != 1:
+        raise ValueError("The zip archive should contain exactly one data file.")
+    return names[0]
+
+
+def read_data(buffer, kind=None, data_format=None, subjects=None):
+    """Reads the file content, dispatching on the file format detected from the leading bytes.
+
+    Parquet, Feather, Excel (.xlsx), and gzip- or zip-compressed text files are read natively, and text files are
+    read with the delimiter sniffed from their first lines. The dates and the amounts are parsed during the read, and
+    with subjects, the text files keep only the rows of the subjects as they're read.
+
+    Parameters
+    ----------
+    buffer : bytes
+        The file content.
+    kind : str
+        "tlfb", "bio" or "visit", which determines the columns that are read as dates and amounts.
+    data_format : str
+        The visit data format, "long" or "wide", in which every column other than id holds dates.
+    subjects : list
+        The subjects whose rows are kept, or None for all the rows.
+
+    Returns
+    -------
+    DataFrame
+        The data as read from the file.
+
+    """
+    if buffer[:4] == b"PAR1":
+        return select_subjects(_read_columnar(buffer, kind, data_format, pd.read_parquet), subjects)
+    if buffer[:6] == b"ARROW1" or buffer[:4] == b"FEA1":
+        return select_subjects(_read_columnar(buffer, kind, data_format, pd.read_feather), subjects)
+    if buffer[:2] == b"\x1f\x8b":
+        return _read_text(lambda: gzip.GzipFile(fileobj=io.BytesIO(buffer)), kind, data_format, subjects)
+    if buffer[:4] == b"PK\x03\x04":
+        archive = zipfile.ZipFile(io.BytesIO(buffer))
+        name = _zip_member(archive)
+        if name is None:
+            return select_subjects(_read_excel(buffer, kind, data_format), subjects)
+        return _read_text(lambda: archive.open(name), kind, data_format, subjects)
+    return _read_text(lambda: io.BytesIO(buffer), kind, data_format, subjects)
+
+
+def iter_file(path, kind=None, data_format=None, chunk_rows=100000):
+    """Reads a data file in chunks of rows, for the files that are too large to be read at once.
+
+    Delimited text, also compressed, and Parquet files are streamed with the same type handling as read_data. Excel
+    and Feather files can't be read partially, so they're yielded as a single chunk.
+
+    Yields
+    ------
+    DataFrame
+        The consecutive chunks of at most chunk_rows rows.
+
+    """
+    with open(path, "rb") as file:
+        head = file.read(_SNIFF_BYTES)
+    if head[:4] == b"PAR1":
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ValueError("Reading Parquet and Feather files requires the pyarrow package.")
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_rows):
+            yield _convert_types(batch.to_pandas(), kind, data_format)
+        return
+    if head[:2] == b"\x1f\x8b":
+        yield from _iter_text(lambda: gzip.open(path), kind, data_format, chunk_rows)
+        return
+    if head[:4] == b"PK\x03\x04":
+        with zipfile.ZipFile(path) as archive:
+            name = _zip_member(archive)
+            if name is not None:
+                yield from _iter_text(lambda: archive.open(name), kind, data_format, chunk_rows)
+                return
+    if head[:4] == b"PK\x03\x04" or head[:6] == b"ARROW1" or head[:4] == b"FEA1":
+        with open(path, "rb") as file:
+            yield read_data(file.read(), kind, data_format)
+        return
+    yield from _iter_text(lambda: open(path, "rb"), kind, data_format, chunk_rows)
+
+
+def parse_data(buffer, kind, data_format=None, digest=None, subjects=None):
+    """Parses the file content of the TLFB ("tlfb"), biochemical ("bio") or visit ("visit") data.
+
+    With subjects, only their rows are kept, and the digest covers the subjects as well as the content.
+
+    Returns
+    -------
+    ParsedUpload
+        The parsed frame with its digest, and the subjects and visits found in the data.
+
+    """
+    df = read_data(buffer, kind, data_format, subjects)
+    found_subjects, visits = list(), list()
+    if kind == "tlfb":
+        found_subjects = sorted(ac.TLFBData(df.copy()).subject_ids)
+    elif kind == "visit":
+        visit_data = ac.VisitData(df.copy(), data_format)
+        found_subjects = sorted(visit_data.subject_ids)
+        visits = sorted(visit_data.visits)
+    digest = digest or file_digest(buffer)
+    if subjects is not None:
+        digest = file_digest(f"{digest}:{sorted(subjects)!r}".encode())
+    return ParsedUpload(digest, df, found_subjects, visits, int(df.memory_usage(deep=True).sum()))
+
+
+def parse_file(path, kind, data_format=None, subjects=None):
+    with open(path, "rb") as file:
+        return parse_data(file.read(), kind, data_format, subjects=subjects)
+
+
+def merge_uploads(sites, parsed_uploads, kind, data_format=None, digest=None):
+    """Merges the parsed files of the sites into one upload whose rows are tagged with their sites.
+
+    The rows are kept as they are, so the records of the same subject and day (or visit) in several files are left to
+    the duplicate handling of the processing. The columns whose types differ between the files are converted again.
+
+    Returns
+    -------
+    ParsedUpload
+        The merged frame with the site column, and the subjects and visits found in any of the files.
+
+    """
+    site_names = list(OrderedDict.fromkeys(sites))
+    frames = [decode(x.data) for x in parsed_uploads]
+    site_codes = np.repeat([site_names.index(x) for x in sites], [len(x) for x in frames])
+    df = pd.concat(frames, ignore_index=True)
+    df[SITE_COLUMN] = pd.Categorical.from_codes(site_codes, categories=site_names)
+    df = _convert_types(df, kind, data_format)
+    subjects = sorted(set().union(*[x.subjects for x in parsed_uploads]))
+    visits = sorted(set().union(*[x.visits for x in parsed_uploads]))
+    digest = digest or file_digest(repr([(site, x.digest) for site, x in zip(sites, parsed_uploads)]).encode())
+    return ParsedUpload(digest, df, subjects, visits, int(df.memory_usage(deep=True).sum()))
+
+
+def profile_sites(df, kind, data_format=None):
+    """Summarizes the rows of each site of a merged multi-site upload.
+
+    The duplicates are the records of the same subject and day (or visit) within the site, and the cross-site
+    duplicates are the records of the site whose subject and day (or visit) another site has as well.
+
+    Returns
+    -------
+    DataFrame
+        The record, subject, missing value and duplicate counts, and the date range of each site.
+
+    """
+    if kind == "visit" and data_format == "wide":
+        df = df.melt(id_vars=["id", SITE_COLUMN], var_name="visit", value_name="date")
+    keys = ["id", "visit"] if kind == "visit" else ["id", "date"]
+    sites = df[SITE_COLUMN].astype(str)
+    site_keys = df[keys].assign(site=sites.values).drop_duplicates()
+    subject_sites = df[["id"]].assign(site=sites.values).drop_duplicates()
+    # A key or subject is shared when it's found in more than one site
+    shared_keys = site_keys.duplicated(keys, keep=False)
+    shared_subjects = subject_sites.duplicated("id", keep=False)
+    cross_site = df[keys].merge(site_keys.loc[shared_keys, keys].drop_duplicates(), how="left", on=keys,
+                                indicator=True)["_merge"].values == "both"
+    profile_df = pd.DataFrame({
+        "record_count": sites.value_counts(),
+        "subject_count": subject_sites["site"].value_counts(),
+        "missing_value_count": df.drop(columns=SITE_COLUMN).isna().any(axis=1).groupby(sites.values).sum(),
+        "duplicate_count": df.duplicated(keys + [SITE_COLUMN], keep=False).groupby(sites.values).sum(),
+        "cross_site_duplicate_count": pd.Series(cross_site).groupby(sites.values).sum(),
+        "shared_subject_count": shared_subjects.groupby(subject_sites["site"].values).sum(),
+        "min_date": df["date"].groupby(sites.values).min(),
+        "max_date": df["date"].groupby(sites.values).max()
+    })
+    profile_df.index.name = SITE_COLUMN
+    return profile_df.reindex(sites.unique())
+
+
+class UploadCache(object):
+    def __init__(self, max_bytes=512 * 1024 ** 2):
+        """A cache of parsed uploads keyed on the file content digest and the parsing parameters.
+
+        The cached uploads hold their frames in the compact encoding (see CompactFrame), which the callers decode
+        with compact.decode, and which the pipeline decodes when it loads the data.
+
+        Parameters
+        ----------
+        max_bytes : int
+            The memory budget of the cached frames. The least recently used entries are evicted when it's exceeded.
+
+        """
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        with self._lock:
+            if key in self._entries:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return self._entries[key]
+            self.misses += 1
+        return None
+
+    def _put(self, key, parsed):
+        frame = CompactFrame(parsed.data)
+        parsed = parsed._replace(data=frame, nbytes=frame.nbytes)
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = parsed
+                self.current_bytes += parsed.nbytes
+            self._evict()
+        return parsed
+
+    def load(self, buffer, kind, data_format=None):
+        """Gets the parsed upload, parsing the file only when the same content hasn't been seen.
+
+        The returned upload is shared among all the callers, and its frame is decoded into a new copy.
+        """
+        buffer = bytes(buffer)
+        key = (kind, file_digest(buffer), data_format)
+        parsed = self._get(key)
+        if parsed is None:
+            parsed = self._put(key, parse_data(buffer, kind, data_format, key[1]))
+        return parsed
+
+    def load_sites(self, site_files, kind, data_format=None, diagnostics=None):
+        """Gets the merged upload of the files of a multi-site study, parsing the files in parallel.
+
+        Each file is parsed and cached the same as by load, and the merged upload is cached as well, keyed on the
+        sites and the contents of all the files. A single file is loaded as it is, without the site column.
+
+        Parameters
+        ----------
+        site_files : list
+            The SiteFile of each file.
+        kind : str
+            "tlfb", "bio" or "visit".
+        data_format : str
+            The visit data format, "long" or "wide".
+        diagnostics : Diagnostics
+            The session's diagnostics, which record the loading of each file as a step, or None.
+
+        Returns
+        -------
+        ParsedUpload
+            The merged upload, as returned by merge_uploads.
+
+        """
+        if len(site_files) == 1:
+            return self.load(site_files[0].buffer, kind, data_format)
+        sites = [x.site for x in site_files]
+        buffers = [bytes(x.buffer) for x in site_files]
+        digest = file_digest(repr([(site, file_digest(x)) for site, x in zip(sites, buffers)]).encode())
+        key = (kind, digest, data_format)
+        parsed = self._get(key)
+        if parsed is not None:
+            return parsed
+
+        def load_site(site, buffer):
+            with measure(diagnostics, "upload", f"{kind} ({site})") as measured:
+                site_parsed = self.load(buffer, kind, data_format)
+                measured["data_out"] = site_parsed.data
+            return site_parsed
+
+        with ThreadPoolExecutor(max_workers=max(1, min(len(buffers), _PARSE_WORKERS))) as executor:
+            parsed_uploads = list(executor.map(load_site, sites, buffers))
+        return self._put(key, merge_uploads(sites, parsed_uploads, kind, data_format, digest))
+
+    def _evict(self):
+        while self.current_bytes > self.max_bytes and len(self._entries) > 1:
+            _, parsed = self._entries.popitem(last=False)
+            self.current_bytes -= parsed.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes
+            }
+
+
+# Imported modules outlive the reruns of the app script, so a single cache is shared by all sessions
+upload_cache = UploadCache()
@@ -0,0 +1,127 @@
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+PENDING, RUNNING, DONE, FAILED, CANCELLED = "pending", "running", "done", "failed", "cancelled"
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job(object):
+    def __init__(self, name, signature):
+        """A computation run by the JobManager, with its progress, its result or error, and a cancellation flag.
+
+        The computation receives the job's report method as its progress callback. Cancellation is cooperative:
+        the flag is checked whenever progress is reported, which is between the stages of the pipeline.
+        """
+        self.name = name
+        self.signature = signature
+        self.status = PENDING
+        self.stage = "waiting for a worker"
+        self.progress = 0.0
+        self.result = None
+        self.error = None
+        self._cancelled = threading.Event()
+        self._finished = threading.Event()
+
+    def report(self, stage, finished, total):
+        if self._cancelled.is_set():
+            raise JobCancelled()
+        self.stage = stage
+        self.progress = finished / total if total else 0.0
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def done(self):
+        return self._finished.is_set()
+
+    def wait(self, timeout=None):
+        return self._finished.wait(timeout)
+
+    def _run(self, func, args):
+        try:
+            self.report(self.stage, 0, 1)
+            self.status = RUNNING
+            self.result = func(*args, progress=self.report)
+            self.status, self.progress = DONE, 1.0
+        except JobCancelled:
+            self.status = CANCELLED
+        except Exception as e:
+            self.error = e
+            self.status = FAILED
+        finally:
+            self._finished.set()
+
+
+class JobManager(object):
+    def __init__(self, max_workers=None, max_owners=256):
+        """Runs the heavy computations of the sessions in a bounded pool of worker threads.
+
+        Each owner, usually a session, has at most one job of each name. A job outlives the reruns of its session's
+        script, so a rerun picks up the running or finished job instead of starting over, and a widget change no
+        longer interrupts the computation.
+
+        Parameters
+        ----------
+        max_workers : int
+            The number of worker threads, by default the number of CPUs up to four.
+        max_owners : int
+            The number of owners whose jobs are kept. The jobs of the least recently active owners are cancelled
+            and dropped beyond it.
+
+        """
+        self.max_owners = max_owners
+        self._executor = ThreadPoolExecutor(max_workers=max_workers or min(4, os.cpu_count() or 1))
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, owner, name):
+        with self._lock:
+            return self._jobs.get(owner, dict()).get(name)
+
+    def submit(self, owner, name, signature, func, *args, restart=False):
+        """Gets the owner's job of the name, starting a new job unless the current one has the same signature.
+
+        A cancelled or failed job of the same signature is kept, so it's reported rather than retried on every
+        rerun, until restart asks for a new run. A job with a different signature is cancelled and replaced.
+        """
+        with self._lock:
+            owner_jobs = self._jobs.pop(owner, dict())
+            self._jobs[owner] = owner_jobs
+            job = owner_jobs.get(name)
+            if job is not None and job.signature == signature and not (restart and job.status in (FAILED, CANCELLED)):
+                return job
+            if job is not None:
+                job.cancel()
+            job = owner_jobs[name] = Job(name, signature)
+            while len(self._jobs) > self.max_owners:
+                _, evicted_jobs = self._jobs.popitem(last=False)
+                for evicted_job in evicted_jobs.values():
+                    evicted_job.cancel()
+        self._executor.submit(job._run, func, args)
+        return job
+
+    def has_running(self, owner):
+        """Whether any job of the owner is still waiting or running, and may write to the owner's state."""
+        with self._lock:
+            return any(not job.done() for job in self._jobs.get(owner, dict()).values())
+
+    def discard(self, owner):
+        with self._lock:
+            owner_jobs = self._jobs.pop(owner, dict())
+        for job in owner_jobs.values():
+            job.cancel()
+
+    def stats(self):
+        with self._lock:
+            jobs = [job for owner_jobs in self._jobs.values() for job in owner_jobs.values()]
+        return {status: sum(job.status == status for job in jobs) for status in (PENDING, RUNNING, DONE, FAILED,
+                                                                                 CANCELLED)}
+
+
+# Imported modules outlive the reruns of the app script, so a single pool serves all sessions
+job_manager = JobManager()
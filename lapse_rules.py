@@ -0,0 +1,285 @@
+import re
+from collections import namedtuple
+import numpy as np
+import pandas as pd
+from usage_index import UsageIndex
+from visit_engine import VisitDateIndex
+
+# The amount, the unit, and optionally the window in days, such as "5 cigs", "2 days" or "5 cigs/14 days"
+_DEFINITION_PATTERN = re.compile(r"^(\d+(?:\.\d+)?)\s+([A-Za-z]+)(?:\s*/\s*(\d+)\s+days?)?$")
+
+# A lapse definition compiled for the evaluator. The threshold is None when no lapse is allowed, counts_days is whether
+# the use days rather than the amounts are counted, and window is None for the total since the end of the grace period.
+LapseRule = namedtuple("LapseRule", ["definition", "threshold", "counts_days", "window"])
+
+
+def _parse_definition(definition):
+    if definition is False or str(definition).strip().lower() == "false":
+        return LapseRule(False, None, False, None)
+    match = _DEFINITION_PATTERN.match(str(definition).strip())
+    if match is None:
+        raise ValueError(f"The lapse definition {definition!r} isn't valid. It should be False, an amount with a unit "
+                         f"such as '5 cigs' or '2 days', or either of them over a window such as '5 cigs/14 days'.")
+    amount, unit, window = match.groups()
+    if float(amount) <= 0:
+        raise ValueError(f"The amount of the lapse definition {definition!r} should be greater than zero.")
+    if window is not None and int(window) <= 0:
+        raise ValueError(f"The window of the lapse definition {definition!r} should be at least one day.")
+    # The singular "day" counts the use days too, rather than being taken for an amount's unit
+    unit = "days" if unit.lower() in ("day", "days") else unit
+    text = f"{amount} {unit}" if window is None else f"{amount} {unit}/{window} days"
+    return LapseRule(text, float(amount), unit == "days", None if window is None else int(window))
+
+
+def compile_lapse_rules(lapse_definitions):
+    """Compiles the lapse definitions, False or the definition strings, into LapseRule objects.
+
+    The definition strings are normalized, so the abstinence names follow the same spelling however they're typed.
+    """
+    if not isinstance(lapse_definitions, (list, tuple)):
+        lapse_definitions = [lapse_definitions]
+    return [_parse_definition(x) for x in lapse_definitions]
+
+
+def parse_lapse_definitions(text):
+    """Parses the comma-separated lapse definitions typed in the app, such as "False, '5 cigs', '5 cigs/14 days'".
+
+    Returns
+    -------
+    list
+        The normalized definitions, False or the definition strings.
+
+    """
+    items = [x.strip().strip("'\"").strip() for x in text.split(",")]
+    return [rule.definition for rule in compile_lapse_rules([x for x in items if x])]
+
+
+def _abst_names(visits, abst_var_names, prefix):
+    if abst_var_names == "infer":
+        return [f"{prefix}_v{visit}" for visit in visits]
+    abst_names = list(abst_var_names) if isinstance(abst_var_names, (list, tuple)) else [abst_var_names]
+    if len(abst_names) != len(visits):
+        raise ValueError("The number of abstinence variable names should match the number of visits.")
+    return abst_names
+
+
+def _by_subject(arrays, subject_count, visit_count, dtype):
+    if not arrays:
+        return np.zeros((subject_count, 0), dtype=dtype)
+    return np.stack([x.reshape(subject_count, visit_count) for x in arrays], axis=1).\
+        reshape(subject_count, len(arrays) * visit_count)
+
+
+def abstinence_prolonged(tlfb_data, visit_data, quit_visit, visits, lapse_definitions, grace_period=14,
+                         abst_var_names="infer", including_end=False, mode="itt", usage_index=None,
+                         visit_index=None):
+    """Calculates the prolonged abstinence of all the lapse definitions in one pass, the same as abstcal's.
+
+    abstcal scans each subject's records for each definition and end visit. Here the windows of all the subjects and
+    visits are laid over the usage index's daily arrays, and each compiled definition is a few array operations over
+    them, so additional definitions cost little. Windows with missing visit dates are scored as invalid, including the
+    responders-only visits that were imputed.
+
+    Parameters
+    ----------
+    tlfb_data : TLFBData
+        The processed TLFB data.
+    visit_data : VisitData
+        The processed visit data.
+    quit_visit : object
+        The visit of the quit date, which the grace period follows.
+    visits : list
+        The end visits of the windows.
+    lapse_definitions : list
+        The lapse definitions, False or the definition strings, or a single definition.
+    grace_period : int
+        The number of days after the quit date before the lapses are counted.
+    abst_var_names : object
+        "infer" or the names of the abstinence variables of each definition.
+    including_end : bool
+        Whether the end visit date is included in the windows.
+    mode : str
+        "itt" for intent-to-treat or "ro" for responders-only.
+    usage_index : UsageIndex
+        The index of the TLFB data, which is built when it's None.
+    visit_index : VisitDateIndex
+        The index of the visit dates, which is built when it's None.
+
+    Returns
+    -------
+    tuple
+        The abstinence data indexed by the subject ids and the lapse data, formatted the same as abstcal's.
+
+    """
+    visits = list(visits) if isinstance(visits, (list, tuple)) else [visits]
+    visit_data.validate_visits([quit_visit, *visits])
+    rules = compile_lapse_rules(lapse_definitions)
+    abst_names = list()
+    for rule in rules:
+        formatted_definition = rule.definition.replace(" ", "_") if rule.definition else rule.definition
+        abst_names.extend(_abst_names(visits, abst_var_names, f"{mode}_prolonged_{formatted_definition}"))
+
+    if usage_index is None:
+        usage_index = UsageIndex(tlfb_data.data, tlfb_data.abst_cutoff)
+    subject_ids = np.array(sorted(tlfb_data.subject_ids & visit_data.subject_ids))
+    if visit_index is None:
+        visit_index = VisitDateIndex(visit_data.data)
+    visit_dates = visit_index.lookup(subject_ids, [quit_visit, *visits], "itt" if mode == "itt" else "ro")
+    start_dates = visit_dates[:, 0] + np.timedelta64(int(grace_period), "D")
+    end_dates = visit_dates[:, 1:] + np.timedelta64(int(including_end), "D")
+    rule_results = usage_index.lapses(np.repeat(subject_ids, len(visits)), np.repeat(start_dates, len(visits)),
+                                      end_dates.ravel(), rules, mode)
+
+    # The results are laid out by subject, then definition and visit, the same as abstcal's columns and lapses
+    subject_count = len(subject_ids)
+    scores = _by_subject([x[0] for x in rule_results], subject_count, len(visits), float)
+    dates = _by_subject([x[1] for x in rule_results], subject_count, len(visits), "datetime64[D]")
+    amounts = _by_subject([x[2] for x in rule_results], subject_count, len(visits), float)
+    return _abstinence_frames(subject_ids, abst_names, scores, dates, amounts)
+
+
+def _abstinence_frames(subject_ids, abst_names, scores, dates, amounts):
+    # The scores, the lapse dates and the lapse amounts are subject x abstinence name matrices
+    subject_count = len(subject_ids)
+    # The scores are integers unless some of them are missing, as in abstcal's frame of mixed values
+    columns = [x if not subject_count or np.isnan(x).any() else x.astype(int) for x in scores.T]
+    abst_df = pd.DataFrame(dict(enumerate(columns)), index=pd.Index(subject_ids, name="id"))
+    abst_df.columns = abst_names
+
+    # abstcal's index of the lapses is their order of collection, which its sort keeps, and without any lapse its
+    # frame has no rows to infer the column types from
+    found = ~np.isnat(dates)
+    if not found.any():
+        return abst_df, pd.DataFrame([], columns=["id", "date", "amount", "abst_name"])
+    lapse_df = pd.DataFrame({
+        "id": np.repeat(subject_ids, len(abst_names))[found.ravel()],
+        "date": pd.to_datetime(dates[found]),
+        "amount": amounts[found],
+        "abst_name": np.tile(np.array(abst_names, dtype=object), subject_count)[found.ravel()]
+    }).sort_values(by=["abst_name", "id", "date"])
+    return abst_df, lapse_df
+
+
+def _first_lapses(usage_index, subject_ids, start_dates, end_dates, scores, mode):
+    # abstcal's lapse is the first use day of the window, which is kept for any valid window in the intent-to-treat
+    # mode, and only for the complete windows, the ones scored 0, in the responders-only mode
+    dates, amounts = usage_index.first_use(subject_ids, start_dates, end_dates, mode)
+    if mode == "itt":
+        found = ~np.isnat(dates) & ~np.isnat(start_dates) & ~np.isnat(end_dates) & (start_dates < end_dates)
+    else:
+        found = scores == 0
+    return np.where(found, dates, np.datetime64("NaT")), np.where(found, amounts, np.nan)
+
+
+def abstinence_pp(tlfb_data, visit_data, visits, days, abst_var_names="infer", including_end=False, mode="itt",
+                  usage_index=None, visit_index=None):
+    """Calculates the point-prevalence abstinence of all the subjects, visits and days at once, the same as abstcal's.
+
+    The windows preceding the visit dates are scored by the usage index's point_prevalence, and their lapses are the
+    first use days of the windows. The missing visit dates, including the responders-only visits that were imputed,
+    give invalid windows.
+
+    Parameters
+    ----------
+    tlfb_data : TLFBData
+        The processed TLFB data.
+    visit_data : VisitData
+        The processed visit data.
+    visits : list
+        The end visits of the windows.
+    days : list
+        The numbers of the days preceding the end visits, or a single number.
+    abst_var_names : object
+        "infer" or the names of the abstinence variables of the visits, which are used for each number of days.
+    including_end : bool
+        Whether the end visit date is included in the windows.
+    mode : str
+        "itt" for intent-to-treat or "ro" for responders-only.
+    usage_index : UsageIndex
+        The index of the TLFB data, which is built when it's None.
+    visit_index : VisitDateIndex
+        The index of the visit dates, which is built when it's None.
+
+    Returns
+    -------
+    tuple
+        The abstinence data indexed by the subject ids and the lapse data, formatted the same as abstcal's.
+
+    """
+    visits = list(visits) if isinstance(visits, (list, tuple)) else [visits]
+    days = list(days) if isinstance(days, (list, tuple)) else [days]
+    visit_data.validate_visits(visits)
+    abst_names = [name for day in days for name in _abst_names(visits, abst_var_names, f"{mode}_pp{day}")]
+
+    if usage_index is None:
+        usage_index = UsageIndex(tlfb_data.data, tlfb_data.abst_cutoff)
+    subject_ids = np.array(sorted(tlfb_data.subject_ids & visit_data.subject_ids))
+    if visit_index is None:
+        visit_index = VisitDateIndex(visit_data.data)
+    visit_dates = visit_index.lookup(subject_ids, visits, "itt" if mode == "itt" else "ro")
+    # The visits are numbered, so the same visit listed twice keeps its own columns
+    scores = usage_index.point_prevalence(pd.DataFrame(visit_dates, index=subject_ids), days, including_end,
+                                          mode).values
+
+    # The windows are laid out by subject, then number of days and visit, the same as the columns of the scores
+    end_dates = np.tile(visit_dates + np.timedelta64(int(including_end), "D"), len(days))
+    start_dates = end_dates - np.repeat(np.array(days, dtype="timedelta64[D]"), len(visits))
+    dates, amounts = _first_lapses(usage_index, np.repeat(subject_ids, len(abst_names)), start_dates.ravel(),
+                                   end_dates.ravel(), scores.ravel(), mode)
+    return _abstinence_frames(subject_ids, abst_names, scores, dates.reshape(scores.shape),
+                              amounts.reshape(scores.shape))
+
+
+def abstinence_cont(tlfb_data, visit_data, start_visit, visits, abst_var_names="infer", including_end=False,
+                    mode="itt", usage_index=None, visit_index=None):
+    """Calculates the continuous abstinence of all the subjects and visits at once, the same as abstcal's.
+
+    The windows from the start visit to each end visit are scored by the usage index's abstinent, and their lapses are
+    the first use days of the windows. The missing visit dates, including the responders-only visits that were
+    imputed, give invalid windows.
+
+    Parameters
+    ----------
+    tlfb_data : TLFBData
+        The processed TLFB data.
+    visit_data : VisitData
+        The processed visit data.
+    start_visit : object
+        The visit where the windows start.
+    visits : list
+        The end visits of the windows.
+    abst_var_names : object
+        "infer" or the names of the abstinence variables of the visits.
+    including_end : bool
+        Whether the end visit date is included in the windows.
+    mode : str
+        "itt" for intent-to-treat or "ro" for responders-only.
+    usage_index : UsageIndex
+        The index of the TLFB data, which is built when it's None.
+    visit_index : VisitDateIndex
+        The index of the visit dates, which is built when it's None.
+
+    Returns
+    -------
+    tuple
+        The abstinence data indexed by the subject ids and the lapse data, formatted the same as abstcal's.
+
+    """
+    visits = list(visits) if isinstance(visits, (list, tuple)) else [visits]
+    visit_data.validate_visits([start_visit, *visits])
+    abst_names = _abst_names(visits, abst_var_names, f"{mode}_cont_v{start_visit}")
+
+    if usage_index is None:
+        usage_index = UsageIndex(tlfb_data.data, tlfb_data.abst_cutoff)
+    subject_ids = np.array(sorted(tlfb_data.subject_ids & visit_data.subject_ids))
+    if visit_index is None:
+        visit_index = VisitDateIndex(visit_data.data)
+    visit_dates = visit_index.lookup(subject_ids, [start_visit, *visits], "itt" if mode == "itt" else "ro")
+    start_dates = np.repeat(visit_dates[:, 0], len(visits))
+    end_dates = (visit_dates[:, 1:] + np.timedelta64(int(including_end), "D")).ravel()
+    window_ids = np.repeat(subject_ids, len(visits))
+    scores = usage_index.abstinent(window_ids, start_dates, end_dates, mode)
+    dates, amounts = _first_lapses(usage_index, window_ids, start_dates, end_dates, scores, mode)
+    shape = (len(subject_ids), len(visits))
+    return _abstinence_frames(subject_ids, abst_names, scores.reshape(shape), dates.reshape(shape),
+                              amounts.reshape(shape))
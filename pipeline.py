@@ -0,0 +1,675 @@
+import copy
+import functools
+import hashlib
+import sys
+import threading
+import types
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import abstcal as ac
+import numpy as np
+import pandas as pd
+import compact
+import ingestion
+import lapse_rules
+import tlfb_engine
+import usage_index
+import visit_engine
+from compact import CompactData, CompactFrame, decode
+from diagnostics import measure
+from disk_cache import StoredData, disk_cache
+from ingestion import drop_sites, select_subjects
+from lapse_rules import abstinence_cont, abstinence_pp, abstinence_prolonged
+from usage_index import UsageIndex
+
+tlfb_param_keys = (
+    "data",
+    "data_digest",
+    "cutoff",
+    "subjects",
+    "duplicate_mode",
+    "imputation_last_record",
+    "imputation_mode",
+    "imputation_gap_limit",
+    "outliers_mode",
+    "allowed_min",
+    "allowed_max"
+)
+visit_param_keys = (
+    "data",
+    "data_digest",
+    "data_format",
+    "expected_visits",
+    "subjects",
+    "duplicate_mode",
+    "imputation_mode",
+    "anchor_visit",
+    "allowed_min",
+    "allowed_max",
+    "outliers_mode"
+)
+bio_param_keys = (
+    "data",
+    "data_digest",
+    "cutoff",
+    "overridden_amount",
+    "duplicate_mode",
+    "imputation_mode",
+    "allowed_min",
+    "allowed_max",
+    "outliers_mode",
+    "enable_interpolation",
+    "half_life",
+    "days_interpolation"
+)
+
+
+class PipelineContext(object):
+    def __init__(self):
+        """The configuration and the processed data of one session's pipeline.
+
+        Each session owns its context, so concurrent sessions served by the same process never share any parameters.
+        The parameters are rebuilt from the widgets on every run with new_run, while the processed data are kept.
+        """
+        self.tlfb_data = None
+        self.tlfb_index = None
+        self.visit_data = None
+        self.visit_index = None
+        # The stage result keys of the processed data, which fingerprint them for the cached calculations
+        self.tlfb_key = None
+        self.visit_key = None
+        # The session's Diagnostics, which are None unless they're turned on
+        self.diagnostics = None
+        self.new_run()
+
+    def new_run(self):
+        self.tlfb_data_params = dict.fromkeys(tlfb_param_keys)
+        self.visit_data_params = dict.fromkeys(visit_param_keys)
+        self.bio_data_params = dict.fromkeys(bio_param_keys)
+        self.abst_pp_params = dict()
+        self.abst_cont_params = dict()
+        self.abst_prol_params = dict()
+        self.abst_params_shared = dict()
+
+    def reset_data(self):
+        self.tlfb_data = None
+        self.tlfb_index = None
+        self.visit_data = None
+        self.visit_index = None
+        self.tlfb_key = None
+        self.visit_key = None
+
+
+# A processing step. The stage transforms the data of its upstream stage (or the raw frame for the root stage) and
+# only the parameters listed in param_keys are part of its fingerprint, so changing any other parameter reuses it.
+Stage = namedtuple("Stage", ["name", "upstream", "param_keys", "func", "mutates"])
+StageResult = namedtuple("StageResult", ["key", "data", "output", "nbytes"])
+
+
+def _fingerprint(*parts):
+    return hashlib.sha256(repr(parts).encode()).hexdigest()
+
+
+def _param_token(value):
+    if isinstance(value, StageResult):
+        return value.key
+    return value
+
+
+def params_signature(*data_params):
+    """Fingerprints the parameters of a run, using the digests of the uploaded data in place of the data."""
+    return _fingerprint(*[sorted((key, _param_token(value)) for key, value in params.items() if key != "data")
+                          for params in data_params])
+
+
+def _data_nbytes(data):
+    df = getattr(data, "data", None)
+    if df is None:
+        return 0
+    return int(df.memory_usage(deep=True).sum())
+
+
+class StageCache(object):
+    def __init__(self, max_bytes=1024 ** 3):
+        """A cache of stage results keyed on the upstream fingerprint and the stage parameters.
+
+        Parameters
+        ----------
+        max_bytes : int
+            The memory budget of the cached data. The least recently used results are evicted when it's exceeded.
+
+        """
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            result = self._entries.get(key)
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+            return result
+
+    def put(self, result):
+        with self._lock:
+            if result.key not in self._entries:
+                self._entries[result.key] = result
+                self.current_bytes += result.nbytes
+            while self.current_bytes > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self.current_bytes -= evicted.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+
+stage_cache = StageCache()
+
+
+def _code_parts(code):
+    # The bytecode, names and constants, leaving out the file names and line numbers that don't change the results.
+    # The frozensets of the membership tests are sorted, as their order changes with the hash seed.
+    parts = [code.co_code, code.co_names]
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            parts.append(_code_parts(const))
+        elif isinstance(const, frozenset):
+            parts.append(sorted(repr(x) for x in const))
+        else:
+            parts.append(repr(const))
+    return parts
+
+
+def _module_code(module):
+    parts = list()
+    for name, value in sorted(vars(module).items()):
+        if isinstance(value, type) and value.__module__ == module.__name__:
+            members = sorted(vars(value).items())
+        else:
+            members = [(None, value)]
+        for member_name, member in members:
+            member = getattr(member, "fget", None) or getattr(member, "__func__", member)
+            if isinstance(member, types.FunctionType) and member.__module__ == module.__name__:
+                parts.append((name, member_name, _code_parts(member.__code__)))
+            elif member_name is None and isinstance(member, (bool, int, float, str)) and not name.startswith("__"):
+                parts.append((name, repr(member)))
+    return parts
+
+
+@functools.lru_cache(maxsize=None)
+def _code_version():
+    """Fingerprints the code that computes the stored results and the versions of the libraries it runs on.
+
+    Any change of the functions or the constants of these modules gives new stored keys, so the results persisted by
+    earlier code are never reused after a deployment.
+    """
+    modules = (sys.modules[__name__], compact, ingestion, lapse_rules, tlfb_engine, usage_index, visit_engine)
+    return _fingerprint([_module_code(x) for x in modules], ac.__version__, pd.__version__, np.__version__)
+
+
+def _stored_key(key):
+    return _fingerprint(key, _code_version())
+
+
+def _load_stored_result(key, upstream_data, lazy, compacted):
+    meta = disk_cache.get(_stored_key(key))
+    if meta is None:
+        return None
+    if "data_class" not in meta:
+        return StageResult(key, upstream_data, meta["output"], int(getattr(meta["output"], "nbytes", 0)))
+    data = StoredData(meta["data_class"], meta["attributes"], disk_cache, _stored_key(key))
+    if lazy:
+        return StageResult(key, data, meta["output"], data.nbytes)
+    data = data.restore()
+    if compacted:
+        data = CompactData(data)
+        return StageResult(key, data, meta["output"], data.nbytes)
+    return StageResult(key, data, meta["output"], _data_nbytes(data))
+
+
+def _store_result(key, data, output, mutates):
+    if not mutates:
+        disk_cache.put(_stored_key(key), dict(), {"output": output})
+        return
+    attributes = {name: value for name, value in vars(data).items() if name != "data"}
+    disk_cache.put(_stored_key(key), {"data": data.data},
+                   {"data_class": type(data), "attributes": attributes, "output": output})
+
+
+def run_stages(stages, source, source_key, data_params, cache=stage_cache, progress=None, diagnostics=None,
+               step=None):
+    """Runs the stage graph, reusing any stage whose upstream fingerprint and parameters have been seen.
+
+    Cached data are shared, so a mutating stage always works on a copy of its upstream data. The data of the mutating
+    stages are cached in the compact encoding (see CompactData), which is decoded into a fresh copy when a downstream
+    stage has to be recomputed, and which the callers decode with compact.decode. A source held as a CompactFrame,
+    such as a cached upload, is decoded for the root stage.
+
+    The results are also persisted in the disk cache, which outlives the process. A stage found there is read back
+    and compacted, except that the data of the stages that only feed other mutating stages are read only when a
+    downstream stage has to be recomputed.
+
+    Parameters
+    ----------
+    stages : tuple
+        The stages in topological order.
+    source : any
+        The input to the root stage, usually the uploaded frame.
+    source_key : str
+        The fingerprint of the source, such as the upload digest.
+    data_params : dict
+        The parameters, from which each stage takes the ones in its param_keys.
+    cache : StageCache
+        The cache of the stage results. Without a cache, the data are neither copied nor compacted, and each mutating
+        stage modifies its upstream data in place, so only the data of the last stage are meaningful.
+    progress : callable
+        Called with the stage name, the number of the finished stages and the number of all the stages before each
+        stage runs. It may raise an exception to stop the run, such as when its job is cancelled.
+    diagnostics : Diagnostics
+        Records each stage, whether it's computed or cached, under the step name.
+    step : str
+        The name of the stage graph in the diagnostics, such as "TLFB".
+
+    Returns
+    -------
+    dict
+        The StageResult of each stage by the stage name.
+
+    """
+    compacted = set() if cache is None else {stage.name for stage in stages if stage.mutates}
+    feeding = {stage.upstream for stage in stages if stage.mutates and stage.upstream is not None}
+    results = dict()
+    for i, stage in enumerate(stages):
+        if progress is not None:
+            progress(stage.name, i, len(stages))
+        if stage.upstream is None:
+            upstream_key, upstream_data = source_key, source
+        else:
+            upstream = results[stage.upstream]
+            upstream_key, upstream_data = upstream.key, upstream.data
+        with measure(diagnostics, step, stage.name, upstream_data) as measured:
+            params = {key: data_params.get(key) for key in stage.param_keys}
+            key = _fingerprint(upstream_key, stage.name, sorted((k, _param_token(v)) for k, v in params.items()))
+            result = None if cache is None else cache.get(key)
+            measured["source"] = "memory cache"
+            if result is None and cache is not None:
+                result = _load_stored_result(key, upstream_data, stage.name in feeding, stage.name in compacted)
+                measured["source"] = "disk cache"
+                if result is not None and not isinstance(result.data, StoredData):
+                    cache.put(result)
+            if result is None:
+                measured["source"] = "computed"
+                if isinstance(upstream_data, CompactFrame):
+                    data = upstream_data.to_frame()
+                elif isinstance(upstream_data, (CompactData, StoredData)):
+                    data = upstream_data.restore()
+                elif stage.mutates and stage.upstream is not None and cache is not None:
+                    data = copy.deepcopy(upstream_data)
+                else:
+                    data = upstream_data
+                data, output = stage.func(data, params)
+                if cache is not None:
+                    _store_result(key, data, output, stage.mutates)
+                if stage.name in compacted:
+                    data = CompactData(data)
+                    nbytes = data.nbytes
+                else:
+                    nbytes = _data_nbytes(data) if stage.mutates else int(getattr(output, "nbytes", 0))
+                result = StageResult(key, data, output, nbytes)
+                if cache is not None:
+                    cache.put(result)
+            measured["data_out"] = result.data
+        results[stage.name] = result
+    return results
+
+
+# The subjects are selected before the frames are copied and validated, so the loading and every later stage only
+# work on the rows of the analysed subjects. The site tags of a multi-site upload aren't columns abstcal accepts.
+def _load_tlfb(df, params):
+    return ac.TLFBData(drop_sites(select_subjects(df, params["subjects"])), params["cutoff"]), None
+
+
+def _load_bio(df, params):
+    return ac.TLFBData(drop_sites(select_subjects(df, params["subjects"])), params["cutoff"]), None
+
+
+def _load_visit(df, params):
+    df = drop_sites(select_subjects(df, params["subjects"]))
+    if params["data_format"] == "wide":
+        df = visit_engine.to_long(df)
+    return ac.VisitData(df, "long", params["expected_visits"]), None
+
+
+def _profile(data, params):
+    return data, data.profile_data(params["allowed_min"], params["allowed_max"])
+
+
+def _drop_na(data, params):
+    return data, data.drop_na_records()
+
+
+def _check_duplicates(data, params):
+    if "duplicate_mode" in params:
+        return data, data.check_duplicates(params["duplicate_mode"])
+    return data, data.check_duplicates()
+
+
+def _recode_outliers(data, params):
+    if params["outliers_mode"] is None:
+        return data, None
+    return data, data.recode_outliers(params["allowed_min"], params["allowed_max"], params["outliers_mode"])
+
+
+def _interpolate_bio(data, params):
+    if params["enable_interpolation"]:
+        tlfb_engine.interpolate_biochemical_data(data, params["half_life"], params["days_interpolation"])
+    return data, None
+
+
+def _impute_tlfb(data, params):
+    if params["imputation_mode"] is None:
+        return data, None
+    imputation_params = [params["imputation_mode"], params["imputation_last_record"], params["imputation_gap_limit"]]
+    if params["bio_data"] is not None:
+        imputation_params.extend((decode(params["bio_data"].data), str(params["overridden_amount"])))
+    return data, tlfb_engine.impute_data(data, *imputation_params)
+
+
+def _build_index(data, params):
+    return data, UsageIndex(data.data, params["cutoff"])
+
+
+def _impute_visit(data, params):
+    if params["imputation_mode"] is None:
+        return data, None
+    return data, visit_engine.impute_data(data, params["anchor_visit"], params["imputation_mode"])
+
+
+def _retention(data, params):
+    return data, visit_engine.retention_rates(data)
+
+
+def _build_visit_index(data, params):
+    return data, visit_engine.VisitDateIndex(data.data)
+
+
+_summary_stages = (
+    Stage("profile", "load", ("allowed_min", "allowed_max"), _profile, False),
+    Stage("drop_na", "load", (), _drop_na, True),
+    Stage("duplicates", "drop_na", ("duplicate_mode",), _check_duplicates, True),
+    Stage("outliers", "duplicates", ("outliers_mode", "allowed_min", "allowed_max"), _recode_outliers, True)
+)
+
+tlfb_stages = (Stage("load", None, ("cutoff", "subjects"), _load_tlfb, True),) + _summary_stages + (
+    Stage("impute", "outliers", ("imputation_mode", "imputation_last_record", "imputation_gap_limit", "bio_data",
+                                 "overridden_amount"), _impute_tlfb, True),
+    Stage("index", "impute", ("cutoff",), _build_index, False)
+)
+
+bio_stages = (
+    Stage("load", None, ("cutoff", "subjects"), _load_bio, True),
+    Stage("interpolate", "load", ("enable_interpolation", "half_life", "days_interpolation"), _interpolate_bio, True),
+    Stage("drop_na", "interpolate", (), _drop_na, True),
+    Stage("duplicates", "drop_na", (), _check_duplicates, True)
+)
+
+visit_stages = (Stage("load", None, ("data_format", "expected_visits", "subjects"), _load_visit, True),) + \
+    _summary_stages + (
+    Stage("impute", "outliers", ("imputation_mode", "anchor_visit"), _impute_visit, True),
+    Stage("retention", "impute", (), _retention, False),
+    Stage("dates", "impute", (), _build_visit_index, False)
+)
+
+
+def _stage_params(data_params):
+    params = dict(data_params)
+    # The parameters of a disabled option don't change the outcome, so they're left out of the fingerprints
+    if params.get("imputation_mode") is None:
+        params.update(imputation_last_record=None, imputation_gap_limit=None, anchor_visit=None)
+    if not params.get("enable_interpolation"):
+        params.update(half_life=None, days_interpolation=None)
+    return params
+
+
+def _active_stages(stages, data_params):
+    # The bounds are still used by the profile, so the outliers stage drops them from its own fingerprint instead
+    if data_params.get("outliers_mode") is not None:
+        return stages
+    return tuple(stage._replace(param_keys=("outliers_mode",)) if stage.name == "outliers" else stage
+                 for stage in stages)
+
+
+def _prefixed(progress, prefix):
+    if progress is None:
+        return None
+    return lambda name, finished, total: progress(f"{prefix} {name}", finished, total)
+
+
+def process_bio_data(bio_data_params, progress=None, diagnostics=None):
+    if bio_data_params.get("data") is None:
+        return None
+    results = run_stages(bio_stages, bio_data_params["data"], bio_data_params["data_digest"],
+                         _stage_params(bio_data_params), progress=_prefixed(progress, "biochemical"),
+                         diagnostics=diagnostics, step="biochemical")
+    return results["duplicates"]
+
+
+def _bio_subjects(bio_data_params, tlfb_data_params):
+    # Only the biochemical data of the TLFB subjects are used, so the others aren't processed
+    return dict(bio_data_params, subjects=tlfb_data_params.get("subjects"))
+
+
+def process_tlfb_data(tlfb_data_params, bio_data_params, progress=None, diagnostics=None):
+    params = _stage_params(tlfb_data_params)
+    params["bio_data"] = process_bio_data(_bio_subjects(bio_data_params, tlfb_data_params), progress, diagnostics)
+    if params["bio_data"] is not None:
+        params["overridden_amount"] = bio_data_params["overridden_amount"]
+    return run_stages(_active_stages(tlfb_stages, params), tlfb_data_params["data"],
+                      tlfb_data_params["data_digest"], params, progress=_prefixed(progress, "TLFB"),
+                      diagnostics=diagnostics, step="TLFB")
+
+
+def process_tlfb_chunk(tlfb_data_params, bio_data_params):
+    """Processes one subject chunk of the TLFB and biochemical data in the out-of-core mode.
+
+    Each chunk is seen only once, so the stages bypass the cache, and the profile and index stages are skipped.
+
+    Returns
+    -------
+    dict
+        The StageResult of each stage by the stage name.
+
+    """
+    params = _stage_params(tlfb_data_params)
+    params["bio_data"] = None
+    if bio_data_params.get("data") is not None:
+        params["bio_data"] = run_stages(bio_stages, bio_data_params["data"], None,
+                                        _stage_params(_bio_subjects(bio_data_params, tlfb_data_params)),
+                                        cache=None)["duplicates"]
+        params["overridden_amount"] = bio_data_params["overridden_amount"]
+    stages = tuple(stage for stage in _active_stages(tlfb_stages, params) if stage.name not in ("profile", "index"))
+    return run_stages(stages, tlfb_data_params["data"], None, params, cache=None)
+
+
+def process_visit_data(visit_data_params, progress=None, diagnostics=None):
+    params = _stage_params(visit_data_params)
+    return run_stages(_active_stages(visit_stages, params), visit_data_params["data"],
+                      visit_data_params["data_digest"], params, progress=_prefixed(progress, "visit"),
+                      diagnostics=diagnostics, step="visit")
+
+
+def _calculate_families(tlfb_data, visit_data, abst_pp_params, abst_prol_params, abst_cont_params,
+                        abst_params_shared, progress=None, diagnostics=None, usage_index=None, visit_index=None):
+    # The indexes are built once for all the families when they aren't kept with the processed data
+    if usage_index is None:
+        usage_index = UsageIndex(tlfb_data.data, tlfb_data.abst_cutoff)
+    if visit_index is None:
+        visit_index = visit_engine.VisitDateIndex(visit_data.data)
+    calculation_results = list()
+    families = [x for x, params in (("point-prevalence", abst_pp_params), ("prolonged", abst_prol_params),
+                                    ("continuous", abst_cont_params)) if params["visits"]]
+    report = (lambda family: progress(f"{family} abstinence", families.index(family), len(families))) \
+        if progress is not None else (lambda family: None)
+    if abst_pp_params["visits"]:
+        report("point-prevalence")
+        with measure(diagnostics, "abstinence", "point-prevalence", tlfb_data) as measured:
+            calculation_results.append(abstinence_pp(
+                tlfb_data,
+                visit_data,
+                abst_pp_params["visits"],
+                abst_pp_params["days"],
+                abst_pp_params["abst_var_names"],
+                abst_params_shared["including_end"],
+                abst_params_shared["mode"],
+                usage_index,
+                visit_index
+            ))
+            measured["data_out"] = calculation_results[-1][0]
+    if abst_prol_params["visits"]:
+        report("prolonged")
+        with measure(diagnostics, "abstinence", "prolonged", tlfb_data) as measured:
+            calculation_results.append(abstinence_prolonged(
+                tlfb_data,
+                visit_data,
+                abst_prol_params["quit_visit"],
+                abst_prol_params["visits"],
+                abst_prol_params["lapse_definitions"],
+                abst_prol_params["grace_period"],
+                abst_prol_params["abst_var_names"],
+                abst_params_shared["including_end"],
+                abst_params_shared["mode"],
+                usage_index,
+                visit_index
+            ))
+            measured["data_out"] = calculation_results[-1][0]
+    if abst_cont_params["visits"]:
+        report("continuous")
+        with measure(diagnostics, "abstinence", "continuous", tlfb_data) as measured:
+            calculation_results.append(abstinence_cont(
+                tlfb_data,
+                visit_data,
+                abst_cont_params["start_visit"],
+                abst_cont_params["visits"],
+                abst_cont_params["abst_var_names"],
+                abst_params_shared["including_end"],
+                abst_params_shared["mode"],
+                usage_index,
+                visit_index
+            ))
+            measured["data_out"] = calculation_results[-1][0]
+    return calculation_results
+
+
+def _shard_data(data, subject_ids):
+    shard = copy.copy(data)
+    shard.data = data.data[data.data["id"].isin(subject_ids)]
+    shard.subject_ids = data.subject_ids & set(subject_ids)
+    return shard
+
+
+def _concat_lapse_shards(frames):
+    # The serial calculation labels the lapses in the order they're found, which follows the subject order, so each
+    # shard's labels are offset by the lapse counts of the preceding shards before restoring the serial sorting
+    shifted_frames = list()
+    offset = 0
+    for df in frames:
+        df = df.copy()
+        df.index = df.index + offset
+        offset += len(df)
+        shifted_frames.append(df)
+    non_empty_frames = [df for df in shifted_frames if not df.empty] or shifted_frames[:1]
+    return pd.concat(non_empty_frames).sort_values(by=['abst_name', 'id', 'date'])
+
+
+def _calculate_sharded(tlfb_data, visit_data, abst_params, workers, progress=None):
+    # Only the subjects in both data are calculated, so every shard produces the same columns and dtypes
+    subject_ids = sorted(tlfb_data.subject_ids & visit_data.subject_ids)
+    if len(subject_ids) < 2:
+        return _calculate_families(tlfb_data, visit_data, *abst_params, progress)
+    shard_count = min(len(subject_ids), workers * 2)
+    shard_size = -(-len(subject_ids) // shard_count)
+    shards = [subject_ids[i:i + shard_size] for i in range(0, len(subject_ids), shard_size)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        shard_results = list()
+        for result in executor.map(
+            _calculate_families,
+            [_shard_data(tlfb_data, x) for x in shards],
+            [_shard_data(visit_data, x) for x in shards],
+            *[[params] * len(shards) for params in abst_params]
+        ):
+            shard_results.append(result)
+            # Stopping the run here closes the map, which cancels the shards that haven't started
+            if progress is not None:
+                progress("subject shards", len(shard_results), len(shards))
+    # The abstinence data are indexed by the subject ids, which are sorted across the contiguous shards
+    return [(pd.concat([x[i][0] for x in shard_results]), _concat_lapse_shards([x[i][1] for x in shard_results]))
+            for i in range(len(shard_results[0]))]
+
+
+def calculate_abstinence(context, progress=None):
+    """Calculates the point-prevalence, prolonged and continuous abstinence of the processed data.
+
+    When abst_params_shared["workers"] is greater than one, the subjects are split into shards that are calculated
+    in a process pool, and the merged results are the same as those of the serial calculation. The progress callback
+    is called before each abstinence family, or as the shards finish, in the same way as in run_stages. The results
+    are persisted in the disk cache, keyed on the stage result keys of the processed data and the parameters. The
+    context's diagnostics, when it has them, record the lookup, each family or the shards as a whole, and the merge.
+
+    Returns
+    -------
+    tuple
+        The merged abstinence data and the merged lapse data.
+
+    """
+    if context.tlfb_data is None or context.visit_data is None:
+        raise ValueError("Please process the TLFB and Visit data first.")
+
+    abst_params = (context.abst_pp_params, context.abst_prol_params, context.abst_cont_params,
+                   context.abst_params_shared)
+    diagnostics = context.diagnostics
+    stored_key = None
+    if context.tlfb_key is not None and context.visit_key is not None:
+        # The number of workers doesn't change the results, so it's left out of the key
+        shared_params = {key: value for key, value in context.abst_params_shared.items() if key != "workers"}
+        stored_key = _stored_key(params_signature(*abst_params[:3], shared_params, {
+            "tlfb_data": context.tlfb_key, "visit_data": context.visit_key}))
+        with measure(diagnostics, "abstinence", "stored results") as measured:
+            frames = None
+            if disk_cache.get(stored_key) is not None:
+                try:
+                    frames = disk_cache.load_frames(stored_key)
+                except (OSError, KeyError):
+                    pass
+            measured["source"] = "not cached" if frames is None else "disk cache"
+            measured["data_out"] = None if frames is None else frames["abst"]
+        if frames is not None:
+            return frames["abst"], frames["lapse"]
+
+    # The processed data are kept compact, so they're decoded for the calculation only
+    tlfb_data, visit_data = decode(context.tlfb_data), decode(context.visit_data)
+    workers = context.abst_params_shared.get("workers") or 1
+    if workers > 1:
+        with measure(diagnostics, "abstinence", "subject shards", tlfb_data) as measured:
+            calculation_results = _calculate_sharded(tlfb_data, visit_data, abst_params, workers, progress)
+            measured["data_out"] = calculation_results[0][0] if calculation_results else None
+    else:
+        # The indexes kept with the processed data are reused, while the shards build their own
+        calculation_results = _calculate_families(tlfb_data, visit_data, *abst_params, progress, diagnostics,
+                                                  context.tlfb_index, context.visit_index)
+    with measure(diagnostics, "abstinence", "merge") as measured:
+        calculator = ac.AbstinenceCalculator(tlfb_data, visit_data)
+        abst_df = calculator.merge_abst_data([x[0] for x in calculation_results])
+        lapse_df = calculator.merge_lapse_data([x[1] for x in calculation_results])
+        measured["data_out"] = abst_df
+    if stored_key is not None:
+        with measure(diagnostics, "abstinence", "store results", abst_df):
+            disk_cache.put(stored_key, {"abst": abst_df, "lapse": lapse_df}, dict())
+    return abst_df, lapse_df
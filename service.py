@@ -0,0 +1,338 @@
+"""Serves the abstinence calculation over HTTP, for the tools that need the results without the web app.
+
+The requests and the responses are JSON. A dataset is posted once with the same options as a study config of
+batch.py, except that each data object holds its file content, base64-encoded in any format the app reads, or its
+rows as a list of records:
+
+    POST /datasets
+    {
+        "tlfb": {"content": "aWQsZGF0ZSxhbW91bnQK...", "cutoff": 0, "imputation_mode": "linear"},
+        "bio": {"records": [{"id": 1000, "date": "2020-01-05", "amount": 3.5}], "cutoff": 4},
+        "visit": {"records": [{"id": 1000, "visit": 0, "date": "2020-01-05"}], "data_format": "long"}
+    }
+
+which processes the TLFB and visit data and responds with the dataset's id. The processed datasets are kept warm, so
+the calculations only need the id and the "abstinence" object of a study config:
+
+    POST /calculate?format=json
+    {"dataset": "<id>", "abstinence": {"mode": "itt", "pp": {"visits": [2], "days": [7]}}}
+
+The data objects may be posted to /calculate in place of the dataset id as well. With the default format "json", the
+response holds the dataset id and the abstinence and lapse data as lists of records. The other download formats of
+the app, such as "parquet" or "csv", return the single table chosen by "table", "abstinence" (the default) or "lapse".
+
+The requests for the same dataset or the same calculation that arrive while it's running share its run, and the runs
+go through a bounded pool of worker threads. The "workers" of an abstinence object, the processes of a calculation,
+are limited by the service's --max-processes. GET /health reports the service's counts, and DELETE /datasets/<id>
+drops a warm dataset.
+
+Usage: python service.py --port 8765 --workers 4
+"""
+import argparse
+import asyncio
+import base64
+import binascii
+import copy
+import json
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+import pandas as pd
+import tornado.httpserver
+import tornado.web
+from abstcal.calculator_error import FileFormatError, InputArgumentError
+from tornado.ioloop import IOLoop
+from batch import build_context, update_abst_params
+from downloads import Download, download_formats, iter_download
+from ingestion import upload_cache
+from pipeline import calculate_abstinence, params_signature, process_tlfb_data, process_visit_data
+
+
+def _load_payload(data_config, kind, data_format=None, subjects=None):
+    # The parsed payloads are cached whole and shared, and the pipeline selects the subjects when it loads them
+    if "content" in data_config:
+        try:
+            buffer = base64.b64decode(data_config["content"], validate=True)
+        except (binascii.Error, TypeError):
+            raise ValueError(f"The content of the {kind} data should be a base64-encoded data file.")
+    elif "records" in data_config:
+        # The records are parsed the same as an uploaded file, so the dates and amounts get the same types
+        buffer = pd.DataFrame(data_config["records"]).to_csv(index=False).encode()
+    else:
+        raise ValueError(f"The {kind} data should have either the base64-encoded file content or the records.")
+    return upload_cache.load(buffer, kind, data_format)
+
+
+# The errors of the posted data or options, which abstcal raises with its own types, and which are the client's to fix
+_request_errors = (ValueError, FileFormatError, InputArgumentError)
+
+# JSON holds both tables, while each of the other formats holds the one table of the request
+_table_formats = ["json"] + [x for x in download_formats if x != "json"]
+
+
+def _tables_json(dataset_id, abst_df, lapse_df):
+    # The tables are already serialized by pandas, which handles the dates and the missing values
+    abst_json = abst_df.reset_index().to_json(orient="records", date_format="iso")
+    lapse_json = lapse_df.to_json(orient="records", date_format="iso")
+    return f'{{"dataset": {json.dumps(dataset_id)}, "abstinence": {abst_json}, "lapses": {lapse_json}}}'
+
+
+class CalculationService(object):
+    def __init__(self, max_workers=None, max_datasets=16, max_processes=1):
+        """Processes the posted datasets and calculates their abstinence in a bounded pool of worker threads.
+
+        A run is shared by all the requests for the same dataset or the same calculation that arrive while it's
+        running. When the disk cache is on (ABSTCAL_CACHE_DIR), the finished calculations are persisted in it by
+        calculate_abstinence, so a repeated calculation only reads its results.
+
+        Parameters
+        ----------
+        max_workers : int
+            The number of worker threads, by default the number of CPUs up to four.
+        max_datasets : int
+            The number of processed datasets kept warm. The least recently used ones are dropped beyond it.
+        max_processes : int
+            The most worker processes a calculation may use. The abstinence "workers" of a request are clamped to it,
+            so by default every calculation runs in its worker thread.
+
+        """
+        self.max_workers = max_workers or min(4, os.cpu_count() or 1)
+        self.max_datasets = max_datasets
+        self.max_processes = max_processes
+        self.coalesced = 0
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        self._datasets = OrderedDict()
+        self._running = dict()
+        self._lock = threading.Lock()
+
+    def _run_once(self, key, func, *args):
+        """Submits the run unless the same key is running, returning the future shared by its callers."""
+        with self._lock:
+            future = self._running.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return future
+            future = self._running[key] = self._executor.submit(func, *args)
+        future.add_done_callback(lambda _: self._finish(key))
+        return future
+
+    def _finish(self, key):
+        with self._lock:
+            self._running.pop(key, None)
+
+    def prepare_dataset(self, config):
+        """Parses the data objects of the config into a context with the processing parameters.
+
+        Returns
+        -------
+        tuple
+            The dataset id, which fingerprints the data and the processing parameters, and the context.
+
+        """
+        if not config.get("tlfb") or not config.get("visit"):
+            raise ValueError("The dataset should have both the TLFB and the visit data.")
+        context = build_context(config, load=_load_payload)
+        dataset_id = params_signature(context.tlfb_data_params, context.bio_data_params, context.visit_data_params)
+        return dataset_id, context
+
+    def _process_dataset(self, dataset_id, context):
+        visit_results = process_visit_data(context.visit_data_params)
+        context.visit_data = visit_results["impute"].data
+        context.visit_index = visit_results["dates"].output
+        context.visit_key = visit_results["impute"].key
+        stage_results = process_tlfb_data(context.tlfb_data_params, context.bio_data_params)
+        context.tlfb_data = stage_results["impute"].data
+        context.tlfb_index = stage_results["index"].output
+        context.tlfb_key = stage_results["impute"].key
+        with self._lock:
+            self._datasets[dataset_id] = context
+            while len(self._datasets) > self.max_datasets:
+                self._datasets.popitem(last=False)
+        return context
+
+    def process_dataset(self, dataset_id, context):
+        """Gets the future of the processed context, which is already done when the dataset is warm."""
+        warm_context = self.get_dataset(dataset_id)
+        if warm_context is not None:
+            future = Future()
+            future.set_result(warm_context)
+            return future
+        return self._run_once(("dataset", dataset_id), self._process_dataset, dataset_id, context)
+
+    def get_dataset(self, dataset_id):
+        with self._lock:
+            context = self._datasets.get(dataset_id)
+            if context is not None:
+                self._datasets.move_to_end(dataset_id)
+            return context
+
+    def drop_dataset(self, dataset_id):
+        with self._lock:
+            return self._datasets.pop(dataset_id, None) is not None
+
+    def calculate(self, dataset_id, abst_config):
+        """Gets the future of the abstinence and lapse data of the warm dataset, calculated with the config.
+
+        The config is the "abstinence" object of a study config. A dataset that isn't warm raises KeyError.
+        """
+        context = self.get_dataset(dataset_id)
+        if context is None:
+            raise KeyError(dataset_id)
+        # The warm context is shared by the requests, so each calculation sets its parameters on a copy
+        context = copy.copy(context)
+        context.abst_pp_params, context.abst_prol_params = dict(), dict()
+        context.abst_cont_params, context.abst_params_shared = dict(), dict()
+        update_abst_params(context, abst_config)
+        workers = context.abst_params_shared["workers"]
+        if workers is None:
+            workers = 1
+        if not isinstance(workers, int) or isinstance(workers, bool) or workers < 1:
+            raise ValueError("The abstinence workers should be a positive integer.")
+        # The worker processes are the operator's to allow, so a request can't start more than the service's limit
+        context.abst_params_shared["workers"] = min(workers, self.max_processes)
+        abst_params = (context.abst_pp_params, context.abst_prol_params, context.abst_cont_params,
+                       context.abst_params_shared)
+        if not any(params["visits"] for params in abst_params[:3]):
+            raise ValueError("Please specify the visits of at least one abstinence calculation.")
+        return self._run_once(("abstinence", dataset_id, params_signature(*abst_params)), calculate_abstinence,
+                              context)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "datasets": len(self._datasets),
+                "max_datasets": self.max_datasets,
+                "running": len(self._running),
+                "coalesced": self.coalesced,
+                "workers": self.max_workers,
+                "max_processes": self.max_processes
+            }
+
+
+class _ServiceHandler(tornado.web.RequestHandler):
+    def initialize(self, service):
+        self.service = service
+
+    def write_error(self, status_code, **kwargs):
+        error = kwargs.get("exc_info", (None, None))[1]
+        message = getattr(error, "log_message", None) or self._reason
+        self.finish({"error": message})
+
+    def _fail(self, status_code, message):
+        self.set_status(status_code)
+        self.finish({"error": message})
+
+    def _json_body(self):
+        try:
+            body = json.loads(self.request.body or b"{}")
+        except ValueError:
+            body = None
+        if not isinstance(body, dict):
+            raise tornado.web.HTTPError(400, "The request body should be a JSON object.")
+        return body
+
+    async def _load_dataset(self, config):
+        # The parsing runs off the event loop, and only the processing takes a worker of the service
+        dataset_id, context = await IOLoop.current().run_in_executor(None, self.service.prepare_dataset, config)
+        context = await asyncio.wrap_future(self.service.process_dataset(dataset_id, context))
+        return dataset_id, context
+
+
+class HealthHandler(_ServiceHandler):
+    def get(self):
+        self.write(dict(self.service.stats(), status="ok"))
+
+
+class DatasetHandler(_ServiceHandler):
+    async def post(self):
+        try:
+            dataset_id, context = await self._load_dataset(self._json_body())
+        except _request_errors as e:
+            self._fail(400, str(e))
+            return
+        self.write({
+            "dataset": dataset_id,
+            "subjects": len(context.tlfb_data.subject_ids & context.visit_data.subject_ids),
+            "visits": [str(visit) for visit in context.visit_data_params["expected_visits"]]
+        })
+
+    def delete(self, dataset_id):
+        if not self.service.drop_dataset(dataset_id):
+            self._fail(404, f"The dataset {dataset_id} isn't warm.")
+            return
+        self.set_status(204)
+
+
+class CalculationHandler(_ServiceHandler):
+    async def post(self):
+        file_format = self.get_argument("format", "json")
+        table = self.get_argument("table", "abstinence")
+        if file_format not in _table_formats:
+            self._fail(400, f"The format should be one of {', '.join(_table_formats)}.")
+            return
+        if table not in ("abstinence", "lapse"):
+            self._fail(400, "The table should be either abstinence or lapse.")
+            return
+        body = self._json_body()
+        dataset_id = body.get("dataset")
+        try:
+            if dataset_id is None:
+                dataset_id, _ = await self._load_dataset(body)
+            try:
+                future = self.service.calculate(dataset_id, body.get("abstinence", dict()))
+            except KeyError:
+                self._fail(404, f"The dataset {dataset_id} isn't warm. Please post its data again.")
+                return
+            abst_df, lapse_df = await asyncio.wrap_future(future)
+        except _request_errors as e:
+            self._fail(400, str(e))
+            return
+
+        if file_format == "json":
+            self.set_header("Content-Type", "application/json")
+            self.write(await IOLoop.current().run_in_executor(None, _tables_json, dataset_id, abst_df, lapse_df))
+            return
+        extension, content_type = download_formats[file_format]
+        download = Download(abst_df, "abstinence_data", True) if table == "abstinence" else \
+            Download(lapse_df, "lapse_data", False)
+        self.set_header("Content-Type", content_type)
+        self.set_header("Content-Disposition", f'attachment; filename="{download.filename}.{extension}"')
+        pieces = iter_download(download, file_format)
+        while True:
+            piece = await IOLoop.current().run_in_executor(None, next, pieces, None)
+            if piece is None:
+                break
+            self.write(piece)
+            await self.flush()
+
+
+def make_app(service):
+    return tornado.web.Application([
+        (r"/health", HealthHandler, {"service": service}),
+        (r"/datasets", DatasetHandler, {"service": service}),
+        (r"/datasets/([0-9a-f]+)", DatasetHandler, {"service": service}),
+        (r"/calculate", CalculationHandler, {"service": service})
+    ])
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1", help="The address to listen on, only this machine by default")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--workers", type=int, default=None, help="The number of worker threads")
+    parser.add_argument("--max-processes", type=int, default=1,
+                        help="The most worker processes of a calculation, which bounds the requested workers")
+    parser.add_argument("--max-datasets", type=int, default=16, help="The number of processed datasets kept warm")
+    parser.add_argument("--max-body-mb", type=int, default=512, help="The largest request body in MB")
+    args = parser.parse_args(args)
+
+    service = CalculationService(args.workers, args.max_datasets, args.max_processes)
+    server = tornado.httpserver.HTTPServer(make_app(service), max_body_size=args.max_body_mb * 1024 ** 2)
+    server.listen(args.port, args.host)
+    print(f"Serving the abstinence calculation on http://{args.host}:{args.port}")
+    IOLoop.current().start()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,258 @@
+import contextlib
+import gzip
+import os
+import pickle
+import sys
+import threading
+import time
+import types
+from collections import OrderedDict
+from disk_cache import private_directory
+from downloads import download_registry
+from jobs import job_manager
+
+
+# Use the following session to track data
+# Reference: https://gist.github.com/tvst/036da038ab3e999a64497f42de966a92
+class SessionState(object):
+    def __init__(self, **kwargs):
+        """A new SessionState object.
+
+        Parameters
+        ----------
+        **kwargs : any
+            Default values for the session state.
+
+        Example
+        -------
+        >>> session_state = SessionState(user_name='', favorite_color='black')
+        >>> session_state.user_name = 'Mary'
+        ''
+        >>> session_state.favorite_color
+        'black'
+
+        """
+        for key, val in kwargs.items():
+            setattr(self, key, val)
+
+
+def estimate_size(value, seen=None):
+    """Estimates the memory footprint of a session value.
+
+    The value is walked through its dicts, sequences and object attributes, such as the session's PipelineContext,
+    counting the frames of the uploads and of the abstcal objects, and the arrays of the indexes. An object reached
+    twice, such as a frame shared by two parameter dicts, is counted once.
+    """
+    seen = set() if seen is None else seen
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    if hasattr(value, "memory_usage"):
+        return int(value.memory_usage(index=True).sum())
+    nbytes = getattr(value, "nbytes", None)
+    if isinstance(nbytes, int):
+        return nbytes
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(estimate_size(x, seen) for x in value.values())
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return sys.getsizeof(value) + sum(estimate_size(x, seen) for x in value)
+    if hasattr(value, "__dict__") and not isinstance(value, (type, types.ModuleType, types.FunctionType,
+                                                              types.MethodType)):
+        return sys.getsizeof(value) + sum(estimate_size(x, seen) for x in vars(value).values())
+    return sys.getsizeof(value)
+
+
+def estimate_session_size(session_state):
+    return estimate_size(session_state)
+
+
+class SessionStore(object):
+    def __init__(self, max_bytes=2 * 1024 ** 3, ttl=3600, max_sessions=100, spill_dir=None, spill_ttl=86400 * 7,
+                 busy=None):
+        """A bounded store of the session states.
+
+        Sessions idle longer than the ttl, or the least recently used ones when the store goes over its memory budget
+        or session count, are spilled to compressed pickle files and restored when the same session comes back.
+        The pickles are only written to and read from a directory private to the user (see private_directory). When
+        there's no spill directory, or it isn't private, the sessions that would be spilled are dropped instead.
+
+        The spilled sessions are chosen under the store's lock but written outside it, so the other sessions aren't
+        held up by the pickling. A session that comes back while it's being written is taken back from memory, and the
+        file is discarded. The sessions held by a run (see hold) and the busy sessions, such as those with a job still
+        running for them, are never spilled, since their state may change while it's written. The tables that the
+        spilled sessions offer for download (see DownloadRegistry) are dropped with them.
+
+        Parameters
+        ----------
+        max_bytes : int
+            The memory budget of all the resident sessions.
+        ttl : int
+            The seconds a session can stay idle before being spilled to disk.
+        max_sessions : int
+            The maximal number of resident sessions.
+        spill_dir : str
+            The directory of the spilled sessions, or None to drop them instead.
+        spill_ttl : int
+            The seconds a spilled session is kept on disk.
+        busy : callable
+            Whether the session of the id is busy, by default whether it has a job running in the job_manager.
+
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.spill_dir = spill_dir
+        self.spill_ttl = spill_ttl
+        self.busy = busy or job_manager.has_running
+        self._entries = OrderedDict()
+        self._spilling = dict()
+        self._holds = dict()
+        self._last_access = dict()
+        self._last_purge = 0
+        self._lock = threading.RLock()
+
+    def get(self, session_id, **kwargs):
+        """Gets the state of the session, restoring it from disk or creating it with the defaults if necessary."""
+        with self._lock:
+            now = time.time()
+            self._last_access[session_id] = now
+            if session_id in self._entries:
+                self._entries.move_to_end(session_id)
+                state = self._entries[session_id]
+            elif session_id in self._spilling:
+                _, state = self._spilling.pop(session_id)
+                self._entries[session_id] = state
+            else:
+                state = self._restore(session_id) or SessionState(**kwargs)
+                self._entries[session_id] = state
+            evicted = self._evict(session_id, now)
+        for evicted_id, spilling in evicted:
+            self._spill(evicted_id, spilling)
+        return state
+
+    @contextlib.contextmanager
+    def hold(self, session_id, **kwargs):
+        """Gets the state of the session the same as get, and keeps it resident until the block ends.
+
+        A run of the app's script holds its session, so the changes that the run makes are never lost to a spill
+        that started before them. The session counts as used when the block ends as well.
+        """
+        with self._lock:
+            self._holds[session_id] = self._holds.get(session_id, 0) + 1
+        try:
+            yield self.get(session_id, **kwargs)
+        finally:
+            with self._lock:
+                self._holds[session_id] -= 1
+                if not self._holds[session_id]:
+                    del self._holds[session_id]
+                if session_id in self._entries:
+                    self._last_access[session_id] = time.time()
+                    self._entries.move_to_end(session_id)
+
+    def resident_bytes(self):
+        with self._lock:
+            return sum(estimate_session_size(state) for state in self._entries.values())
+
+    def stats(self):
+        with self._lock:
+            spilled = [x for x in os.listdir(self.spill_dir) if x.endswith(".pkl.gz")] \
+                if self.spill_dir and os.path.isdir(self.spill_dir) else list()
+            return {
+                "sessions": len(self._entries),
+                "spilled_sessions": len(spilled),
+                "bytes": self.resident_bytes(),
+                "max_bytes": self.max_bytes
+            }
+
+    def _spill_path(self, session_id):
+        return os.path.join(self.spill_dir, f"{session_id}.pkl.gz")
+
+    def _private_spill_dir(self):
+        if self.spill_dir is None:
+            return False
+        try:
+            private_directory(self.spill_dir)
+        except OSError:
+            return False
+        return True
+
+    def _spill(self, session_id, spilling):
+        # Runs outside the lock, the state being kept in _spilling until it's written or taken back. The spilling is
+        # the state with a token of this spill, so a spill that's taken back and started again isn't confused with it
+        _, state = spilling
+        temp_path = None
+        if self._private_spill_dir():
+            temp_path = f"{self._spill_path(session_id)}.{threading.get_ident()}.tmp"
+            try:
+                with gzip.open(temp_path, "wb", compresslevel=3) as file:
+                    pickle.dump(vars(state), file, protocol=pickle.HIGHEST_PROTOCOL)
+            except Exception:
+                _remove(temp_path)
+                temp_path = None
+        with self._lock:
+            if self._spilling.get(session_id) is not spilling:
+                _remove(temp_path)
+                return
+            del self._spilling[session_id]
+            if temp_path is not None:
+                os.replace(temp_path, self._spill_path(session_id))
+
+    def _restore(self, session_id):
+        # A file that can't be read back, such as one written by an older version of the app, starts a new session
+        if not self._private_spill_dir() or not os.path.exists(self._spill_path(session_id)):
+            return None
+        path = self._spill_path(session_id)
+        try:
+            with gzip.open(path, "rb") as file:
+                attributes = pickle.load(file)
+            state = SessionState(**attributes)
+        except Exception:
+            state = None
+        _remove(path)
+        return state
+
+    def _evict(self, current_id, now):
+        evictable = [x for x in self._entries if x != current_id and x not in self._holds and not self.busy(x)]
+        evicted = [x for x in evictable if now - self._last_access.get(x, now) > self.ttl]
+
+        sizes = {session_id: estimate_session_size(state) for session_id, state in self._entries.items()
+                 if session_id not in evicted}
+        total_bytes, total_sessions = sum(sizes.values()), len(sizes)
+        for session_id in [x for x in evictable if x not in evicted]:
+            if total_bytes <= self.max_bytes and total_sessions <= self.max_sessions:
+                break
+            total_bytes -= sizes[session_id]
+            total_sessions -= 1
+            evicted.append(session_id)
+
+        for session_id in evicted:
+            self._spilling[session_id] = (object(), self._entries.pop(session_id))
+            self._last_access.pop(session_id, None)
+            # The tables offered for download are registered again by the session's next run
+            download_registry.discard(session_id)
+        self._purge_spilled(now)
+        return [(session_id, self._spilling[session_id]) for session_id in evicted]
+
+    def _purge_spilled(self, now):
+        if now - self._last_purge < 600 or not self.spill_dir or not os.path.isdir(self.spill_dir):
+            return
+        self._last_purge = now
+        for filename in os.listdir(self.spill_dir):
+            path = os.path.join(self.spill_dir, filename)
+            if filename.endswith((".pkl.gz", ".tmp")) and now - os.path.getmtime(path) > self.spill_ttl:
+                _remove(path)
+
+
+def _remove(path):
+    if path is None:
+        return
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+# Imported modules outlive the reruns of the app script, so a single store is shared by all sessions. The sessions hold
+# the uploaded data, so they're only spilled to disk when the deployment sets the spill directory
+session_store = SessionStore(spill_dir=os.environ.get("ABSTCAL_SESSION_DIR"))
@@ -0,0 +1,136 @@
+import copy
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+from pipeline import calculate_abstinence, process_tlfb_data
+
+# The parameters that a sweep can vary, in the order of the tag columns of its results
+sweep_keys = ("tlfb_cutoff", "bio_cutoff", "including_end", "mode", "grace_period", "lapse_definitions")
+
+
+def _grid_values(grid, key, default):
+    values = grid.get(key, [default])
+    return values if isinstance(values, list) else [values]
+
+
+def _lapse_label(lapse_definitions):
+    return ", ".join(str(x) for x in lapse_definitions)
+
+
+def _calculate_combinations(context, prolonged_settings):
+    """Calculates the point-prevalence and continuous abstinence once, and the prolonged abstinence of each setting.
+
+    Only the prolonged abstinence depends on the grace period and the lapse definitions, so the other families
+    aren't repeated for each of them.
+
+    Returns
+    -------
+    list
+        The tags of the prolonged settings with the abstinence data and the lapse data of each calculation.
+
+    """
+    calculation_results = list()
+    if context.abst_pp_params["visits"] or context.abst_cont_params["visits"]:
+        other_context = copy.copy(context)
+        other_context.abst_prol_params = dict(context.abst_prol_params, visits=list())
+        calculation_results.append((dict(), *calculate_abstinence(other_context)))
+    if context.abst_prol_params["visits"]:
+        for grace_period, lapse_definitions in prolonged_settings:
+            prolonged_context = copy.copy(context)
+            prolonged_context.abst_pp_params = dict(context.abst_pp_params, visits=list())
+            prolonged_context.abst_cont_params = dict(context.abst_cont_params, visits=list())
+            prolonged_context.abst_prol_params = dict(context.abst_prol_params, grace_period=grace_period,
+                                                      lapse_definitions=lapse_definitions)
+            tags = {"grace_period": grace_period, "lapse_definitions": _lapse_label(lapse_definitions)}
+            calculation_results.append((tags, *calculate_abstinence(prolonged_context)))
+    return calculation_results
+
+
+def _tag(df, tags):
+    df = df.copy()
+    for i, key in enumerate(key for key in sweep_keys if key in tags):
+        df.insert(i, key, tags[key])
+    return df
+
+
+def run_sweep(context, grid, workers=1):
+    """Calculates the abstinence for every combination of the parameters in the grid.
+
+    The TLFB and biochemical data are processed once for each distinct pair of cutoffs, and the calculations of the
+    processed data are run in a process pool, one task for each combination of including_end and mode. The visit
+    data and all the other parameters are those of the context.
+
+    Parameters
+    ----------
+    context : PipelineContext
+        The context with the processed visit data and the parameters of the study.
+    grid : dict
+        The values of the parameters in sweep_keys. Each lapse_definitions value is a list of lapse definitions, the
+        same as the lapse_definitions parameter. A parameter that isn't in the grid keeps its value in the context.
+    workers : int
+        The number of worker processes, calculating in this process when it's one.
+
+    Returns
+    -------
+    tuple
+        The abstinence data and the lapse data in the long format, each row tagged by its parameter combination.
+        The grace period and the lapse definitions are missing in the rows of the other abstinence families.
+
+    """
+    if context.visit_data is None:
+        raise ValueError("Please process the Visit data first.")
+    unknown_keys = set(grid) - set(sweep_keys)
+    if unknown_keys:
+        raise ValueError(f"The sweep can only vary {', '.join(sweep_keys)}, not {', '.join(sorted(unknown_keys))}.")
+
+    has_bio_data = context.bio_data_params.get("data") is not None
+    cutoff_settings = list(itertools.product(
+        _grid_values(grid, "tlfb_cutoff", context.tlfb_data_params["cutoff"]),
+        _grid_values(grid, "bio_cutoff", context.bio_data_params["cutoff"]) if has_bio_data else [None]
+    ))
+    calculation_settings = list(itertools.product(
+        _grid_values(grid, "including_end", context.abst_params_shared["including_end"]),
+        _grid_values(grid, "mode", context.abst_params_shared["mode"])
+    ))
+    prolonged_settings = list(itertools.product(
+        _grid_values(grid, "grace_period", context.abst_prol_params["grace_period"]),
+        [x if isinstance(x, list) else [x] for x in
+         _grid_values(grid, "lapse_definitions", context.abst_prol_params["lapse_definitions"])]
+    ))
+
+    tasks = list()
+    for tlfb_cutoff, bio_cutoff in cutoff_settings:
+        tlfb_data_params = dict(context.tlfb_data_params, cutoff=tlfb_cutoff)
+        bio_data_params = dict(context.bio_data_params, cutoff=bio_cutoff)
+        stage_results = process_tlfb_data(tlfb_data_params, bio_data_params)
+        for including_end, mode in calculation_settings:
+            task_context = copy.copy(context)
+            task_context.tlfb_data = stage_results["impute"].data
+            task_context.tlfb_key = stage_results["impute"].key
+            # The tasks already run in parallel, and the index isn't used by the calculation
+            task_context.tlfb_index = None
+            task_context.abst_params_shared = dict(context.abst_params_shared, including_end=including_end,
+                                                   mode=mode, workers=1)
+            tags = {"tlfb_cutoff": tlfb_cutoff, "bio_cutoff": bio_cutoff, "including_end": including_end,
+                    "mode": mode}
+            tasks.append((tags, task_context))
+
+    if workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            task_results = list(executor.map(_calculate_combinations, [x[1] for x in tasks],
+                                             [prolonged_settings] * len(tasks)))
+    else:
+        task_results = [_calculate_combinations(x[1], prolonged_settings) for x in tasks]
+
+    abst_frames, lapse_frames = list(), list()
+    for (task_tags, _), calculation_results in zip(tasks, task_results):
+        for prolonged_tags, abst_df, lapse_df in calculation_results:
+            tags = dict(task_tags, grace_period=None, lapse_definitions=None)
+            tags.update(prolonged_tags)
+            long_df = abst_df.rename_axis("id").reset_index().melt(id_vars="id", var_name="abst_name",
+                                                                   value_name="abstinent")
+            abst_frames.append(_tag(long_df, tags))
+            lapse_frames.append(_tag(lapse_df.reset_index(drop=True), tags))
+    if not abst_frames:
+        raise ValueError("Please specify the visits of at least one abstinence calculation.")
+    return pd.concat(abst_frames, ignore_index=True), pd.concat(lapse_frames, ignore_index=True)
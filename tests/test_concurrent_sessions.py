@@ -0,0 +1,170 @@
+import tempfile
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+import pipeline
+from batch import build_context
+from benchmarks.synthetic import make_trial_data
+from disk_cache import DiskCache
+from ingestion import parse_data
+from jobs import DONE, job_manager
+from pipeline import PipelineContext, calculate_abstinence, process_tlfb_data, process_visit_data
+from sessions import SessionStore
+
+_SESSION_COUNT = 8
+
+_param_dicts = ("tlfb_data_params", "visit_data_params", "bio_data_params", "abst_pp_params", "abst_prol_params",
+                "abst_cont_params", "abst_params_shared")
+
+
+def _load_content(data_config, kind, data_format=None, subjects=None):
+    return parse_data(data_config["content"], kind, data_format, subjects=subjects)
+
+
+def _session_config(i):
+    # Each session uploads its own trial, with its own subjects, and sets its own parameters
+    trial_data = make_trial_data(12 + 3 * i, follow_up_days=90, visit_count=4, missing_rate=0.08, seed=i)
+    return {
+        "name": f"session_{i}",
+        "tlfb": {"content": trial_data.tlfb.to_csv(index=False).encode(), "cutoff": float(i % 3),
+                 "imputation_mode": ("linear", "uniform", 0)[i % 3], "outliers_mode": bool(i % 2),
+                 "allowed_min": 0.0, "allowed_max": 100.0},
+        "bio": {"content": trial_data.bio.to_csv(index=False).encode(), "cutoff": 4.0 + i},
+        "visit": {"content": trial_data.visits_long.to_csv(index=False).encode(), "anchor_visit": 0},
+        "abstinence": {"mode": ("itt", "ro")[i % 2], "including_end": i % 4 >= 2,
+                       "pp": {"visits": [2, 3], "days": [7, 14 + i]},
+                       "prolonged": {"quit_visit": 1, "visits": [3], "lapse_definitions": [False, f"{i + 1} cigs"],
+                                     "grace_period": 7 + i},
+                       "continuous": {"start_visit": 1, "visits": [2, 3]}}
+    }
+
+
+def _process_session(context, progress=None):
+    visit_results = process_visit_data(context.visit_data_params, progress)
+    context.visit_data = visit_results["impute"].data
+    context.visit_index = visit_results["dates"].output
+    context.visit_key = visit_results["impute"].key
+    stage_results = process_tlfb_data(context.tlfb_data_params, context.bio_data_params, progress)
+    context.tlfb_data = stage_results["impute"].data
+    context.tlfb_index = stage_results["index"].output
+    context.tlfb_key = stage_results["impute"].key
+
+
+def _run_session(context):
+    visit_results = process_visit_data(context.visit_data_params)
+    context.visit_data = visit_results["impute"].data
+    context.visit_index = visit_results["dates"].output
+    context.visit_key = visit_results["impute"].key
+    stage_results = process_tlfb_data(context.tlfb_data_params, context.bio_data_params)
+    context.tlfb_data = stage_results["impute"].data
+    context.tlfb_index = stage_results["index"].output
+    context.tlfb_key = stage_results["impute"].key
+    return calculate_abstinence(context)
+
+
+def _scalar_params(context):
+    return {name: {key: value for key, value in getattr(context, name).items() if key != "data"}
+            for name in _param_dicts}
+
+
+class ConcurrentSessionsTest(unittest.TestCase):
+    def setUp(self):
+        # The sessions share the process's caches, as they do in the app, but not the caches of other runs
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.spill_dir = tempfile.TemporaryDirectory()
+        self.disk_cache = pipeline.disk_cache
+        pipeline.disk_cache = DiskCache(self.cache_dir.name)
+        pipeline.stage_cache.clear()
+
+    def tearDown(self):
+        pipeline.disk_cache = self.disk_cache
+        pipeline.stage_cache.clear()
+        self.cache_dir.cleanup()
+        self.spill_dir.cleanup()
+
+    def test_sessions_are_isolated(self):
+        configs = [_session_config(i) for i in range(_SESSION_COUNT)]
+        contexts = [build_context(config, load=_load_content) for config in configs]
+        params_before = [_scalar_params(context) for context in contexts]
+
+        # The sessions start together and run twice, the second time mostly from the cached stages
+        barrier = threading.Barrier(_SESSION_COUNT)
+
+        def run(context):
+            barrier.wait()
+            return _run_session(context), _run_session(context)
+
+        with ThreadPoolExecutor(max_workers=_SESSION_COUNT) as executor:
+            session_results = list(executor.map(run, contexts))
+
+        param_ids = [id(getattr(context, name)) for context in contexts for name in _param_dicts]
+        self.assertEqual(len(set(param_ids)), len(param_ids))
+        for context, params in zip(contexts, params_before):
+            self.assertEqual(_scalar_params(context), params)
+
+        # Each session's results are those of the same session run alone on empty caches
+        pipeline.disk_cache.clear()
+        pipeline.stage_cache.clear()
+        for i, (config, results) in enumerate(zip(configs, session_results)):
+            expected_abst_df, expected_lapse_df = _run_session(build_context(config, load=_load_content))
+            mode = config["abstinence"]["mode"]
+            self.assertEqual(len(expected_abst_df), 12 + 3 * i)
+            self.assertIn(f"{mode}_pp{14 + i}_v2", expected_abst_df.columns)
+            for abst_df, lapse_df in results:
+                pd.testing.assert_frame_equal(abst_df, expected_abst_df)
+                pd.testing.assert_frame_equal(lapse_df, expected_lapse_df)
+
+    def test_store_keeps_the_sessions_apart(self):
+        # The budget holds a few sessions at most, so the sessions are spilled and restored while the others run
+        store = SessionStore(max_bytes=2 ** 18, max_sessions=3, spill_dir=self.spill_dir.name)
+        configs = [_session_config(i) for i in range(_SESSION_COUNT)]
+        barrier = threading.Barrier(_SESSION_COUNT)
+
+        def rerun(i, run_number):
+            session_id = f"stress_{i}"
+            with store.hold(session_id, context=PipelineContext(), runs=list(), results=list()) as state:
+                context = state.context
+                # Each run sets the parameters again, as the widgets do, while the processed data are kept
+                loaded = build_context(configs[i], load=_load_content)
+                for name in _param_dicts:
+                    setattr(context, name, getattr(loaded, name))
+                if run_number == 0:
+                    # The processing job writes to the context after the run has ended
+                    job_manager.submit(session_id, "process", run_number, _process_session, context)
+                else:
+                    job = job_manager.get(session_id, "process")
+                    self.assertTrue(job.wait(60))
+                    self.assertEqual(job.status, DONE)
+                    state.results.append(calculate_abstinence(context))
+                state.runs.append(run_number)
+
+        def run(i):
+            barrier.wait()
+            for run_number in range(3):
+                rerun(i, run_number)
+
+        try:
+            with ThreadPoolExecutor(max_workers=_SESSION_COUNT) as executor:
+                list(executor.map(run, range(_SESSION_COUNT)))
+            self.assertGreater(store.stats()["spilled_sessions"], 0)
+            states = [store.get(f"stress_{i}") for i in range(_SESSION_COUNT)]
+        finally:
+            for i in range(_SESSION_COUNT):
+                job_manager.discard(f"stress_{i}")
+
+        pipeline.disk_cache.clear()
+        pipeline.stage_cache.clear()
+        for config, state in zip(configs, states):
+            # No run of the session is lost to a spill, and its results are its own
+            self.assertEqual(state.runs, [0, 1, 2])
+            self.assertEqual(_scalar_params(state.context), _scalar_params(build_context(config, load=_load_content)))
+            expected_abst_df, expected_lapse_df = _run_session(build_context(config, load=_load_content))
+            self.assertEqual(len(state.results), 2)
+            for abst_df, lapse_df in state.results:
+                pd.testing.assert_frame_equal(abst_df, expected_abst_df)
+                pd.testing.assert_frame_equal(lapse_df, expected_lapse_df)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,24 @@
+import unittest
+from unittest import mock
+import downloads
+
+
+class RegisterRouteTest(unittest.TestCase):
+    def setUp(self):
+        self.route_registered = downloads._route_registered
+        downloads._route_registered = None
+
+    def tearDown(self):
+        downloads._route_registered = self.route_registered
+
+    def test_missing_app_is_reported_once(self):
+        # Outside a Streamlit server there's no Tornado app, so the links have to fall back to embedded files
+        with mock.patch.object(downloads.gc, "get_objects", return_value=list()) as get_objects, \
+                self.assertLogs(downloads.logger, "WARNING"):
+            self.assertFalse(downloads.register_route())
+            self.assertFalse(downloads.register_route())
+        get_objects.assert_called_once_with()
+
+
+if __name__ == "__main__":
+    unittest.main()
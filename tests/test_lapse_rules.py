@@ -0,0 +1,163 @@
+import unittest
+import warnings
+import abstcal as ac
+import pandas as pd
+import tlfb_engine
+import visit_engine
+from benchmarks.synthetic import make_trial_data
+from lapse_rules import abstinence_cont, abstinence_pp, abstinence_prolonged
+from tests.test_tlfb_engine import _tlfb_data
+from usage_index import UsageIndex
+
+
+def _processed_data(trial_data, use_bio):
+    # The engines' processing matches abstcal's (see test_tlfb_engine and test_visit_engine), and is much faster
+    bio_data = None
+    if use_bio:
+        bio_data = _tlfb_data(trial_data.bio, 4)
+        tlfb_engine.interpolate_biochemical_data(bio_data, 0.25, 3)
+    tlfb_data = _tlfb_data(trial_data.tlfb, 0)
+    tlfb_engine.impute_data(tlfb_data, "linear", "ffill", None, bio_data)
+    visit_data = ac.VisitData(trial_data.visits_long.copy())
+    visit_engine.impute_data(visit_data, 0, "freq")
+    return tlfb_data, visit_data
+
+
+def _by_visit(calculate, visits):
+    # abstcal scores a single visit right, even in the responders-only mode where its imputed date is left out
+    results = [calculate(visit) for visit in visits]
+    abst_df = pd.concat([x[0] for x in results], axis=1)
+    lapse_df = pd.concat([x[1] for x in results]).sort_values(by=["abst_name", "id", "date"])
+    return abst_df, lapse_df
+
+
+class _AbstinenceTestCase(unittest.TestCase):
+    def setUp(self):
+        catch_warnings = warnings.catch_warnings()
+        catch_warnings.__enter__()
+        self.addCleanup(catch_warnings.__exit__, None, None, None)
+        warnings.simplefilter("ignore")
+        self.trial_data = make_trial_data(60, follow_up_days=120, visit_count=4, missing_rate=0.1, seed=7)
+        self.complete_trial_data = make_trial_data(30, follow_up_days=120, visit_count=4, missing_rate=0.0,
+                                                   duplicate_rate=0.0, seed=8)
+
+    def _data_cases(self):
+        for trial_data in (self.trial_data, self.complete_trial_data):
+            for use_bio in (False, True):
+                tlfb_data, visit_data = _processed_data(trial_data, use_bio)
+                yield dict(missing=trial_data is self.trial_data, use_bio=use_bio), tlfb_data, visit_data
+
+    def assert_results_equal(self, actual, expected, check_index=True):
+        pd.testing.assert_frame_equal(actual[0], expected[0])
+        if check_index:
+            pd.testing.assert_frame_equal(actual[1], expected[1])
+        else:
+            pd.testing.assert_frame_equal(actual[1].reset_index(drop=True), expected[1].reset_index(drop=True))
+
+
+class AbstinenceTest(_AbstinenceTestCase):
+    def test_intent_to_treat_matches_abstcal(self):
+        for case, tlfb_data, visit_data in self._data_cases():
+            calculator = ac.AbstinenceCalculator(tlfb_data, visit_data)
+            usage_index = UsageIndex(tlfb_data.data, tlfb_data.abst_cutoff)
+            visit_index = visit_engine.VisitDateIndex(visit_data.data)
+            for including_end in (False, True):
+                with self.subTest(including_end=including_end, **case):
+                    expected = calculator.abstinence_pp([2, 3], [7, 14, 30], "infer", including_end)
+                    self.assert_results_equal(abstinence_pp(tlfb_data, visit_data, [2, 3], [7, 14, 30], "infer",
+                                                            including_end), expected)
+                    # The indexes kept with the processed data give the same results
+                    self.assert_results_equal(abstinence_pp(tlfb_data, visit_data, [2, 3], [7, 14, 30], "infer",
+                                                            including_end, usage_index=usage_index,
+                                                            visit_index=visit_index), expected)
+                    self.assert_results_equal(abstinence_cont(tlfb_data, visit_data, 1, [2, 3], "infer",
+                                                              including_end),
+                                              calculator.abstinence_cont(1, [2, 3], "infer", including_end))
+                    self.assert_results_equal(abstinence_cont(tlfb_data, visit_data, 0, 3, ["cont"], including_end),
+                                              calculator.abstinence_cont(0, 3, ["cont"], including_end))
+
+    def test_responders_only_matches_abstcal(self):
+        for case, tlfb_data, visit_data in self._data_cases():
+            calculator = ac.AbstinenceCalculator(tlfb_data, visit_data)
+            # abstcal is only right for all the visits at once when no visit was imputed, see the test below
+            imputed_ids = visit_data.data.loc[visit_data.data["imputation_code"] != 0, "id"].unique()
+            self.assertEqual(len(imputed_ids) > 0, case["missing"])
+            for including_end in (False, True):
+                with self.subTest(including_end=including_end, **case):
+                    for actual, expected in (
+                            (abstinence_pp(tlfb_data, visit_data, [2, 3], [7, 30], "infer", including_end, "ro"),
+                             calculator.abstinence_pp([2, 3], [7, 30], "infer", including_end, "ro")),
+                            (abstinence_cont(tlfb_data, visit_data, 1, [2, 3], "infer", including_end, "ro"),
+                             calculator.abstinence_cont(1, [2, 3], "infer", including_end, "ro"))):
+                        actual = actual[0].drop(index=imputed_ids), actual[1].loc[~actual[1]["id"].isin(imputed_ids)]
+                        expected = expected[0].drop(index=imputed_ids), \
+                            expected[1].loc[~expected[1]["id"].isin(imputed_ids)]
+                        self.assert_results_equal(actual, expected, check_index=False)
+
+    def test_responders_only_imputed_visits_are_missing(self):
+        # abstcal leaves out the imputed visit dates of a subject and shifts the scores of the later visits into the
+        # columns of the earlier ones. Here the windows ending at an imputed visit are missing (NaN), and the other
+        # scores stay under their own visits, the same as abstcal's scores of one visit at a time.
+        tlfb_data, visit_data = _processed_data(self.trial_data, True)
+        calculator = ac.AbstinenceCalculator(tlfb_data, visit_data)
+        imputed = visit_data.data.loc[visit_data.data["imputation_code"] != 0, :]
+        self.assertTrue(imputed["visit"].isin([2, 3]).any())
+
+        actual = abstinence_pp(tlfb_data, visit_data, [2, 3], 7, mode="ro")
+        self.assert_results_equal(actual, _by_visit(lambda x: calculator.abstinence_pp(x, 7, mode="ro"), [2, 3]),
+                                  check_index=False)
+        for visit, visit_df in imputed.groupby("visit"):
+            if visit in (2, 3):
+                self.assertTrue(actual[0].loc[visit_df["id"], f"ro_pp7_v{visit}"].isna().all())
+        self.assertFalse(actual[0].equals(calculator.abstinence_pp([2, 3], 7, mode="ro")[0]))
+
+        actual = abstinence_cont(tlfb_data, visit_data, 1, [2, 3], mode="ro")
+        self.assert_results_equal(actual, _by_visit(lambda x: calculator.abstinence_cont(1, x, mode="ro"), [2, 3]),
+                                  check_index=False)
+
+
+class ProlongedAbstinenceTest(_AbstinenceTestCase):
+    lapse_definitions = [False, "5 cigs", "3 days", "5 cigs/7 days", "2 days/7 days", "0.5 cigs/3 days"]
+
+    def test_intent_to_treat_matches_abstcal(self):
+        for case, tlfb_data, visit_data in self._data_cases():
+            calculator = ac.AbstinenceCalculator(tlfb_data, visit_data)
+            for including_end, grace_period in ((False, 14), (True, 7)):
+                with self.subTest(including_end=including_end, grace_period=grace_period, **case):
+                    self.assert_results_equal(
+                        abstinence_prolonged(tlfb_data, visit_data, 1, [2, 3], self.lapse_definitions, grace_period,
+                                             "infer", including_end),
+                        calculator.abstinence_prolonged(1, [2, 3], self.lapse_definitions, grace_period, "infer",
+                                                        including_end))
+
+    def test_responders_only_matches_abstcal(self):
+        for case, tlfb_data, visit_data in self._data_cases():
+            calculator = ac.AbstinenceCalculator(tlfb_data, visit_data)
+            imputed_ids = visit_data.data.loc[visit_data.data["imputation_code"] != 0, "id"].unique()
+            with self.subTest(**case):
+                actual = abstinence_prolonged(tlfb_data, visit_data, 1, [2, 3], self.lapse_definitions, mode="ro")
+                expected = calculator.abstinence_prolonged(1, [2, 3], self.lapse_definitions, mode="ro")
+                actual = actual[0].drop(index=imputed_ids), actual[1].loc[~actual[1]["id"].isin(imputed_ids)]
+                expected = expected[0].drop(index=imputed_ids), expected[1].loc[~expected[1]["id"].isin(imputed_ids)]
+                self.assert_results_equal(actual, expected, check_index=False)
+
+    def test_responders_only_imputed_visits_are_missing(self):
+        tlfb_data, visit_data = _processed_data(self.trial_data, True)
+        calculator = ac.AbstinenceCalculator(tlfb_data, visit_data)
+        imputed = visit_data.data.loc[visit_data.data["imputation_code"] != 0, :]
+        self.assertTrue(imputed["visit"].isin([1, 2, 3]).any())
+
+        actual = abstinence_prolonged(tlfb_data, visit_data, 1, [2, 3], self.lapse_definitions, mode="ro")
+        expected = _by_visit(lambda x: calculator.abstinence_prolonged(1, x, self.lapse_definitions, mode="ro"), [2, 3])
+        self.assert_results_equal(actual, (expected[0][actual[0].columns], expected[1]), check_index=False)
+        # The windows that start after an imputed quit visit or end at an imputed visit are missing
+        missing_ids = imputed.loc[imputed["visit"] == 1, "id"]
+        self.assertTrue(actual[0].loc[missing_ids, :].isna().all(axis=None))
+        for visit in (2, 3):
+            missing_ids = imputed.loc[imputed["visit"] == visit, "id"]
+            self.assertTrue(actual[0].loc[missing_ids, actual[0].columns.str.endswith(f"_v{visit}")].isna().
+                            all(axis=None))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+import unittest
+import abstcal as ac
+import pandas as pd
+import pipeline
+from tests.test_lapse_rules import _AbstinenceTestCase
+
+
+def _abst_params(mode):
+    return ({"visits": [2, 3], "days": [7, 30], "abst_var_names": "infer"},
+            {"quit_visit": 1, "visits": [3], "lapse_definitions": [False, "5 cigs", "2 days/7 days"],
+             "grace_period": 14, "abst_var_names": "infer"},
+            {"start_visit": 1, "visits": [2, 3], "abst_var_names": "infer"},
+            {"including_end": False, "mode": mode})
+
+
+def _without_subjects(results, subject_ids):
+    abst_df, lapse_df = results
+    return abst_df.drop(index=subject_ids), lapse_df.loc[~lapse_df["id"].isin(subject_ids)]
+
+
+class ShardedCalculationTest(_AbstinenceTestCase):
+    def test_shards_match_the_serial_calculation_and_abstcal(self):
+        for case, tlfb_data, visit_data in self._data_cases():
+            # A subject without visits isn't calculated, by abstcal or by any shard
+            tlfb_data.data = pd.concat([tlfb_data.data, tlfb_data.data.loc[tlfb_data.data["id"] == 1000].assign(id=1)],
+                                       ignore_index=True)
+            tlfb_data.subject_ids.add(1)
+            calculator = ac.AbstinenceCalculator(tlfb_data, visit_data)
+            imputed_ids = visit_data.data.loc[visit_data.data["imputation_code"] != 0, "id"].unique()
+            for mode in ("itt", "ro"):
+                with self.subTest(mode=mode, **case):
+                    abst_params = _abst_params(mode)
+                    sharded_results = pipeline._calculate_sharded(tlfb_data, visit_data, abst_params, 2)
+                    serial_results = pipeline._calculate_families(tlfb_data, visit_data, *abst_params)
+                    self.assertEqual(len(sharded_results), 3)
+                    for sharded, serial in zip(sharded_results, serial_results):
+                        self.assert_results_equal(sharded, serial)
+
+                    pp_params, prol_params, cont_params, _ = abst_params
+                    expected_results = [
+                        calculator.abstinence_pp(pp_params["visits"], pp_params["days"], mode=mode),
+                        calculator.abstinence_prolonged(1, prol_params["visits"], prol_params["lapse_definitions"],
+                                                        mode=mode),
+                        calculator.abstinence_cont(1, cont_params["visits"], mode=mode)
+                    ]
+                    for sharded, expected in zip(sharded_results, expected_results):
+                        if mode == "itt":
+                            self.assert_results_equal(sharded, expected)
+                        else:
+                            # abstcal shifts the responders-only scores of the subjects with imputed visits (see
+                            # test_lapse_rules), so they're left out
+                            self.assert_results_equal(_without_subjects(sharded, imputed_ids),
+                                                      _without_subjects(expected, imputed_ids), check_index=False)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,131 @@
+import asyncio
+import base64
+import json
+import tempfile
+import threading
+from unittest import mock
+import pipeline
+from tornado.testing import AsyncHTTPTestCase, gen_test
+from benchmarks.synthetic import make_trial_data
+from disk_cache import DiskCache
+from service import CalculationService, make_app
+
+
+class ServiceTest(AsyncHTTPTestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.disk_cache = pipeline.disk_cache
+        pipeline.disk_cache = DiskCache(self.cache_dir.name)
+        # A single worker, so a calculation can be held in the queue while the same one is requested again
+        self.service = CalculationService(max_workers=1)
+        trial_data = make_trial_data(10, follow_up_days=60, visit_count=3, seed=1)
+        self.dataset = {
+            "tlfb": {"content": base64.b64encode(trial_data.tlfb.to_csv(index=False).encode()).decode(),
+                     "cutoff": 0, "imputation_mode": "linear"},
+            "visit": {"records": json.loads(trial_data.visits_long.to_json(orient="records", date_format="iso")),
+                      "anchor_visit": 0}
+        }
+        super().setUp()
+
+    def tearDown(self):
+        super().tearDown()
+        self.service._executor.shutdown()
+        pipeline.disk_cache = self.disk_cache
+        self.cache_dir.cleanup()
+
+    def get_app(self):
+        return make_app(self.service)
+
+    def _post(self, path, body):
+        return self.http_client.fetch(self.get_url(path), method="POST", body=json.dumps(body), raise_error=False)
+
+    async def _post_dataset(self):
+        response = await self._post("/datasets", self.dataset)
+        self.assertEqual(response.code, 200, response.body)
+        return json.loads(response.body)
+
+    @gen_test(timeout=60)
+    async def test_post_dataset_and_calculate(self):
+        dataset = await self._post_dataset()
+        self.assertEqual(dataset["subjects"], 10)
+        self.assertEqual(dataset["visits"], ["0", "1", "2"])
+
+        response = await self._post("/calculate", {"dataset": dataset["dataset"], "abstinence": {
+            "mode": "itt", "pp": {"visits": [2], "days": [7, 14]}, "continuous": {"start_visit": 1, "visits": [2]}}})
+        self.assertEqual(response.code, 200, response.body)
+        result = json.loads(response.body)
+        self.assertEqual(result["dataset"], dataset["dataset"])
+        self.assertEqual(len(result["abstinence"]), 10)
+        self.assertEqual(set(result["abstinence"][0]), {"id", "itt_pp7_v2", "itt_pp14_v2", "itt_cont_v1_v2"})
+
+        response = await self._post("/calculate?format=csv&table=lapse", {
+            "dataset": dataset["dataset"], "abstinence": {"pp": {"visits": [2], "days": [7]}}})
+        self.assertEqual(response.code, 200, response.body)
+        self.assertEqual(response.body.decode().splitlines()[0], "id,date,amount,abst_name")
+
+    @gen_test(timeout=60)
+    async def test_same_calculations_share_a_run(self):
+        dataset = await self._post_dataset()
+        body = {"dataset": dataset["dataset"], "abstinence": {"mode": "ro", "pp": {"visits": [1, 2], "days": [7]}}}
+        released = threading.Event()
+        self.service._executor.submit(released.wait)
+        requests = [self._post("/calculate", body) for _ in range(2)]
+        for _ in range(500):
+            if self.service.stats()["coalesced"]:
+                break
+            await asyncio.sleep(0.01)
+        released.set()
+        responses = await asyncio.gather(*requests)
+        self.assertEqual(self.service.stats()["coalesced"], 1)
+        self.assertEqual([x.code for x in responses], [200, 200])
+        self.assertEqual(responses[0].body, responses[1].body)
+
+    @gen_test(timeout=60)
+    async def test_unknown_dataset(self):
+        response = await self._post("/calculate", {"dataset": "0123abcd", "abstinence": {
+            "pp": {"visits": [2], "days": [7]}}})
+        self.assertEqual(response.code, 404)
+        self.assertIn("0123abcd", json.loads(response.body)["error"])
+
+        dataset = await self._post_dataset()
+        response = await self.http_client.fetch(self.get_url(f"/datasets/{dataset['dataset']}"), method="DELETE")
+        self.assertEqual(response.code, 204)
+        response = await self.http_client.fetch(self.get_url(f"/datasets/{dataset['dataset']}"), method="DELETE",
+                                                raise_error=False)
+        self.assertEqual(response.code, 404)
+        response = await self._post("/calculate", {"dataset": dataset["dataset"], "abstinence": {
+            "pp": {"visits": [2], "days": [7]}}})
+        self.assertEqual(response.code, 404)
+
+    @gen_test(timeout=60)
+    async def test_invalid_requests(self):
+        # The visit that isn't in the data and the data with an extra column are rejected by abstcal's own errors
+        dataset = await self._post_dataset()
+        response = await self._post("/calculate", {"dataset": dataset["dataset"], "abstinence": {
+            "pp": {"visits": [9], "days": [7]}}})
+        self.assertEqual(response.code, 400)
+        self.assertTrue(json.loads(response.body)["error"])
+
+        response = await self._post("/datasets", dict(self.dataset, tlfb={
+            "records": [{"id": 1000, "date": "2020-01-05", "amount": 1, "note": "extra"}]}))
+        self.assertEqual(response.code, 400)
+        self.assertTrue(json.loads(response.body)["error"])
+
+        response = await self._post("/calculate", {"dataset": dataset["dataset"], "abstinence": dict()})
+        self.assertEqual(response.code, 400)
+
+    @gen_test(timeout=60)
+    async def test_requested_workers_are_bounded(self):
+        dataset = await self._post_dataset()
+        # The service allows a single process by default, so the calculation isn't sharded however many are asked for
+        with mock.patch("pipeline._calculate_sharded") as calculate_sharded:
+            response = await self._post("/calculate", {"dataset": dataset["dataset"], "abstinence": {
+                "workers": 64, "pp": {"visits": [2], "days": [7]}}})
+        self.assertEqual(response.code, 200, response.body)
+        calculate_sharded.assert_not_called()
+
+        for workers in ("many", 0, 2.5, True):
+            response = await self._post("/calculate", {"dataset": dataset["dataset"], "abstinence": {
+                "workers": workers, "pp": {"visits": [2], "days": [7]}}})
+            self.assertEqual(response.code, 400, workers)
+            self.assertIn("workers", json.loads(response.body)["error"])
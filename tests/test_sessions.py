@@ -0,0 +1,131 @@
+import os
+import tempfile
+import threading
+import unittest
+import pandas as pd
+import pipeline
+from batch import build_context
+from disk_cache import DiskCache
+from downloads import download_registry
+from pipeline import PipelineContext
+from sessions import SessionStore, estimate_session_size
+from tests.test_concurrent_sessions import _load_content, _run_session, _session_config
+
+
+class _SlowState(object):
+    def __init__(self, pickling, released):
+        self.pickling = pickling
+        self.released = released
+
+    def __getstate__(self):
+        self.pickling.set()
+        self.released.wait(10)
+        return dict()
+
+
+class SessionStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.spill_dir = tempfile.TemporaryDirectory()
+        self.disk_cache = pipeline.disk_cache
+        pipeline.disk_cache = DiskCache(self.cache_dir.name)
+        pipeline.stage_cache.clear()
+
+    def tearDown(self):
+        pipeline.disk_cache = self.disk_cache
+        pipeline.stage_cache.clear()
+        self.cache_dir.cleanup()
+        self.spill_dir.cleanup()
+
+    def test_processed_context_is_spilled(self):
+        store = SessionStore(max_bytes=2 ** 18, spill_dir=self.spill_dir.name)
+        state = store.get("first", context=PipelineContext())
+        # The session's context holds its uploads, processed data and indexes, as it does after a run of the app
+        loaded = build_context(_session_config(8), load=_load_content)
+        vars(state.context).update(vars(loaded))
+        abst_df, _ = _run_session(state.context)
+
+        upload_bytes = sum(int(params["data"].memory_usage(index=True).sum()) for params in
+                           (state.context.tlfb_data_params, state.context.visit_data_params,
+                            state.context.bio_data_params))
+        processed_bytes = state.context.tlfb_data.nbytes + state.context.tlfb_index.nbytes
+        self.assertGreater(estimate_session_size(state), upload_bytes + processed_bytes)
+        self.assertGreater(estimate_session_size(state), store.max_bytes)
+
+        store.get("second", context=PipelineContext())
+        stats = store.stats()
+        self.assertEqual((stats["sessions"], stats["spilled_sessions"]), (1, 1))
+        self.assertLess(stats["bytes"], store.max_bytes)
+        self.assertTrue(os.path.exists(os.path.join(self.spill_dir.name, "first.pkl.gz")))
+
+        restored = store.get("first", context=PipelineContext())
+        self.assertIsNot(restored, state)
+        self.assertEqual(restored.context.tlfb_key, state.context.tlfb_key)
+        self.assertEqual(restored.context.tlfb_data.frame.row_count, state.context.tlfb_data.frame.row_count)
+        pd.testing.assert_frame_equal(_run_session(restored.context)[0], abst_df)
+
+    def test_spill_is_written_outside_the_lock(self):
+        store = SessionStore(max_sessions=1, spill_dir=self.spill_dir.name)
+        pickling, released = threading.Event(), threading.Event()
+        first = store.get("first", value=_SlowState(pickling, released))
+        thread = threading.Thread(target=store.get, args=("second",))
+        thread.start()
+        self.assertTrue(pickling.wait(10))
+
+        # While the first session is being written, it's served from memory, and its file is discarded afterwards
+        self.assertIs(store.get("first"), first)
+        released.set()
+        thread.join(10)
+        self.assertEqual(store.stats()["sessions"], 1)
+        self.assertFalse(os.path.exists(os.path.join(self.spill_dir.name, "first.pkl.gz")))
+        self.assertTrue(os.path.exists(os.path.join(self.spill_dir.name, "second.pkl.gz")))
+        self.assertFalse([x for x in os.listdir(self.spill_dir.name) if x.endswith(".tmp")])
+
+    def test_held_sessions_are_kept(self):
+        store = SessionStore(max_sessions=1, spill_dir=self.spill_dir.name)
+        with store.hold("first", value=1) as first:
+            store.get("second", value=2)
+            # The run of the first session goes on while the second one comes and goes
+            first.value = 3
+        self.assertEqual(store.stats()["sessions"], 2)
+        self.assertIs(store.get("first"), first)
+        self.assertEqual(store.stats()["sessions"], 1)
+        self.assertEqual(store.get("second").value, 2)
+        self.assertEqual(store.get("first").value, 3)
+
+    def test_busy_sessions_are_kept(self):
+        busy_ids = {"first"}
+        store = SessionStore(max_sessions=1, ttl=0, spill_dir=self.spill_dir.name, busy=busy_ids.__contains__)
+        first = store.get("first", value=1)
+        store.get("second", value=2)
+        self.assertIs(store.get("first"), first)
+
+        busy_ids.clear()
+        store.get("second")
+        self.assertEqual(store.stats(), {"sessions": 1, "spilled_sessions": 1, "bytes": store.resident_bytes(),
+                                         "max_bytes": store.max_bytes})
+        self.assertEqual(store.get("first").value, 1)
+
+    def test_spilled_sessions_drop_their_downloads(self):
+        store = SessionStore(max_sessions=1, spill_dir=self.spill_dir.name)
+        store.get("first", value=1)
+        df = pd.DataFrame({"id": [1000], "itt_pp7_v2": ["abstinent"]})
+        first_token = download_registry.register("first", df, "abstinence", False)
+        store.get("second", value=2)
+        second_token = download_registry.register("second", df, "abstinence", False)
+        self.assertIsNone(download_registry.get(first_token))
+        self.assertIs(download_registry.get(second_token).df, df)
+        download_registry.discard("second")
+        self.assertIsNone(download_registry.get(second_token))
+
+    def test_unreadable_spill_starts_a_new_session(self):
+        store = SessionStore(spill_dir=self.spill_dir.name)
+        path = os.path.join(self.spill_dir.name, "first.pkl.gz")
+        with open(path, "wb") as file:
+            file.write(b"not a pickle")
+        self.assertEqual(store.get("first", value=1).value, 1)
+        self.assertFalse(os.path.exists(path))
+
+
+if __name__ == "__main__":
+    unittest.main()
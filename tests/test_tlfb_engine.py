@@ -0,0 +1,81 @@
+import unittest
+import warnings
+import abstcal as ac
+import pandas as pd
+import tlfb_engine
+from benchmarks.synthetic import make_trial_data
+
+
+def _tlfb_data(df, cutoff):
+    # The records are cleaned the way the pipeline does before the stages under test
+    tlfb_data = ac.TLFBData(df.copy(), abst_cutoff=cutoff)
+    tlfb_data.drop_na_records()
+    tlfb_data.check_duplicates("mean")
+    tlfb_data.recode_outliers(0, 100)
+    return tlfb_data
+
+
+class TLFBEngineTest(unittest.TestCase):
+    def setUp(self):
+        catch_warnings = warnings.catch_warnings()
+        catch_warnings.__enter__()
+        self.addCleanup(catch_warnings.__exit__, None, None, None)
+        warnings.simplefilter("ignore")
+        # The trial with missing records and visits has gaps to impute, the complete one only the last records
+        self.trial_data = make_trial_data(40, follow_up_days=120, visit_count=4, missing_rate=0.1, seed=5)
+        self.complete_trial_data = make_trial_data(20, follow_up_days=120, visit_count=4, missing_rate=0.0,
+                                                   duplicate_rate=0.0, seed=6)
+
+    def test_interpolation_matches_abstcal(self):
+        for trial_data in (self.trial_data, self.complete_trial_data):
+            for half_life, days in ((0.25, 3), (1.5, 7)):
+                with self.subTest(half_life=half_life, days=days):
+                    expected, actual = _tlfb_data(trial_data.bio, 4), _tlfb_data(trial_data.bio, 4)
+                    interpolated_count = tlfb_engine.interpolate_biochemical_data(actual, half_life, days)
+                    self.assertGreater(interpolated_count, 0)
+                    self.assertEqual(interpolated_count, expected.interpolate_biochemical_data(half_life, days))
+                    pd.testing.assert_frame_equal(actual.data, expected.data)
+
+    def _bio_data(self, trial_data):
+        bio_data = _tlfb_data(trial_data.bio, 4)
+        bio_data.interpolate_biochemical_data(0.25, 3)
+        return bio_data
+
+    def test_imputation_matches_abstcal(self):
+        # abstcal only runs with a gap limit, which it then ignores, so it's given one that no gap reaches
+        for trial_data in (self.trial_data, self.complete_trial_data):
+            for use_bio in (False, True):
+                for impute, last_record_action in (("linear", "ffill"), ("uniform", None), (0, "ffill"), (2, 1)):
+                    with self.subTest(missing=trial_data is self.trial_data, use_bio=use_bio, impute=impute,
+                                      last_record_action=last_record_action):
+                        expected, actual = _tlfb_data(trial_data.tlfb, 0), _tlfb_data(trial_data.tlfb, 0)
+                        bio_data = self._bio_data(trial_data) if use_bio else None
+                        expected_summary = expected.impute_data(impute, last_record_action, 1000, bio_data)
+                        actual_summary = tlfb_engine.impute_data(actual, impute, last_record_action, None, bio_data)
+                        pd.testing.assert_frame_equal(actual.data, expected.data)
+                        pd.testing.assert_frame_equal(actual_summary, expected_summary)
+
+    def test_gap_limit_is_applied(self):
+        # Unlike abstcal, which fails without a gap limit and ignores one that's set, the days of the gaps longer
+        # than the limit are imputed as use, and the others the same as without a limit
+        with self.assertRaises(TypeError):
+            _tlfb_data(self.trial_data.tlfb, 0).impute_data("linear", None, None)
+        expected = _tlfb_data(self.trial_data.tlfb, 0)
+        expected.impute_data("linear", None, 2)
+        actual = _tlfb_data(self.trial_data.tlfb, 0)
+        tlfb_engine.impute_data(actual, "linear", None, 2)
+
+        # A gap is as long as the days between the records around it, so a single missing day is a gap of two days
+        imputed = expected.data["imputation_code"] == tlfb_engine.IMPUTED
+        raw_dates = expected.data["date"].where(~imputed)
+        gap_days = (raw_dates.groupby(expected.data["id"]).bfill() -
+                    raw_dates.groupby(expected.data["id"]).ffill()).dt.days
+        long_gaps = imputed & (gap_days > 2)
+        self.assertTrue(long_gaps.any())
+        self.assertTrue((imputed & ~long_gaps).any())
+        pd.testing.assert_frame_equal(actual.data.drop(columns="amount"), expected.data.drop(columns="amount"))
+        pd.testing.assert_series_equal(actual.data["amount"], expected.data["amount"].where(~long_gaps, 1.0))
+
+
+if __name__ == "__main__":
+    unittest.main()
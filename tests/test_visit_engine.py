@@ -0,0 +1,75 @@
+import unittest
+import warnings
+import abstcal as ac
+import numpy as np
+import pandas as pd
+import visit_engine
+from benchmarks.synthetic import make_trial_data
+
+
+def _visit_data_pair(visit_df, data_format="long"):
+    # The same data for abstcal and the engine, each updated in place by its own imputation
+    expected, actual = ac.VisitData(visit_df.copy(), data_format), ac.VisitData(visit_df.copy(), data_format)
+    for visit_data in (expected, actual):
+        visit_data.drop_na_records()
+    return expected, actual
+
+
+class VisitEngineTest(unittest.TestCase):
+    def setUp(self):
+        # abstcal warns of the subjects missing the anchor visit, which some of the cases are meant to have
+        catch_warnings = warnings.catch_warnings()
+        catch_warnings.__enter__()
+        self.addCleanup(catch_warnings.__exit__, None, None, None)
+        warnings.simplefilter("ignore")
+        self.trial_data = make_trial_data(120, follow_up_days=180, visit_count=6, missing_rate=0.15, seed=3)
+        self.complete_trial_data = make_trial_data(60, follow_up_days=180, visit_count=6, missing_rate=0.0, seed=4)
+
+    def assert_imputation_matches(self, visit_df, anchor_visit, impute, data_format="long"):
+        expected, actual = _visit_data_pair(visit_df, data_format)
+        expected_summary = expected.impute_data(anchor_visit, impute)
+        actual_summary = visit_engine.impute_data(actual, anchor_visit, impute)
+        pd.testing.assert_frame_equal(actual.data, expected.data)
+        pd.testing.assert_frame_equal(actual_summary, expected_summary)
+        pd.testing.assert_frame_equal(visit_engine.retention_rates(actual), expected.get_retention_rates())
+        return actual
+
+    def test_imputation_matches_abstcal(self):
+        visits_long = self.trial_data.visits_long
+        # Some subjects are also missing the baseline, so their visits can't be imputed from the anchor
+        without_baseline = visits_long.loc[~((visits_long["visit"] == 0) & (visits_long["id"] % 17 == 0)), :]
+        for impute in ("freq", "mean", {1: 14, 2: 40, 3: 80, 4: 120, 5: 180}):
+            with self.subTest(impute=impute):
+                self.assert_imputation_matches(visits_long, 0, impute)
+                self.assert_imputation_matches(without_baseline, "infer", impute)
+                self.assert_imputation_matches(self.complete_trial_data.visits_long, "infer", impute)
+
+    def test_wide_data_match_abstcal(self):
+        visits_wide = self.trial_data.visits_wide.copy()
+        self.assert_imputation_matches(visits_wide, 0, "freq", "wide")
+        visits_wide.columns = [str(x) for x in visits_wide.columns]
+        self.assert_imputation_matches(visits_wide, "0", "mean", "wide")
+        pd.testing.assert_frame_equal(visit_engine.to_long(visits_wide),
+                                      visits_wide.melt(id_vars="id", var_name="visit", value_name="date"))
+
+    def test_retention_without_imputation_matches_abstcal(self):
+        for visit_df in (self.trial_data.visits_long, self.complete_trial_data.visits_long):
+            visit_data = ac.VisitData(visit_df.copy())
+            pd.testing.assert_frame_equal(visit_engine.retention_rates(visit_data), visit_data.get_retention_rates())
+
+    def test_date_index_matches_the_visit_data(self):
+        visit_data = self.assert_imputation_matches(self.trial_data.visits_long, 0, "freq")
+        self.assertTrue((visit_data.data["imputation_code"] != 0).any())
+        date_index = visit_engine.VisitDateIndex(visit_data.data)
+        subject_ids, visits = sorted(visit_data.subject_ids) + [-1], sorted(visit_data.visits)
+        for mode in ("itt", "ro"):
+            with self.subTest(mode=mode):
+                # The responders-only dates leave out the imputed visits, and the unknown subject has no dates
+                df = visit_data.data if mode == "itt" else visit_data.data.loc[visit_data.data["imputation_code"] == 0]
+                expected = df.pivot(index="id", columns="visit", values="date").\
+                    reindex(index=subject_ids, columns=visits).values.astype("datetime64[D]")
+                np.testing.assert_array_equal(date_index.lookup(subject_ids, visits, mode), expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,239 @@
+import numpy as np
+import pandas as pd
+
+# The imputation code abstcal gives to the imputed TLFB records, which are left out in the responders-only mode
+_IMPUTED_CODE = 1
+
+
+class UsageIndex(object):
+    def __init__(self, tlfb_df, cutoff):
+        """A per-subject cumulative-use index of the TLFB data for constant-time window queries.
+
+        Each subject's records are laid out as a dense array of days from its first to its last record, and the
+        arrays of all the subjects are concatenated. The prefix sums of the amounts, the days above the cutoff and
+        the recorded days over the concatenated arrays answer any window query with two lookups. The prefix sums are
+        kept for all the records ("itt") and for the records that aren't imputed ("ro").
+
+        Parameters
+        ----------
+        tlfb_df : DataFrame
+            The processed TLFB data with the id, date and amount columns, and optionally the imputation_code column.
+        cutoff : float
+            The amount above which a day is counted as a use day.
+
+        """
+        df = tlfb_df.loc[tlfb_df["date"].notna() & tlfb_df["amount"].notna(), :]
+        codes, self.subject_ids = pd.factorize(df["id"], sort=True)
+        days = df["date"].values.astype("datetime64[D]").astype(np.int64)
+        subject_count = len(self.subject_ids)
+        self.first_days = np.full(subject_count, np.iinfo(np.int64).max, dtype=np.int64)
+        np.minimum.at(self.first_days, codes, days)
+        last_days = np.full(subject_count, np.iinfo(np.int64).min, dtype=np.int64)
+        np.maximum.at(last_days, codes, days)
+        self.lengths = (last_days - self.first_days + 1) if subject_count else np.zeros(0, dtype=np.int64)
+        self.offsets = np.concatenate(([0], np.cumsum(self.lengths)[:-1])).astype(np.int64)
+        self.cutoff = cutoff
+
+        positions = self.offsets[codes] + days - self.first_days[codes]
+        imputed = df["imputation_code"].values == _IMPUTED_CODE if "imputation_code" in df.columns \
+            else np.zeros(len(df), dtype=bool)
+        self.amounts = dict()
+        self.amount_prefix = dict()
+        self.use_prefix = dict()
+        self.recorded_prefix = dict()
+        for mode, kept in (("itt", np.ones(len(df), dtype=bool)), ("ro", ~imputed)):
+            amounts = np.full(int(self.lengths.sum()), np.nan)
+            amounts[positions[kept]] = df["amount"].values[kept]
+            recorded = ~np.isnan(amounts)
+            self.amounts[mode] = amounts
+            self.amount_prefix[mode] = np.concatenate(([0.0], np.cumsum(np.where(recorded, amounts, 0.0))))
+            self.use_prefix[mode] = np.concatenate(([0], np.cumsum(recorded & (np.nan_to_num(amounts) > cutoff))))
+            self.recorded_prefix[mode] = np.concatenate(([0], np.cumsum(recorded)))
+
+    @property
+    def nbytes(self):
+        arrays = [self.first_days, self.lengths, self.offsets]
+        for prefixes in (self.amounts, self.amount_prefix, self.use_prefix, self.recorded_prefix):
+            arrays.extend(prefixes.values())
+        return sum(x.nbytes for x in arrays)
+
+    def _positions(self, subject_ids, start_dates, end_dates):
+        codes = pd.Index(self.subject_ids).get_indexer(np.asarray(subject_ids))
+        known = codes >= 0
+        codes = np.where(known, codes, 0)
+        starts = np.asarray(start_dates, dtype="datetime64[D]").astype(np.int64) - self.first_days[codes]
+        ends = np.asarray(end_dates, dtype="datetime64[D]").astype(np.int64) - self.first_days[codes]
+        lengths = np.where(known, self.lengths[codes], 0)
+        starts = self.offsets[codes] + np.clip(starts, 0, lengths)
+        ends = self.offsets[codes] + np.clip(ends, 0, lengths)
+        return codes, starts, np.maximum(ends, starts)
+
+    def window(self, subject_ids, start_dates, end_dates, mode="itt"):
+        """Summarizes the windows [start_date, end_date) of the subjects, all arguments being aligned arrays.
+
+        Returns
+        -------
+        DataFrame
+            The total amount, the use days (above the cutoff), the recorded days and the days of each window.
+
+        """
+        _, starts, ends = self._positions(subject_ids, start_dates, end_dates)
+        window_days = (np.asarray(end_dates, dtype="datetime64[D]") -
+                       np.asarray(start_dates, dtype="datetime64[D]")).astype(np.int64)
+        return pd.DataFrame({
+            "amount": self.amount_prefix[mode][ends] - self.amount_prefix[mode][starts],
+            "use_days": self.use_prefix[mode][ends] - self.use_prefix[mode][starts],
+            "recorded_days": self.recorded_prefix[mode][ends] - self.recorded_prefix[mode][starts],
+            "days": np.maximum(window_days, 0)
+        })
+
+    def first_use(self, subject_ids, start_dates, end_dates, mode="itt"):
+        """Finds the first day above the cutoff in each window [start_date, end_date).
+
+        Returns
+        -------
+        tuple
+            The dates (NaT without any use) and the amounts of the first use days.
+
+        """
+        codes, starts, ends = self._positions(subject_ids, start_dates, end_dates)
+        use_prefix = self.use_prefix[mode]
+        # The prefix sums never decrease, so the first use day is where the sum first exceeds its value at the start
+        positions = np.searchsorted(use_prefix, use_prefix[starts] + 1, side="left") - 1
+        found = positions < ends
+        positions = np.where(found, positions, 0)
+        day_numbers = self.first_days[codes] + positions - self.offsets[codes]
+        dates = np.where(found, day_numbers.astype("datetime64[D]"), np.datetime64("NaT"))
+        amounts = self.amounts[mode][positions] if len(self.amounts[mode]) else np.zeros(len(positions))
+        amounts = np.where(found, amounts, np.nan)
+        return dates, amounts
+
+    def abstinent(self, subject_ids, start_dates, end_dates, mode="itt"):
+        """Scores the windows [start_date, end_date) with the same rules as abstcal's continuous abstinence.
+
+        A window is abstinent (1) when every day is recorded at or below the cutoff. In the intent-to-treat mode,
+        windows with missing days or invalid dates are non-abstinent (0), while they're NaN in the responders-only mode.
+        """
+        start_dates = np.asarray(start_dates, dtype="datetime64[D]")
+        end_dates = np.asarray(end_dates, dtype="datetime64[D]")
+        summary = self.window(subject_ids, start_dates, end_dates, mode)
+        complete = summary["recorded_days"].values == summary["days"].values
+        scores = (complete & (summary["use_days"].values == 0)).astype(float)
+        invalid = np.isnat(start_dates) | np.isnat(end_dates) | (start_dates >= end_dates)
+        if mode == "itt":
+            scores[invalid] = 0
+        else:
+            scores[invalid | ~complete] = np.nan
+        return scores
+
+    def point_prevalence(self, visit_dates, days, including_end=False, mode="itt"):
+        """Scores the point-prevalence windows of all the subjects and visits in one pass.
+
+        Parameters
+        ----------
+        visit_dates : DataFrame
+            The visit dates with the subject ids as the index and the visits as the columns.
+        days : list
+            The numbers of the days preceding the visit dates.
+        including_end : bool
+            Whether the visit date is the last day of the window.
+        mode : str
+            "itt" for intent-to-treat or "ro" for responders-only.
+
+        Returns
+        -------
+        DataFrame
+            The scores with the subject ids as the index and a column for each (visit, days) pair.
+
+        """
+        end_dates = visit_dates.values.astype("datetime64[D]") + np.timedelta64(int(including_end), "D")
+        subject_ids = np.repeat(visit_dates.index.values, end_dates.shape[1])
+        # The columns are kept by position, so the same number of days listed twice gives two sets of columns
+        scores = list()
+        for day in days:
+            start_dates = end_dates - np.timedelta64(int(day), "D")
+            scores.append(self.abstinent(subject_ids, start_dates.ravel(), end_dates.ravel(), mode).
+                          reshape(end_dates.shape))
+        columns = pd.MultiIndex.from_arrays([list(visit_dates.columns) * len(days),
+                                             np.repeat(days, len(visit_dates.columns))])
+        return pd.DataFrame(np.hstack(scores) if scores else np.zeros((len(visit_dates), 0)),
+                            index=visit_dates.index, columns=columns)
+
+    def lapses(self, subject_ids, start_dates, end_dates, rules, mode="itt"):
+        """Scores the windows [start_date, end_date) by each of the lapse rules with the same rules as abstcal.
+
+        The windows are located once, and each rule is a few array passes over the prefix sums. A rule without a
+        threshold allows no lapse, the first use day being the lapse. A rule without a window is a lapse once the
+        total amount (or the use days) since the start of the window reaches the threshold. A rule with a window is a
+        lapse once the amount (or the use days) in the rolling window that starts on a use day exceeds the threshold.
+        The amounts are expected to be non-negative, which keeps the prefix sums sorted.
+
+        Parameters
+        ----------
+        subject_ids, start_dates, end_dates : array-like
+            The aligned subject ids and the dates of the windows.
+        rules : list
+            The LapseRule objects to apply.
+        mode : str
+            "itt" for intent-to-treat or "ro" for responders-only.
+
+        Returns
+        -------
+        list
+            The scores, the lapse dates (NaT without a lapse) and the lapse amounts of each rule.
+
+        """
+        start_dates = np.asarray(start_dates, dtype="datetime64[D]")
+        end_dates = np.asarray(end_dates, dtype="datetime64[D]")
+        codes, starts, ends = self._positions(subject_ids, start_dates, end_dates)
+        invalid = np.isnat(start_dates) | np.isnat(end_dates) | (start_dates >= end_dates)
+        window_days = np.where(invalid, -1, (end_dates - start_dates).astype(np.int64))
+        recorded_prefix, use_prefix = self.recorded_prefix[mode], self.use_prefix[mode]
+        complete = ~invalid & (recorded_prefix[ends] - recorded_prefix[starts] == window_days)
+        default = 0.0 if mode == "itt" else np.nan
+
+        rule_results = list()
+        for rule in rules:
+            if rule.threshold is None:
+                positions = np.searchsorted(use_prefix, use_prefix[starts] + 1, side="left") - 1
+                found = ~invalid & (positions < ends)
+                if mode != "itt":
+                    found &= complete
+            else:
+                prefix = use_prefix if rule.counts_days else self.amount_prefix[mode]
+                if rule.window is None:
+                    positions = np.searchsorted(prefix, prefix[starts] + rule.threshold, side="left") - 1
+                    found = ~invalid & (positions < ends)
+                else:
+                    lapse_starts, found = self._rolling_lapse_starts(prefix, use_prefix, starts, ends, rule)
+                    found &= ~invalid
+                    lapse_starts = np.where(found, lapse_starts, 0)
+                    positions = np.searchsorted(prefix, prefix[lapse_starts] + rule.threshold, side="right") - 1
+            scores = np.where(complete, (~found).astype(float), default)
+            positions = np.where(found, positions, 0)
+            day_numbers = self.first_days[codes] + positions - self.offsets[codes]
+            dates = np.where(found, day_numbers.astype("datetime64[D]"), np.datetime64("NaT"))
+            amounts = self.amounts[mode][positions] if len(self.amounts[mode]) else np.zeros(len(positions))
+            rule_results.append((scores, dates, np.where(found, amounts, np.nan)))
+        return rule_results
+
+    def _rolling_lapse_starts(self, prefix, use_prefix, starts, ends, rule):
+        # A use day qualifies when its rolling window, which ends early at the end of the subject's days, exceeds the
+        # threshold. A window that would run past the end of the scored window is cut there, and as the cut sums only
+        # shrink with later starts, only the first use day among those starts needs to be checked.
+        total_length = len(prefix) - 1
+        day_positions = np.arange(total_length)
+        subject_ends = np.repeat(self.offsets + self.lengths, self.lengths)
+        window_ends = np.minimum(day_positions + rule.window, subject_ends)
+        is_use = np.diff(use_prefix) > 0
+        qualified = is_use & (prefix[window_ends] - prefix[day_positions] > rule.threshold)
+        qualified_prefix = np.concatenate(([0], np.cumsum(qualified)))
+
+        full_ends = np.clip(ends - rule.window + 1, starts, ends)
+        full_starts = np.searchsorted(qualified_prefix, qualified_prefix[starts] + 1, side="left") - 1
+        found_full = full_starts < full_ends
+        cut_starts = np.searchsorted(use_prefix, use_prefix[full_ends] + 1, side="left") - 1
+        found_cut = cut_starts < ends
+        cut_starts = np.where(found_cut, cut_starts, 0)
+        found_cut &= prefix[ends] - prefix[cut_starts] > rule.threshold
+        return np.where(found_full, full_starts, cut_starts), found_full | found_cut
@@ -0,0 +1,204 @@
+import warnings
+from datetime import timedelta
+import numpy as np
+import pandas as pd
+
+# The imputation codes used by abstcal
+RAW, IMPUTED = 0, 1
+
+_DAY_NS = 86400 * 10 ** 9
+
+
+def to_long(wide_df):
+    """Reshapes the wide visit data, the id column followed by a date column per visit, to the long format.
+
+    The rows are laid out visit by visit, the same as the melt of VisitData, with array operations.
+
+    Returns
+    -------
+    DataFrame
+        The id, visit and date columns, with a row for every subject and visit.
+
+    """
+    visits = [x for x in wide_df.columns if x != "id"]
+    subject_count = len(wide_df)
+    return pd.DataFrame({
+        "id": np.tile(wide_df["id"].values, len(visits)),
+        "visit": np.repeat(pd.Index(visits).values, subject_count),
+        "date": wide_df[visits].values.ravel(order="F") if visits else np.zeros(0)
+    })
+
+
+def to_wide(visit_df):
+    """Reshapes the long visit data to one row per subject, the first visit of a duplicated one being kept.
+
+    Returns
+    -------
+    DataFrame
+        The id column followed by a date column per visit, in the visits' sorted order.
+
+    """
+    wide_df = visit_df.drop_duplicates(["id", "visit"]).pivot(index="id", columns="visit", values="date").\
+        reset_index()
+    wide_df.columns.name = None
+    return wide_df
+
+
+def _day_differences(dates, anchor_dates):
+    # The whole days from the anchor, rounded down as timedelta.days is, and NaN when either date is missing
+    differences = dates.astype(np.int64) - anchor_dates.astype(np.int64)[:, None]
+    missing = np.isnat(dates) | np.isnat(anchor_dates)[:, None]
+    return np.where(missing, np.nan, np.floor_divide(np.where(missing, 0, differences), _DAY_NS))
+
+
+def impute_data(visit_data, anchor_visit="infer", impute="freq"):
+    """Imputes the missing visit dates, the same as VisitData.impute_data but for all the subjects and visits at once.
+
+    The dates are laid out as a dense subject x visit matrix, and the intervals from the anchor visit, their most
+    frequent or mean days by visit, and the imputed dates are whole-matrix operations. The data with duplicate visits
+    of a subject, which abstcal pairs up row by row, are imputed by abstcal.
+
+    Parameters
+    ----------
+    visit_data : VisitData
+        The visit data, which are updated in place.
+    anchor_visit : object
+        The visit whose dates the others are imputed from, "infer" for the most common first visit of the subjects.
+    impute : str or dict
+        "freq" for the most frequent interval, "mean" for the average interval, a dict of the interval days by
+        visit, or None for no imputation.
+
+    Returns
+    -------
+    DataFrame
+        The record counts by the imputation code.
+
+    """
+    if impute is None or str(impute).lower() == "none":
+        return None
+    if impute not in ("freq", "mean") and not isinstance(impute, dict):
+        raise ValueError("The imputation mode can only be None, 'freq', 'mean', or a dict of the interval days.")
+
+    data = visit_data.data
+    if "imputation_code" in data.columns:
+        data = data[data["imputation_code"] == RAW]
+    data = data.sort_values(by=["id", "visit"], ignore_index=True)
+    if isinstance(anchor_visit, str) and anchor_visit == "infer":
+        anchor_visit = data.loc[data.groupby("id")["date"].idxmin(), "visit"].value_counts().idxmax()
+    if data.duplicated(["id", "visit"]).any():
+        return visit_data.impute_data(anchor_visit, impute)
+
+    subject_ids = pd.Index(sorted(visit_data.subject_ids))
+    visits = pd.Index([anchor_visit] + [x for x in visit_data.visits if x != anchor_visit])
+    rows, columns = subject_ids.get_indexer(data["id"]), visits.get_indexer(data["visit"])
+    dates = np.full((len(subject_ids), len(visits)), np.datetime64("NaT"), dtype="datetime64[ns]")
+    dates[rows, columns] = data["date"].values.astype("datetime64[ns]")
+    anchor_dates = dates[:, 0]
+    missing_anchor_ids = set(subject_ids[np.isnat(anchor_dates)])
+    if missing_anchor_ids:
+        warnings.warn(f"Subjects {missing_anchor_ids} are missing anchor visit {anchor_visit}. "
+                      f"There might be problems calculating abstinence data for these subjects.")
+
+    imputed_dates = dates.copy()
+    imputed_dates[:, 0] = anchor_dates
+    day_differences = _day_differences(dates[:, 1:], anchor_dates)
+    for i, visit in enumerate(visits[1:]):
+        # The intervals are summarized by pandas, which breaks the ties of the most frequent one the way abstcal does
+        if impute == "freq":
+            used_days = pd.Series(day_differences[:, i]).value_counts().idxmax()
+        elif impute == "mean":
+            used_days = int(pd.Series(day_differences[:, i]).mean())
+        else:
+            used_days = impute[visit]
+        missing = np.isnat(dates[:, i + 1])
+        imputed_dates[missing, i + 1] = anchor_dates[missing] + np.timedelta64(timedelta(days=used_days))
+
+    visit_data.data = pd.DataFrame({
+        "id": np.repeat(subject_ids.values, len(visits)),
+        "visit": np.tile(visits.values, len(subject_ids)),
+        "date": imputed_dates.ravel(),
+        "imputation_code": np.isnat(dates).ravel().astype(np.int64)
+    }).sort_values(by=["id", "visit"], ignore_index=True)
+    impute_summary = visit_data.data.groupby(["imputation_code"]).size().reset_index().\
+        rename({0: "record_count"}, axis=1)
+    impute_summary["imputation_code"] = impute_summary["imputation_code"].map({RAW: "RAW", IMPUTED: "IMPUTED"})
+    return impute_summary
+
+
+def _format_rate(counts, subject_count):
+    return counts.map(lambda x: f"{x / subject_count:.2%}")
+
+
+def retention_rates(visit_data):
+    """Gets the retention of the subjects by visit, the same as VisitData.get_retention_rates.
+
+    The subjects are lost after their last recorded visit, which is found in one sorted pass, and the subjects
+    remaining at each visit are the cumulative losses of the preceding visits.
+
+    Returns
+    -------
+    DataFrame
+        The subject count and the retention, attrition and attendance rates, indexed by the visits.
+
+    """
+    data = visit_data.data
+    recorded = data[data["imputation_code"] == RAW] if "imputation_code" in data.columns else data
+    sorted_visits = visit_data.expected_ordered_visits or sorted(visit_data.visits)
+    # The stable sort keeps the first of the latest visits of a subject first, the one idxmax would find
+    last_visits = recorded.sort_values(by=["id", "date"], ascending=[True, False], kind="mergesort").\
+        drop_duplicates("id")["visit"]
+    losses = last_visits.value_counts().reindex(sorted_visits, fill_value=0).values
+    subject_count = len(visit_data.subject_ids)
+
+    retention_df = pd.DataFrame({"subject_count": subject_count - (np.cumsum(losses) - losses)},
+                                index=pd.Index(sorted_visits, name="visit"))
+    retention_df["retention_rate"] = _format_rate(retention_df["subject_count"], subject_count)
+    retention_df["attrition_rate"] = _format_rate(subject_count - retention_df["subject_count"], subject_count)
+    retention_df["attendance_rate"] = _format_rate(data["visit"].value_counts(), subject_count)
+    return retention_df
+
+
+class VisitDateIndex(object):
+    def __init__(self, visit_df):
+        """A dense subject x visit matrix of the processed visit dates for lookups by index.
+
+        The matrix is kept for all the visits ("itt") and for the visits that aren't imputed ("ro"), with the first
+        date of a duplicated visit. An extra row and column of missing dates answer the unknown subjects and visits.
+
+        Parameters
+        ----------
+        visit_df : DataFrame
+            The processed visit data with the id, visit and date columns, and optionally the imputation_code column.
+
+        """
+        self.subject_ids = pd.Index(sorted(visit_df["id"].unique()))
+        self.visits = pd.Index(pd.unique(visit_df["visit"]))
+        imputed = visit_df["imputation_code"].values != RAW if "imputation_code" in visit_df.columns \
+            else np.zeros(len(visit_df), dtype=bool)
+        self.dates = dict()
+        for mode, kept in (("itt", np.ones(len(visit_df), dtype=bool)), ("ro", ~imputed)):
+            df = visit_df.loc[kept, :]
+            df = df.loc[~df.duplicated(["id", "visit"]).values, :]
+            dates = np.full((len(self.subject_ids) + 1, len(self.visits) + 1), np.datetime64("NaT"),
+                            dtype="datetime64[D]")
+            dates[self.subject_ids.get_indexer(df["id"]), self.visits.get_indexer(df["visit"])] = \
+                df["date"].values.astype("datetime64[ns]").astype("datetime64[D]")
+            self.dates[mode] = dates
+
+    @property
+    def nbytes(self):
+        return sum(x.nbytes for x in self.dates.values())
+
+    def lookup(self, subject_ids, visits, mode="itt"):
+        """Gets the dates of the subjects (rows) at the visits (columns), NaT for the missing ones.
+
+        Returns
+        -------
+        ndarray
+            The datetime64[D] dates of the subjects by the visits.
+
+        """
+        rows = self.subject_ids.get_indexer(np.asarray(subject_ids))
+        columns = self.visits.get_indexer(pd.Index(list(visits)))
+        # The unknown subjects and visits are at -1, which is the extra row and column of missing dates
+        return self.dates[mode][rows[:, None], columns[None, :]]